@@ -0,0 +1,81 @@
+/*
+Lookup cost of the per worker flow tables: std::map (the previous implementation) against FlowTable.
+
+Build and run (same dependencies of the binaries, see the Dockerfile):
+g++ binsrc/bench/flow_table_bench.cpp -o flow_table_bench -std=c++23 -O3 -lnetfilter_queue -lnfnetlink $(pkg-config --cflags --libs libtins libmnl)
+./flow_table_bench [lookups per size]
+*/
+
+#include "../classes/nfqueue.cpp"
+#include <iostream>
+#include <iomanip>
+#include <chrono>
+#include <random>
+#include <map>
+#include <vector>
+#include <cstdlib>
+#include <cstring>
+
+using namespace std;
+using Firegex::NfQueue::stream_id;
+using Firegex::NfQueue::stream_table;
+
+vector<stream_id> make_flows(size_t n, mt19937& rng){
+	vector<stream_id> flows;
+	flows.reserve(n);
+	stream_id::address_type server{};
+	server[0] = 10; server[3] = 1;
+	for (size_t i = 0; i < n; i++){
+		// Many clients towards the same service, as seen by a single firegex service
+		stream_id::address_type client{};
+		uint32_t client_ip = rng();
+		memcpy(client.data(), &client_ip, sizeof(client_ip));
+		flows.emplace_back(client, uint16_t(1024 + rng() % 64000), server, 80);
+	}
+	return flows;
+}
+
+template<typename F>
+double ns_per_op(size_t ops, F&& f){
+	auto start = chrono::steady_clock::now();
+	f();
+	auto end = chrono::steady_clock::now();
+	return chrono::duration<double, nano>(end - start).count() / ops;
+}
+
+int main(int argc, char *argv[]){
+	size_t lookups = argc > 1 ? ::atoll(argv[1]) : 10000000;
+	mt19937 rng(42);
+	cout << setw(10) << "flows" << setw(16) << "map insert" << setw(16) << "table insert"
+		<< setw(16) << "map lookup" << setw(16) << "table lookup" << "   (ns/op)" << endl;
+	for (size_t n_flows : {10000, 100000, 1000000}){
+		vector<stream_id> flows = make_flows(n_flows, rng);
+		vector<uint32_t> order(lookups);
+		for (auto& i : order){
+			i = rng() % n_flows;
+		}
+
+		map<stream_id, void*> tree;
+		stream_table<void*> table;
+		double tree_insert = ns_per_op(n_flows, [&](){
+			for (auto& sid : flows) tree.insert_or_assign(sid, (void*)&sid);
+		});
+		double table_insert = ns_per_op(n_flows, [&](){
+			for (auto& sid : flows) table.insert_or_assign(sid, (void*)&sid);
+		});
+
+		size_t found = 0;
+		double tree_lookup = ns_per_op(lookups, [&](){
+			for (auto i : order) found += tree.find(flows[i]) != tree.end();
+		});
+		double table_lookup = ns_per_op(lookups, [&](){
+			for (auto i : order) found += table.find(flows[i]) != table.end();
+		});
+		if (found != 2 * lookups){
+			cerr << "[error] [main] lookups failed: " << found << endl;
+			return 1;
+		}
+		cout << fixed << setprecision(1) << setw(10) << n_flows << setw(16) << tree_insert << setw(16) << table_insert
+			<< setw(16) << tree_lookup << setw(16) << table_lookup << endl;
+	}
+}
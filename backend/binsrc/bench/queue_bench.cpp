@@ -0,0 +1,108 @@
+/*
+Hand-off cost of the BlockingQueue implementations (see utils.cpp): a producer (the nfqueue reader)
+spreads the packets round robin over the workers, each worker takes them from its own queue.
+Reported for each implementation and number of workers: packets/sec and hand-off latency (put -> take).
+
+Build and run:
+g++ binsrc/bench/queue_bench.cpp -o queue_bench -std=c++23 -O3 -pthread
+./queue_bench [packets]
+*/
+
+#include "../utils.cpp"
+#include <iostream>
+#include <iomanip>
+#include <chrono>
+#include <vector>
+#include <thread>
+#include <algorithm>
+#include <memory>
+#include <string>
+#include <cstdlib>
+
+using namespace std;
+
+struct fake_packet {
+	chrono::steady_clock::time_point sent;
+	bool last = false;
+};
+
+struct bench_result {
+	double packets_per_sec;
+	double avg_latency_ns;
+	double p99_latency_ns;
+};
+
+template<typename Queue>
+bench_result run_bench(size_t n_workers, size_t n_packets){
+	vector<unique_ptr<Queue>> queues;
+	for (size_t i = 0; i < n_workers; i++){
+		queues.push_back(make_unique<Queue>());
+	}
+	vector<fake_packet> packets(n_packets + n_workers);
+	vector<vector<double>> latencies(n_workers);
+	vector<thread> workers;
+	for (size_t i = 0; i < n_workers; i++){
+		latencies[i].reserve(n_packets / n_workers + 1);
+		workers.emplace_back([&, i](){
+			fake_packet* pkt;
+			for (;;){
+				queues[i]->take(pkt);
+				if (pkt->last){
+					return;
+				}
+				latencies[i].push_back(chrono::duration<double, nano>(chrono::steady_clock::now() - pkt->sent).count());
+			}
+		});
+	}
+	auto start = chrono::steady_clock::now();
+	for (size_t i = 0; i < n_packets; i++){
+		packets[i].sent = chrono::steady_clock::now();
+		queues[i % n_workers]->put(&packets[i]);
+	}
+	for (size_t i = 0; i < n_workers; i++){
+		packets[n_packets + i].last = true;
+		queues[i]->put(&packets[n_packets + i]);
+	}
+	for (auto& worker : workers){
+		worker.join();
+	}
+	auto end = chrono::steady_clock::now();
+
+	vector<double> all;
+	all.reserve(n_packets);
+	for (auto& l : latencies){
+		all.insert(all.end(), l.begin(), l.end());
+	}
+	if (all.size() != n_packets){
+		cerr << "[error] [run_bench] lost packets: " << (n_packets - all.size()) << endl;
+		exit(1);
+	}
+	sort(all.begin(), all.end());
+	double sum = 0;
+	for (double l : all){
+		sum += l;
+	}
+	return bench_result{
+		packets_per_sec: n_packets / chrono::duration<double>(end - start).count(),
+		avg_latency_ns: sum / all.size(),
+		p99_latency_ns: all[all.size() * 99 / 100]
+	};
+}
+
+template<typename Queue>
+void print_bench(const string& name, size_t n_workers, size_t n_packets){
+	bench_result res = run_bench<Queue>(n_workers, n_packets);
+	cout << fixed << setprecision(0) << setw(8) << name << setw(10) << n_workers << setw(16) << res.packets_per_sec
+		<< setw(14) << res.avg_latency_ns << setw(14) << res.p99_latency_ns << endl;
+}
+
+int main(int argc, char *argv[]){
+	size_t n_packets = argc > 1 ? ::atoll(argv[1]) : 2000000;
+	cout << setw(8) << "queue" << setw(10) << "workers" << setw(16) << "packets/sec"
+		<< setw(14) << "avg lat ns" << setw(14) << "p99 lat ns" << endl;
+	for (size_t n_workers : {1, 4, 16}){
+		print_bench<MutexBlockingQueue<fake_packet*>>("mutex", n_workers, n_packets);
+		print_bench<PipeBlockingQueue<fake_packet*>>("pipe", n_workers, n_packets);
+		print_bench<RingBlockingQueue<fake_packet*>>("ring", n_workers, n_packets);
+	}
+}
@@ -0,0 +1,78 @@
+#ifndef ALLOC_STATS_CPP
+#define ALLOC_STATS_CPP
+
+#include <atomic>
+#include <thread>
+#include <chrono>
+#include <iostream>
+#include <cstdlib>
+#include <new>
+
+using namespace std;
+
+/*
+Compile with -DFIREGEX_ALLOC_STATS to count the C++ heap allocations (operator new) of the process:
+every 5 seconds the allocations per handled packet are written on stderr.
+Without the define all the functions are no-op.
+*/
+
+namespace Firegex {
+namespace NfQueue {
+
+#ifdef FIREGEX_ALLOC_STATS
+
+atomic<uint64_t> allocations_count{0};
+atomic<uint64_t> handled_packets_count{0};
+
+inline void count_handled_packet(){
+	handled_packets_count.fetch_add(1, memory_order_relaxed);
+}
+
+void run_alloc_stats_reporter(){
+	thread([](){
+		uint64_t last_allocations = 0, last_packets = 0;
+		for(;;){
+			this_thread::sleep_for(chrono::seconds(5));
+			uint64_t allocations = allocations_count.load(memory_order_relaxed);
+			uint64_t packets = handled_packets_count.load(memory_order_relaxed);
+			if (packets != last_packets){
+				cerr << "[info] [alloc_stats] " << (packets - last_packets) << " packets, "
+					<< double(allocations - last_allocations) / (packets - last_packets) << " allocations per packet" << endl;
+			}
+			last_allocations = allocations;
+			last_packets = packets;
+		}
+	}).detach();
+}
+
+#else
+
+inline void count_handled_packet(){}
+inline void run_alloc_stats_reporter(){}
+
+#endif
+
+}}
+
+#ifdef FIREGEX_ALLOC_STATS
+
+void* operator new(size_t size){
+	Firegex::NfQueue::allocations_count.fetch_add(1, memory_order_relaxed);
+	void* ptr = malloc(size == 0 ? 1 : size);
+	if (ptr == nullptr){
+		throw bad_alloc();
+	}
+	return ptr;
+}
+
+void operator delete(void* ptr) noexcept {
+	free(ptr);
+}
+
+void operator delete(void* ptr, size_t) noexcept {
+	free(ptr);
+}
+
+#endif
+
+#endif // ALLOC_STATS_CPP
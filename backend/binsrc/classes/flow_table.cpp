@@ -0,0 +1,349 @@
+#ifndef FLOW_TABLE_CPP
+#define FLOW_TABLE_CPP
+
+#include <vector>
+#include <cstdint>
+#include <cstddef>
+#include <utility>
+#include <string>
+#include <thread>
+#include <cstdlib>
+#include <atomic>
+#include <chrono>
+
+using namespace std;
+
+namespace Firegex {
+namespace NfQueue {
+
+/*
+Settings used by the flow tables created by the workers (read from the environment in main):
+FIREGEX_FLOW_TABLE_CAPACITY - initial number of slots of each table (rounded up to a power of 2, default 4096)
+FIREGEX_FLOW_TABLE_MAX - max number of flows tracked by each table, when reached the least recently
+	used flow is evicted to make room (0 means no limit, the default depends on the binary)
+FIREGEX_FLOW_IDLE_TIMEOUT - seconds without packets after which a flow is evicted (default 300, 0 disables it)
+FIREGEX_FLOW_STATS_INTERVAL - seconds between the "FLOWS <tracked> <evicted idle> <evicted full>" reports (default 5)
+*/
+struct flow_table_config {
+	size_t initial_capacity = 4096;
+	size_t max_entries = 0;
+	uint32_t idle_timeout = 300;
+	unsigned int stats_interval = 5;
+};
+
+flow_table_config flow_table_settings;
+
+void load_flow_table_settings(){
+	char * capacity = getenv("FIREGEX_FLOW_TABLE_CAPACITY");
+	if (capacity != nullptr && ::atoll(capacity) > 0) flow_table_settings.initial_capacity = ::atoll(capacity);
+	char * max_entries = getenv("FIREGEX_FLOW_TABLE_MAX");
+	if (max_entries != nullptr && ::atoll(max_entries) >= 0) flow_table_settings.max_entries = ::atoll(max_entries);
+	char * idle_timeout = getenv("FIREGEX_FLOW_IDLE_TIMEOUT");
+	if (idle_timeout != nullptr && ::atoll(idle_timeout) >= 0) flow_table_settings.idle_timeout = ::atoll(idle_timeout);
+	char * stats_interval = getenv("FIREGEX_FLOW_STATS_INTERVAL");
+	if (stats_interval != nullptr && ::atoi(stats_interval) > 0) flow_table_settings.stats_interval = ::atoi(stats_interval);
+}
+
+// Slots checked for idle flows at each packet, and entries sampled to choose the one evicted from a full table
+constexpr size_t FLOW_SWEEP_STEP = 8;
+constexpr size_t FLOW_EVICT_SAMPLES = 16;
+
+// Counters of all the tables of the process, reported to the backend
+struct flow_table_counters {
+	atomic<int64_t> tracked{0};
+	atomic<uint64_t> evicted_idle{0};
+	atomic<uint64_t> evicted_full{0};
+
+	string report(){
+		return "FLOWS " + to_string(tracked.load(memory_order_relaxed)) + " " +
+			to_string(evicted_idle.load(memory_order_relaxed)) + " " +
+			to_string(evicted_full.load(memory_order_relaxed)) + "\n";
+	}
+};
+
+flow_table_counters flow_table_stats;
+
+// Coarse clock (seconds) used for the idle time of the flows, updated by each worker before handling a packet
+thread_local uint32_t flow_clock = 0;
+
+inline void update_flow_clock(){
+	flow_clock = chrono::duration_cast<chrono::seconds>(chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+// Writes the report with write_line every FIREGEX_FLOW_STATS_INTERVAL seconds, when it changes
+template<typename F>
+void run_flow_stats_reporter(F write_line){
+	thread([write_line](){
+		string last_report;
+		for(;;){
+			this_thread::sleep_for(chrono::seconds(flow_table_settings.stats_interval));
+			string report = flow_table_stats.report();
+			if (report != last_report){
+				write_line(report);
+				last_report = report;
+			}
+		}
+	}).detach();
+}
+
+/*
+Open addressing hash table (linear probing, backward shift deletion) used for the per-flow state of the workers.
+The hash of the key is stored with the entry, so probing compares the full key only on hash match
+and growing never calls the hash function again.
+Hash must return a well mixed uint32_t: the slot is chosen with its most significant bits.
+Each entry keeps the flow_clock of its last find/insert, used to evict the idle flows (evict_idle, a few slots
+at a time) and to make room in a full table (evict_oldest, approximated LRU over a sample of entries).
+Iterators are invalidated by insertions and deletions.
+*/
+template<typename K, typename V, typename Hash>
+class FlowTable {
+	public:
+		struct entry {
+			K first;
+			V second;
+		};
+
+	private:
+		struct slot {
+			entry kv;
+			uint32_t hash = 0;
+			uint32_t last_seen = 0;
+			bool used = false;
+		};
+
+		vector<slot> slots;
+		size_t n_entries = 0;
+		unsigned int bits = 0;
+		size_t sweep_pos = 0;
+		Hash hasher;
+
+		static unsigned int bits_for(size_t capacity){
+			unsigned int b = 4;
+			while ((size_t(1) << b) < capacity && b < 31){
+				b++;
+			}
+			return b;
+		}
+
+		inline size_t mask() const {
+			return slots.size() - 1;
+		}
+
+		inline size_t home(uint32_t hash) const {
+			return hash >> (32 - bits);
+		}
+
+		size_t lookup(const K& key, uint32_t hash) const {
+			for (size_t i = home(hash);; i = (i + 1) & mask()){
+				const slot& s = slots[i];
+				if (!s.used){
+					return slots.size();
+				}
+				if (s.hash == hash && s.kv.first == key){
+					return i;
+				}
+			}
+		}
+
+		void place(entry&& kv, uint32_t hash, uint32_t last_seen){
+			size_t i = home(hash);
+			while (slots[i].used){
+				i = (i + 1) & mask();
+			}
+			slots[i].kv = std::move(kv);
+			slots[i].hash = hash;
+			slots[i].last_seen = last_seen;
+			slots[i].used = true;
+		}
+
+		void rehash(unsigned int new_bits){
+			vector<slot> old_slots(size_t(1) << new_bits);
+			old_slots.swap(slots);
+			bits = new_bits;
+			for (slot& s : old_slots){
+				if (s.used){
+					place(std::move(s.kv), s.hash, s.last_seen);
+				}
+			}
+		}
+
+		void erase_slot(size_t i){
+			// Backward shift: moves back the following entries of the cluster, no tombstones are left
+			size_t j = i;
+			for (;;){
+				j = (j + 1) & mask();
+				if (!slots[j].used){
+					break;
+				}
+				size_t h = home(slots[j].hash);
+				// The entry in j can be moved in i only if its home is not in (i, j] (cyclically)
+				if ((j > i && (h <= i || h > j)) || (j < i && (h <= i && h > j))){
+					slots[i].kv = std::move(slots[j].kv);
+					slots[i].hash = slots[j].hash;
+					slots[i].last_seen = slots[j].last_seen;
+					i = j;
+				}
+			}
+			slots[i].kv = entry();
+			slots[i].used = false;
+			n_entries--;
+			if (count_stats){
+				flow_table_stats.tracked.fetch_sub(1, memory_order_relaxed);
+			}
+		}
+
+	public:
+		size_t max_entries;
+		bool count_stats = true;
+
+		class iterator {
+			private:
+				FlowTable* table;
+				size_t pos;
+
+				void skip_empty(){
+					while (pos < table->slots.size() && !table->slots[pos].used){
+						pos++;
+					}
+				}
+
+			public:
+				iterator(FlowTable* table, size_t pos): table(table), pos(pos){
+					skip_empty();
+				}
+				entry& operator*() const { return table->slots[pos].kv; }
+				entry* operator->() const { return &table->slots[pos].kv; }
+				iterator& operator++(){
+					pos++;
+					skip_empty();
+					return *this;
+				}
+				bool operator==(const iterator& other) const { return pos == other.pos; }
+				bool operator!=(const iterator& other) const { return pos != other.pos; }
+				friend class FlowTable;
+		};
+
+		FlowTable(size_t initial_capacity = flow_table_settings.initial_capacity, size_t max_entries = flow_table_settings.max_entries):
+			max_entries(max_entries)
+		{
+			bits = bits_for(initial_capacity);
+			slots.resize(size_t(1) << bits);
+		}
+
+		iterator begin(){ return iterator(this, 0); }
+		iterator end(){ return iterator(this, slots.size()); }
+
+		size_t size() const { return n_entries; }
+		size_t capacity() const { return slots.size(); }
+		bool full() const { return max_entries != 0 && n_entries >= max_entries; }
+
+		iterator find(const K& key){
+			size_t i = lookup(key, hasher(key));
+			if (i != slots.size()){
+				slots[i].last_seen = flow_clock;
+			}
+			return iterator(this, i);
+		}
+
+		// Returns false (without inserting) if the key is new and the table has reached max_entries
+		bool insert_or_assign(const K& key, V value){
+			uint32_t hash = hasher(key);
+			size_t i = lookup(key, hash);
+			if (i != slots.size()){
+				slots[i].kv.second = std::move(value);
+				slots[i].last_seen = flow_clock;
+				return true;
+			}
+			if (full()){
+				return false;
+			}
+			// Max load factor 3/4
+			if ((n_entries + 1) * 4 > slots.size() * 3){
+				rehash(bits + 1);
+			}
+			place(entry{ key, std::move(value) }, hash, flow_clock);
+			n_entries++;
+			if (count_stats){
+				flow_table_stats.tracked.fetch_add(1, memory_order_relaxed);
+			}
+			return true;
+		}
+
+		/*
+		Checks the next max_scan slots (continuing from the previous call) and evicts the entries
+		not seen for idle_timeout seconds, on_evict(entry&) is called before removing each of them.
+		*/
+		template<typename F>
+		size_t evict_idle(uint32_t idle_timeout, size_t max_scan, F&& on_evict){
+			if (idle_timeout == 0 || n_entries == 0){
+				return 0;
+			}
+			size_t evicted = 0;
+			for (size_t scanned = 0; scanned < max_scan; scanned++){
+				if (sweep_pos >= slots.size()){
+					sweep_pos = 0;
+				}
+				slot& s = slots[sweep_pos];
+				if (s.used && flow_clock - s.last_seen >= idle_timeout){
+					on_evict(s.kv);
+					// The backward shift can move the next entry here: the slot is checked again
+					erase_slot(sweep_pos);
+					evicted++;
+				}else{
+					sweep_pos++;
+				}
+			}
+			if (evicted > 0 && count_stats){
+				flow_table_stats.evicted_idle.fetch_add(evicted, memory_order_relaxed);
+			}
+			return evicted;
+		}
+
+		// Evicts the least recently seen entry among the next samples entries (continuing from evict_idle)
+		template<typename F>
+		bool evict_oldest(size_t samples, F&& on_evict){
+			if (n_entries == 0){
+				return false;
+			}
+			size_t oldest = slots.size();
+			size_t pos = sweep_pos;
+			for (size_t sampled = 0; sampled < samples && sampled < n_entries; pos = (pos + 1) & mask()){
+				if (slots[pos].used){
+					if (oldest == slots.size() || flow_clock - slots[pos].last_seen > flow_clock - slots[oldest].last_seen){
+						oldest = pos;
+					}
+					sampled++;
+				}
+			}
+			sweep_pos = pos;
+			on_evict(slots[oldest].kv);
+			erase_slot(oldest);
+			if (count_stats){
+				flow_table_stats.evicted_full.fetch_add(1, memory_order_relaxed);
+			}
+			return true;
+		}
+
+		void erase(iterator it){
+			if (it.pos < slots.size()){
+				erase_slot(it.pos);
+			}
+		}
+
+		void erase(const K& key){
+			erase(find(key));
+		}
+
+		void clear(){
+			for (slot& s : slots){
+				s = slot();
+			}
+			if (count_stats){
+				flow_table_stats.tracked.fetch_sub(n_entries, memory_order_relaxed);
+			}
+			n_entries = 0;
+		}
+};
+
+}}
+#endif // FLOW_TABLE_CPP
@@ -1,6 +1,7 @@
 #include <vector>
 #include <thread>
 #include <type_traits>
+#include <limits>
 #include "../utils.cpp"
 #include "nfqueue.cpp"
 
@@ -20,6 +21,8 @@ public:
     BlockingQueue<PktRequest<Derived>*> queue;
 
     virtual void before_loop() {}
+    // Called when all the queued packets have been handled, before waiting for the next one
+    virtual void on_queue_empty() {}
 	virtual void handle_next_packet(PktRequest<Derived>* pkt){}
     
     void loop() {
@@ -27,6 +30,7 @@ public:
         PktRequest<Derived>* pkt;
         for(;;) {
             queue.take(pkt);
+            update_flow_clock();
             try {
                 static_cast<Derived*>(this)->handle_next_packet(pkt);
             } catch (const std::exception& e) {
@@ -45,6 +49,19 @@ public:
                 }
             }
             delete pkt;
+            count_handled_packet();
+            // Verdicts are sent at the end of a burst, or when the oldest one waited too much
+            bool queue_empty = queue.empty();
+            if (verdict_batch.pending() && (queue_empty || verdict_batch.expired())) {
+                try {
+                    verdict_batch.flush();
+                } catch (const std::exception& e) {
+                    std::cerr << "[error] Exception sending the verdicts: " << e.what() << std::endl;
+                }
+            }
+            if (queue_empty) {
+                static_cast<Derived*>(this)->on_queue_empty();
+            }
         }
     }
 
@@ -64,17 +81,37 @@ void __real_handler(PktRequest<std::vector<Worker>>* pkt) {
 }
 
 
+/*
+Each worker owns an nfqueue of a contiguous range (queue_num() - last_queue_num()), the nftables rule
+spreads the packets over the range ("queue num a-b fanout"), and each queue has its own reader thread.
+The kernel balances by CPU, so the packets of a flow can arrive on any queue: the readers send each packet
+to the worker that owns its flow (hash_stream_id), that keeps the per flow state of the stream.
+*/
 template <typename Worker, typename = is_base_of<ThreadNfQueue<Worker>, Worker>>
 class MultiThreadQueue {
     static_assert(std::is_base_of_v<ThreadNfQueue<Worker>, Worker>,
         "Worker must inherit from ThreadNfQueue<Worker>");
 
 private:
+    typedef NfQueue<std::vector<Worker>, __real_handler<Worker>> queue_type;
     std::vector<Worker> workers;
-    NfQueue<std::vector<Worker>, __real_handler<Worker>> * nfq;
+    std::vector<queue_type*> nfqs;
+    std::vector<std::thread> readers;
     uint16_t queue_num_;
-	
-    
+
+    void clear_queues() {
+        for (auto* nfq : nfqs) {
+            delete nfq;
+        }
+        nfqs.clear();
+    }
+
+    void read_loop(queue_type* nfq) {
+        for (;;){
+            nfq->handle_next_packet(&workers);
+        }
+    }
+
 public:
     const size_t n_threads;
     static constexpr int QUEUE_BASE_NUM = 1000;
@@ -83,34 +120,43 @@ public:
         : n_threads(n_threads), workers(n_threads) 
     {
         if(n_threads == 0) throw std::invalid_argument("At least 1 thread required");
-        
-        for(uint16_t qnum = QUEUE_BASE_NUM; ; qnum++) {
+        if(n_threads > std::numeric_limits<uint16_t>::max() - QUEUE_BASE_NUM) throw std::invalid_argument("Too many threads");
+
+        // Looking for n_threads free consecutive queues
+        for(uint32_t qnum = QUEUE_BASE_NUM; qnum + n_threads - 1 <= std::numeric_limits<uint16_t>::max(); ) {
             try {
-                nfq = new NfQueue<std::vector<Worker>, __real_handler<Worker>>(qnum);
+                while (nfqs.size() < n_threads) {
+                    nfqs.push_back(new queue_type(qnum + nfqs.size()));
+                }
                 queue_num_ = qnum;
-                break;
+                return;
             }
             catch(const std::invalid_argument&) {
-                if(qnum == std::numeric_limits<uint16_t>::max())
-                    throw std::runtime_error("No available queue numbers");
+                // The queue qnum + nfqs.size() is busy: the range restarts after it
+                qnum += nfqs.size() + 1;
+                clear_queues();
             }
         }
+        throw std::runtime_error("No available queue numbers");
     }
 
     ~MultiThreadQueue() {
-        delete nfq;
+        clear_queues();
     }
 
     void start() {
+        run_alloc_stats_reporter();
         for(auto& worker : workers) {
             worker.run_thread_loop();
         }
-		for (;;){
-        	nfq->handle_next_packet(&workers);
-		}
+        for(size_t i = 1; i < nfqs.size(); i++) {
+            readers.emplace_back([this, i]() { this->read_loop(nfqs[i]); });
+        }
+        read_loop(nfqs[0]);
     }
 
     uint16_t queue_num() const { return queue_num_; }
+    uint16_t last_queue_num() const { return queue_num_ + nfqs.size() - 1; }
 };
 
 }} // namespace Firegex::NfQueue
@@ -3,11 +3,20 @@
 #define NFQUEUE_CLASS_CPP
 
 #include <libnetfilter_queue/libnetfilter_queue.h>
+#include <linux/netfilter.h>
 #include <linux/netfilter/nfnetlink_queue.h>
 #include <tins/tcp_ip/stream_identifier.h>
 #include <libmnl/libmnl.h>
 #include <tins/tins.h>
 #include <map>
+#include <string_view>
+#include <netinet/in.h>
+#include <cstring>
+#include <vector>
+#include <sys/socket.h>
+#include "flow_table.cpp"
+#include "alloc_stats.cpp"
+#include "nfqueue_batch.cpp"
 
 using namespace std;
 
@@ -18,6 +27,32 @@ enum class FilterAction{ DROP, ACCEPT, MANGLE, NOACTION };
 enum class L4Proto { TCP, UDP, RAW };
 typedef Tins::TCPIP::StreamIdentifier stream_id;
 
+uint32_t hash_stream_id(const stream_id &sid) {
+    uint32_t addr_hash = 0;
+    const uint32_t* min_addr = reinterpret_cast<const uint32_t*>(sid.min_address.data());
+    const uint32_t* max_addr = reinterpret_cast<const uint32_t*>(sid.max_address.data());
+    addr_hash ^= min_addr[0] ^ min_addr[1] ^ min_addr[2] ^ min_addr[3];
+    addr_hash ^= max_addr[0] ^ max_addr[1] ^ max_addr[2] ^ max_addr[3];
+
+    uint32_t ports = (static_cast<uint32_t>(sid.min_address_port) << 16) | sid.max_address_port;
+    
+    uint32_t hash = addr_hash ^ ports;
+    
+    hash *= 0x9e3779b9;
+    
+    return hash;
+}
+
+struct stream_id_hash {
+	inline uint32_t operator()(const stream_id &sid) const {
+		return hash_stream_id(sid);
+	}
+};
+
+// Per flow state of a worker, indexed with the same hash used to assign the flows to the workers
+template<typename V>
+using stream_table = FlowTable<stream_id, V, stream_id_hash>;
+
 struct tcp_ack_seq_ctx{
 	int64_t in = 0;
 	int64_t out = 0;
@@ -28,7 +63,13 @@ struct tcp_ack_seq_ctx{
 	}
 };
 
-typedef map<stream_id, tcp_ack_seq_ctx*> tcp_ack_map;
+// Not limited by FIREGEX_FLOW_TABLE_MAX nor idle-evicted: losing the offsets would break the mangled connections,
+// the entries are removed with the stream they belong to (also when the stream follower drops it for inactivity)
+struct tcp_ack_map : public stream_table<tcp_ack_seq_ctx*> {
+	tcp_ack_map(): stream_table<tcp_ack_seq_ctx*>(flow_table_settings.initial_capacity, 0){
+		count_stats = false;
+	}
+};
 
 template<typename T>
 class PktRequest {
@@ -41,8 +82,10 @@ class PktRequest {
 	size_t _data_original_size;
 	size_t _header_size;
 	bool need_tcp_fixing = false;
+	bool parsed = false;
 	public:
 	bool is_ipv6;
+	// libtins PDU tree, built by parse() only when needed (stream reassembly, mangling, reject)
 	Tins::IP* ipv4 = nullptr;
 	Tins::IPv6* ipv6 = nullptr;
 	Tins::TCP* tcp = nullptr;
@@ -110,7 +153,79 @@ class PktRequest {
 	}
 
 	bool need_tcp_fix(){
-		return tcp && ack_seq_offset != nullptr && (ack_seq_offset->in != 0 || ack_seq_offset->out != 0);
+		return l4_proto == L4Proto::TCP && ack_seq_offset != nullptr && (ack_seq_offset->in != 0 || ack_seq_offset->out != 0);
+	}
+
+	static inline uint16_t read_be16(const uint8_t* ptr){
+		return (uint16_t(ptr[0]) << 8) | ptr[1];
+	}
+
+	/*
+	Reads the IP and TCP/UDP headers of the common packets (no fragments or IPv6 extension headers)
+	without building the libtins PDU tree. Returns false if libtins is needed to parse the packet.
+	*/
+	bool fast_parse_headers(){
+		const uint8_t* raw = (const uint8_t*)packet.data();
+		size_t len = packet.size();
+		size_t l4_offset;
+		uint8_t next_header;
+		if (is_ipv6){
+			if (len < 40 || 40 + size_t(read_be16(raw + 4)) != len){
+				return false;
+			}
+			next_header = raw[6];
+			l4_offset = 40;
+		}else{
+			if (len < 20){
+				return false;
+			}
+			l4_offset = (raw[0] & 0x0f) * 4;
+			// Fragments (MF flag or offset) are left to libtins
+			if (l4_offset < 20 || l4_offset > len || read_be16(raw + 2) != len || (read_be16(raw + 6) & 0x3fff) != 0){
+				return false;
+			}
+			next_header = raw[9];
+		}
+		size_t l4_header_size;
+		if (next_header == IPPROTO_TCP){
+			if (len < l4_offset + 20){
+				return false;
+			}
+			l4_header_size = (raw[l4_offset + 12] >> 4) * 4;
+			if (l4_header_size < 20 || l4_offset + l4_header_size > len){
+				return false;
+			}
+			l4_proto = L4Proto::TCP;
+		}else if (next_header == IPPROTO_UDP){
+			if (len < l4_offset + 8){
+				return false;
+			}
+			l4_header_size = 8;
+			l4_proto = L4Proto::UDP;
+		}else{
+			return false;
+		}
+		uint16_t sport = read_be16(raw + l4_offset);
+		uint16_t dport = read_be16(raw + l4_offset + 2);
+		// Same addresses serialization of stream_id::make_identifier
+		if (is_ipv6){
+			sid = stream_id(
+				stream_id::serialize(Tins::IPv6Address(raw + 8)), sport,
+				stream_id::serialize(Tins::IPv6Address(raw + 24)), dport
+			);
+		}else{
+			uint32_t saddr, daddr;
+			memcpy(&saddr, raw + 12, sizeof(saddr));
+			memcpy(&daddr, raw + 16, sizeof(daddr));
+			sid = stream_id(
+				stream_id::serialize(Tins::IPv4Address(saddr)), sport,
+				stream_id::serialize(Tins::IPv4Address(daddr)), dport
+			);
+		}
+		_original_size = len;
+		_header_size = l4_offset + l4_header_size;
+		_data_original_size = len - _header_size;
+		return true;
 	}
 
 	public:
@@ -122,13 +237,28 @@ class PktRequest {
 		action(FilterAction::NOACTION),
 		is_ipv6((payload[0] & 0xf0) == 0x60)
 	{
+		// The constructor runs in the netlink thread: the PDU tree is built later by the worker, if needed
+		if (!fast_parse_headers()){
+			parse();
+			if (is_ipv6){
+				sid = stream_id::make_identifier(*ipv6);
+			}else{
+				sid = stream_id::make_identifier(*ipv4);
+			}
+		}
+	}
+
+	// Builds the libtins PDU tree of the packet
+	void parse(){
+		if (parsed){
+			return;
+		}
+		parsed = true;
 		if (is_ipv6){
-			ipv6 = new Tins::IPv6((uint8_t*)packet.c_str(), plen);
-			sid = stream_id::make_identifier(*ipv6);
+			ipv6 = new Tins::IPv6((uint8_t*)packet.c_str(), packet.size());
 			_original_size = ipv6->size();
 		}else{
-			ipv4 = new Tins::IP((uint8_t*)packet.c_str(), plen);
-			sid = stream_id::make_identifier(*ipv4);
+			ipv4 = new Tins::IP((uint8_t*)packet.c_str(), packet.size());
 			_original_size = ipv4->size();
 		}
 		l4_proto = fill_l4_info();
@@ -140,6 +270,15 @@ class PktRequest {
 		#endif
 	}
 
+	// IP PDU for the libtins stream follower
+	Tins::PDU& ip_pdu(){
+		parse();
+		if (is_ipv6){
+			return *ipv6;
+		}
+		return *ipv4;
+	}
+
 	inline size_t header_size(){
 		return _header_size;
 	}
@@ -152,17 +291,25 @@ class PktRequest {
 		return packet.size()-_header_size;
 	}
 
+	string_view data_view(){
+		return string_view(data(), data_size());
+	}
+
 	size_t data_original_size(){
 		return _data_original_size;
 	}
 
 	void reserialize(){
+		if (!parsed){
+			return; // Not modified: the packet is still the original one
+		}
 		auto data = serialize();
 		packet.resize(data.size());
 		memcpy(packet.data(), data.data(), data.size());
 	}
 
 	void set_data(const char* data, const size_t& data_size){
+		parse();
 		auto bef_raw = before_raw_pdu_ptr();
 		if (bef_raw){
 			delete before_raw_pdu_ptr()->release_inner_pdu();
@@ -184,6 +331,7 @@ class PktRequest {
 	}
 
 	void set_packet(const char* data, size_t data_size){
+		parse();
 		// Parsing only the header with libtins
 		Tins::PDU *data_pdu = nullptr;
 		size_t total_size;
@@ -231,6 +379,7 @@ class PktRequest {
 		if(!need_tcp_fixing){
 			return;
 		}
+		parse();
 		#ifdef DEBUG
 		cerr << "[DEBUG] Fixing ack_seq with offsets " << ((int32_t)ack_seq_offset->in) << " " << ((int32_t)ack_seq_offset->out) << endl;
 		#endif
@@ -292,7 +441,7 @@ class PktRequest {
 	}
 
 	void reject(){
-		if (tcp){
+		if (l4_proto == L4Proto::TCP){
 			//If the packet has data, we have to remove it
 			set_data(nullptr, 0);
 			//For the first matched data or only for data packets, we set RST bit
@@ -336,6 +485,7 @@ class PktRequest {
 	}
 
 	Tins::PDU::serialization_type serialize(){
+		parse();
 		if (is_ipv6){
 			return ipv6->serialize();
 		}else{
@@ -345,16 +495,20 @@ class PktRequest {
 
 	private:
 	void perform_action(bool do_serialize = true){
-		char buf[MNL_SOCKET_BUFFER_SIZE+packet.size()];
+		bool with_packet = action == FilterAction::MANGLE || (action == FilterAction::ACCEPT && need_tcp_fixing);
+		if (with_packet && do_serialize){
+			if (action == FilterAction::ACCEPT){
+				fix_data_payload();
+			}
+			reserialize();
+		}
+		// The verdict is added to the batch of the worker, sent by the worker loop (see classes/nfqueue_batch.cpp)
+		char* buf = verdict_batch.reserve(nl, MNL_SOCKET_BUFFER_SIZE + (with_packet ? packet.size() : 0));
 		struct nlmsghdr *nlh_verdict = nfq_nlmsg_put(buf, NFQNL_MSG_VERDICT, ntohs(res_id));
 		switch (action)
 		{
 			case FilterAction::ACCEPT:
 				if (need_tcp_fixing){
-					if (do_serialize){
-						fix_data_payload();
-						reserialize();
-					}
 					nfq_nlmsg_verdict_put_pkt(nlh_verdict, packet.data(), packet.size());
 				}
 				nfq_nlmsg_verdict_put(nlh_verdict, ntohl(packet_id), NF_ACCEPT );
@@ -363,10 +517,6 @@ class PktRequest {
 				nfq_nlmsg_verdict_put(nlh_verdict, ntohl(packet_id), NF_DROP );
 				break;
 			case FilterAction::MANGLE:{
-				//If not custom data, use the data in the packets
-				if(do_serialize){
-					reserialize();
-				}
 				nfq_nlmsg_verdict_put_pkt(nlh_verdict, packet.data(), packet.size());
 				#ifdef PKTDEBUG
 				if (tcp){
@@ -388,9 +538,7 @@ class PktRequest {
 			default:
 				throw invalid_argument("Invalid action");
 		}
-		if (mnl_socket_sendto(nl, nlh_verdict, nlh_verdict->nlmsg_len) < 0) {
-			throw runtime_error( "mnl_socket_send" );
-		}
+		verdict_batch.commit(nlh_verdict);
 	}
 
 };
@@ -412,9 +560,25 @@ class NfQueue {
     public:
 	char* queue_msg_buffer = nullptr;
 	const uint16_t queue_num;
-
-	NfQueue(u_int16_t queue_num): queue_num(queue_num) {
-		queue_msg_buffer = new char[NFQUEUE_BUFFER_SIZE];
+	// One buffer of NFQUEUE_BUFFER_SIZE for each message received by recvmmsg (queue_msg_buffer is the first one)
+	const unsigned int recv_batch;
+	vector<mmsghdr> recv_msgs;
+	vector<iovec> recv_iovs;
+	vector<sockaddr_nl> recv_addrs;
+
+	NfQueue(u_int16_t queue_num): queue_num(queue_num), recv_batch(nfqueue_batch_settings.recv_batch) {
+		queue_msg_buffer = new char[NFQUEUE_BUFFER_SIZE * recv_batch];
+		recv_msgs.resize(recv_batch);
+		recv_iovs.resize(recv_batch);
+		recv_addrs.resize(recv_batch);
+		for (unsigned int i = 0; i < recv_batch; i++){
+			recv_iovs[i] = { iov_base: queue_msg_buffer + i * NFQUEUE_BUFFER_SIZE, iov_len: NFQUEUE_BUFFER_SIZE };
+			recv_msgs[i].msg_hdr = {};
+			recv_msgs[i].msg_hdr.msg_name = &recv_addrs[i];
+			recv_msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_nl);
+			recv_msgs[i].msg_hdr.msg_iov = &recv_iovs[i];
+			recv_msgs[i].msg_hdr.msg_iovlen = 1;
+		}
 		nl = mnl_socket_open(NETLINK_NETFILTER);
 		
 		if (nl == nullptr) { throw runtime_error( "mnl_socket_open" );}
@@ -487,20 +651,34 @@ class NfQueue {
 
 	}
 
+	// Handles all the packets available (up to FIREGEX_NFQUEUE_RECV_BATCH), waiting for at least one
 	void handle_next_packet(D* data){
-		int ret = _recv_packet();
-		if (ret == -1) {
-			throw runtime_error( "mnl_socket_recvfrom" );
-		}
 		internal_nfqueue_execution_data_tmp raw_ptr = {
 			nl: nl,
 			data: data
 		};
-
-		ret = mnl_cb_run(queue_msg_buffer, ret, 0, portid, _real_queue_cb, &raw_ptr);
-		if (ret <= 0){
-			cerr << "[error] [NfQueue.handle_next_packet] mnl_cb_run error with: " << ret << endl;
-			throw runtime_error( "mnl_cb_run error!" );
+		if (recv_batch == 1){
+			int ret = _recv_packet();
+			if (ret == -1) {
+				throw runtime_error( "mnl_socket_recvfrom" );
+			}
+			_run_callbacks(queue_msg_buffer, ret, &raw_ptr);
+			return;
+		}
+		int n_msgs = _recv_packets();
+		if (n_msgs == -1) {
+			throw runtime_error( "mnl_socket_recvfrom" );
+		}
+		for (int i = 0; i < n_msgs; i++){
+			mmsghdr& msg = recv_msgs[i];
+			// Same checks of mnl_socket_recvfrom: truncated messages and messages not sent by the kernel
+			if (msg.msg_hdr.msg_flags & MSG_TRUNC){
+				throw runtime_error( "mnl_socket_recvfrom" );
+			}
+			if (recv_addrs[i].nl_pid != 0){
+				continue;
+			}
+			_run_callbacks(queue_msg_buffer + i * NFQUEUE_BUFFER_SIZE, msg.msg_len, &raw_ptr);
 		}
 	}
 	
@@ -571,27 +749,27 @@ class NfQueue {
 
 	inline ssize_t _recv_packet(){
 		return mnl_socket_recvfrom(nl, queue_msg_buffer, NFQUEUE_BUFFER_SIZE);
-	}	
-
-};
+	}
 
+	inline int _recv_packets(){
+		for (unsigned int i = 0; i < recv_batch; i++){
+			recv_msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_nl);
+			recv_msgs[i].msg_hdr.msg_flags = 0;
+		}
+		// Blocks until the first message, then takes only the ones already queued
+		return recvmmsg(mnl_socket_get_fd(nl), recv_msgs.data(), recv_batch, MSG_WAITFORONE, nullptr);
+	}
 
+	inline void _run_callbacks(char* buffer, size_t len, internal_nfqueue_execution_data_tmp* raw_ptr){
+		int ret = mnl_cb_run(buffer, len, 0, portid, _real_queue_cb, raw_ptr);
+		if (ret <= 0){
+			cerr << "[error] [NfQueue.handle_next_packet] mnl_cb_run error with: " << ret << endl;
+			throw runtime_error( "mnl_cb_run error!" );
+		}
+	}
 
-uint32_t hash_stream_id(const stream_id &sid) {
-    uint32_t addr_hash = 0;
-    const uint32_t* min_addr = reinterpret_cast<const uint32_t*>(sid.min_address.data());
-    const uint32_t* max_addr = reinterpret_cast<const uint32_t*>(sid.max_address.data());
-    addr_hash ^= min_addr[0] ^ min_addr[1] ^ min_addr[2] ^ min_addr[3];
-    addr_hash ^= max_addr[0] ^ max_addr[1] ^ max_addr[2] ^ max_addr[3];
+};
 
-    uint32_t ports = (static_cast<uint32_t>(sid.min_address_port) << 16) | sid.max_address_port;
-    
-    uint32_t hash = addr_hash ^ ports;
-    
-    hash *= 0x9e3779b9;
-    
-    return hash;
-}
 
 }}
 #endif // NFQUEUE_CLASS_CPP
@@ -0,0 +1,150 @@
+#ifndef NFQUEUE_BATCH_CPP
+#define NFQUEUE_BATCH_CPP
+
+#include <libmnl/libmnl.h>
+#include <linux/netlink.h>
+#include <vector>
+#include <chrono>
+#include <cstdlib>
+#include <stdexcept>
+
+using namespace std;
+
+namespace Firegex {
+namespace NfQueue {
+
+/*
+Batching of the netlink messages exchanged with nfqueue (read from the environment in main):
+FIREGEX_NFQUEUE_RECV_BATCH - max packets received with a single recvmmsg by the queue reader (default 16, 1 disables it)
+FIREGEX_NFQUEUE_VERDICT_BATCH - max verdicts sent together by a worker in a single netlink message (default 32, 1 disables it)
+FIREGEX_NFQUEUE_VERDICT_FLUSH_US - max microseconds a verdict waits in the batch while the worker has other packets
+	to handle (default 200). The batch is always sent when the worker has no more packets queued.
+*/
+struct nfqueue_batch_config {
+	unsigned int recv_batch = 16;
+	unsigned int verdict_batch = 32;
+	unsigned int verdict_flush_us = 200;
+};
+
+nfqueue_batch_config nfqueue_batch_settings;
+
+void load_nfqueue_batch_settings(){
+	char * recv_batch = getenv("FIREGEX_NFQUEUE_RECV_BATCH");
+	if (recv_batch != nullptr && ::atoi(recv_batch) > 0) nfqueue_batch_settings.recv_batch = ::atoi(recv_batch);
+	char * verdict_batch = getenv("FIREGEX_NFQUEUE_VERDICT_BATCH");
+	if (verdict_batch != nullptr && ::atoi(verdict_batch) > 0) nfqueue_batch_settings.verdict_batch = ::atoi(verdict_batch);
+	char * verdict_flush_us = getenv("FIREGEX_NFQUEUE_VERDICT_FLUSH_US");
+	if (verdict_flush_us != nullptr && ::atoi(verdict_flush_us) >= 0) nfqueue_batch_settings.verdict_flush_us = ::atoi(verdict_flush_us);
+}
+
+// Verdicts are sent early if the batch gets bigger than this (the kernel limits a netlink message to the socket sndbuf)
+constexpr size_t VERDICT_BATCH_MAX_BYTES = 0xffff;
+
+/*
+Verdicts of a worker, written one after the other in the same buffer and sent with a single sendto:
+the kernel handles all the nlmsgs of the message.
+A verdict has to be sent with the socket bound to the queue of its packet, so there is a buffer for each
+socket the worker received packets from (one for each queue of the MultiThreadQueue).
+The verdict is built in the space returned by reserve and added with commit.
+*/
+class VerdictBatch {
+	private:
+		struct socket_batch {
+			mnl_socket* nl = nullptr;
+			vector<char> buffer;
+			size_t used = 0;
+			unsigned int count = 0;
+			chrono::steady_clock::time_point first_verdict;
+
+			void send(){
+				size_t len = used;
+				used = 0;
+				count = 0;
+				if (mnl_socket_sendto(nl, buffer.data(), len) < 0) {
+					throw runtime_error( "mnl_socket_send" );
+				}
+			}
+		};
+
+		vector<socket_batch> batches;
+		socket_batch* current = nullptr;
+		unsigned int count = 0;
+
+		socket_batch& batch_for(mnl_socket* socket){
+			for (auto& batch : batches){
+				if (batch.nl == socket){
+					return batch;
+				}
+			}
+			batches.emplace_back();
+			batches.back().nl = socket;
+			return batches.back();
+		}
+
+	public:
+		char* reserve(mnl_socket* socket, size_t size){
+			current = &batch_for(socket);
+			if (current->count > 0 && current->used + size > VERDICT_BATCH_MAX_BYTES){
+				count -= current->count;
+				current->send();
+			}
+			if (current->buffer.size() < current->used + size){
+				current->buffer.resize(current->used + size);
+			}
+			return current->buffer.data() + current->used;
+		}
+
+		void commit(nlmsghdr* nlh){
+			if (current->count == 0){
+				current->first_verdict = chrono::steady_clock::now();
+			}
+			current->used += NLMSG_ALIGN(nlh->nlmsg_len);
+			current->count++;
+			count++;
+			if (count >= nfqueue_batch_settings.verdict_batch){
+				flush();
+			}
+		}
+
+		bool pending() const {
+			return count > 0;
+		}
+
+		bool expired() const {
+			if (count == 0){
+				return false;
+			}
+			auto now = chrono::steady_clock::now();
+			for (auto& batch : batches){
+				if (batch.count > 0 && now - batch.first_verdict >= chrono::microseconds(nfqueue_batch_settings.verdict_flush_us)){
+					return true;
+				}
+			}
+			return false;
+		}
+
+		void flush(){
+			if (count == 0){
+				return;
+			}
+			count = 0;
+			bool failed = false;
+			for (auto& batch : batches){
+				if (batch.count > 0){
+					try {
+						batch.send();
+					} catch (const runtime_error&) {
+						failed = true;
+					}
+				}
+			}
+			if (failed){
+				throw runtime_error( "mnl_socket_send" );
+			}
+		}
+};
+
+thread_local VerdictBatch verdict_batch;
+
+}}
+#endif // NFQUEUE_BATCH_CPP
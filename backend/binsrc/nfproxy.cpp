@@ -45,36 +45,45 @@ firegex.nfproxy.internals.compile(globals(), locals()) # This function can save
 This code will be executed only once, and is needed to build the global and local context to use
 The globals and locals generated here are copied for each connection, and are used to handle the packets
 
-Using C API will be injected in global context the following informations:
-
-__firegex_packet_info = {
-	"data" = b"raw data found on L4",
-	"raw_packet" = b"raw packet",
-	"is_input" = True, # If the packet is incoming from a client
-	"is_ipv6" = False, # If the packet is ipv6
-	"is_tcp" = True, # If the packet is tcp
-}
+Every time a packet is received, the packet handler calls (once resolved for each worker, using the C API):
+```python
+firegex.nfproxy.internals.handle_packet_fast(
+	globals(), # The globals of the stream
+	data, # b"raw data found on L4"
+	raw_packet, # b"raw packet", None if no enabled filter uses RawPacket (firegex.nfproxy.internals.need_raw_packet)
+	is_input, # True if the packet is incoming from a client
+	is_ipv6, # True if the packet is ipv6
+	is_tcp, # True if the packet is tcp
+	l4_size # The size of the L4 payload of the packet
+)
+```
 
-As result the packet handler is responsible to return a dictionary in the global context with the following dictionary:
-__firegex_pyfilter_result = {
-	"action": REJECT, # One of PyFilterResponse
-	"matched_by": "invalid_curl_agent", # The function that matched the packet (used if action = DROP or REJECT or MANGLE)
-	"mangled_packet": b"new packet" # The new packet to send to the kernel (used if action = MANGLE)
-}
+As result the packet handler returns the tuple (action, matched_by, mangled_packet):
+- action: one of PyFilterResponse, e.g. REJECT
+- matched_by: the function that matched the packet, e.g. "invalid_curl_agent" (used if action = DROP or REJECT or MANGLE)
+- mangled_packet: the new packet to send to the kernel, e.g. b"new packet" (used if action = MANGLE)
 
 PyFilterResponse {
 	ACCEPT = 0,
 	DROP = 1,
 	REJECT = 2,
 	MANGLE = 3,
-	EXCEPTION = 4,
-	INVALID = 5
+	ACCEPT_FLOW = 4,
+	ACCEPT_DIRECTION = 5,
+	EXCEPTION = 6,
+	INVALID = 7
 };
 
-Every time a packet is received, the packet handler will execute the following code:
-```python
-firegex.nfproxy.internals.handle_packet(globals())
-````
+ACCEPT_DIRECTION is returned when no filter is left on the direction of the packet (the filters returned
+ACCEPT_DIRECTION or ACCEPT_FLOW, or no filter handles that direction), ACCEPT_FLOW when none is left on the stream:
+libtins stops following the data of the direction (ignore_client_data/ignore_server_data) and python is no longer called for it,
+with ACCEPT_FLOW the filter context of the stream is dropped too.
+
+If every enabled filter declares a prefilter (@pyfilter(prefilter=[b"literal", ...])) and none uses RawPacket,
+firegex.nfproxy.internals.prefilter_literals gives the literals, compiled in a hyperscan stream database:
+the packets of a stream are accepted without calling python until a literal is found in one of its directions,
+then the data accepted so far is sent to handle_packet_fast (in order) before the current packet, and the stream is no longer prefiltered.
+The data kept waiting for a match is limited by FIREGEX_NFPROXY_PREFILTER_BUFFER (default 16KB): beyond it the stream is handled by python.
 
 The TCP stream is sorted by libtins using c++ code, but the c++ code is not responsabile di buffer the stream, but only to sort those
 So firegex handle_packet has to implement a way to limit memory usage, this dipends on what methods you choose to use to filter packets
@@ -117,20 +126,31 @@ int main(int argc, char *argv[]) {
 	// Initialize the python interpreter
 	Py_Initialize();
 	atexit(Py_Finalize);
-	init_handle_packet_code(); //Compile the static code used to handle packets
 
 	int n_of_threads = 1;
    	char * n_threads_str = getenv("NTHREADS");
    	if (n_threads_str != nullptr) n_of_threads = ::atoi(n_threads_str);
 	if(n_of_threads <= 0) n_of_threads = 1;
 
+	Firegex::NfQueue::flow_table_settings.max_entries = 65536; // Each flow has its own python context
+	Firegex::NfQueue::load_flow_table_settings();
+	Firegex::NfQueue::load_nfqueue_batch_settings();
+	load_gc_settings();
+	load_prefilter_settings();
+
 	config.reset(new PyCodeConfig());
 
 	MultiThreadQueue<PyProxyQueue> queue(n_of_threads);
 
-	control_socket << "QUEUE " << queue.queue_num() << endl;
+	control_socket << "QUEUE " << queue.queue_num() << " " << queue.last_queue_num() << endl;
 
-	cerr << "[info] [main] Queue: " << queue.queue_num() << " threads assigned: " << n_of_threads << endl;
+	cerr << "[info] [main] Queues: " << queue.queue_num() << "-" << queue.last_queue_num() << " threads assigned: " << n_of_threads << endl;
+	Firegex::NfQueue::run_flow_stats_reporter([](const string& report){
+		control_socket.send(report);
+	});
+	run_gc_stats_reporter(Firegex::NfQueue::flow_table_settings.stats_interval, [](const string& report){
+		control_socket.send(report);
+	});
 
 	thread qthr([&](){
 		queue.start();
@@ -1,5 +1,6 @@
 #include "regex/regex_rules.cpp"
 #include "regex/regexfilter.cpp"
+#include "regex/stats.cpp"
 #include "classes/netfilter.cpp"
 #include <syncstream>
 #include <iostream>
@@ -11,6 +12,20 @@ using Firegex::NfQueue::MultiThreadQueue;
 /*
 Compile options:
 USE_PIPES_FOR_BLOKING_QUEUE - use pipes instead of conditional variable, queue and mutex for blocking queue
+USE_RING_FOR_BLOCKING_QUEUE - use lock free ring buffers with spin-then-futex waiting for blocking queue (see utils.cpp)
+FIREGEX_ALLOC_STATS - count the heap allocations and report them per handled packet (see classes/alloc_stats.cpp)
+
+Environment:
+FIREGEX_STATS_PROTOCOL - "binary" to report blocked packets with the binary protocol (see regex/stats.cpp), text lines otherwise
+FIREGEX_STATS_FLUSH_MS - time slice used to aggregate blocked packets in binary mode (default 100ms)
+FIREGEX_HS_CACHE_DIR - directory where compiled hyperscan databases are cached (see regex/db_cache.cpp), disabled if not set
+FIREGEX_HS_CACHE_MAX_ENTRIES - max number of cached databases (default 64)
+FIREGEX_RELOAD_STREAMS - "reset" to restart the matching of the open streams on config updates, otherwise
+	they keep the config they were opened with (see pin_stream_generations in regex/regexfilter.cpp)
+FIREGEX_FLOW_TABLE_CAPACITY, FIREGEX_FLOW_TABLE_MAX, FIREGEX_FLOW_IDLE_TIMEOUT, FIREGEX_FLOW_STATS_INTERVAL - per worker
+	stream tables and their eviction, reported with "FLOWS" lines (see classes/flow_table.cpp, max 1048576 streams by default)
+FIREGEX_NFQUEUE_RECV_BATCH, FIREGEX_NFQUEUE_VERDICT_BATCH, FIREGEX_NFQUEUE_VERDICT_FLUSH_US - packets received with a
+	single syscall and verdicts sent together by each worker (see classes/nfqueue_batch.cpp)
 */
 
 
@@ -38,9 +53,12 @@ void config_updater (){
 			}
 		}
 		try{
-			regex_config.reset(new RegexRules(raw_rules, regex_config->stream_mode()));
-			cerr << "[info] [updater] Config update done to ver "<< regex_config->ver() << endl;
-			osyncstream(cout) << "ACK OK" << endl;
+			shared_ptr<RegexRules> new_config = make_shared<RegexRules>(raw_rules, regex_config.load()->stream_mode());
+			// The ACK (with the version) is sent before publishing the config: the backend always knows
+			// a version before receiving its blocked events
+			osyncstream(cout) << "ACK OK " << new_config->ver() << endl;
+			regex_config.store(new_config);
+			cerr << "[info] [updater] Config update done to ver "<< new_config->ver() << endl;
 		}catch(const std::exception& e){
 			cerr << "[error] [updater] Failed to build new configuration!" << endl;
 			osyncstream(cout) << "ACK FAIL " << e.what() << endl;
@@ -78,11 +96,32 @@ int main(int argc, char *argv[]){
 	
 	bool fail_open = strcmp(getenv("FIREGEX_NFQUEUE_FAIL_OPEN"), "1") == 0;
 
-	regex_config.reset(new RegexRules(stream_mode));
+	char * stats_protocol = getenv("FIREGEX_STATS_PROTOCOL");
+	blocked_stats.binary_mode = stats_protocol != nullptr && strcmp(stats_protocol, "binary") == 0;
+	char * stats_flush_ms = getenv("FIREGEX_STATS_FLUSH_MS");
+	if (stats_flush_ms != nullptr && ::atoi(stats_flush_ms) > 0) blocked_stats.flush_interval_ms = ::atoi(stats_flush_ms);
+
+	char * hs_cache_dir = getenv("FIREGEX_HS_CACHE_DIR");
+	if (hs_cache_dir != nullptr) hs_db_cache.cache_dir = hs_cache_dir;
+	char * hs_cache_max = getenv("FIREGEX_HS_CACHE_MAX_ENTRIES");
+	if (hs_cache_max != nullptr && ::atoi(hs_cache_max) > 0) hs_db_cache.max_entries = ::atoi(hs_cache_max);
+
+	Firegex::NfQueue::flow_table_settings.max_entries = 1048576;
+	Firegex::NfQueue::load_flow_table_settings();
+	Firegex::NfQueue::load_nfqueue_batch_settings();
+
+	char * reload_streams = getenv("FIREGEX_RELOAD_STREAMS");
+	pin_stream_generations = reload_streams == nullptr || strcmp(reload_streams, "reset") != 0;
+
+	regex_config.store(make_shared<RegexRules>(stream_mode));
 
 	MultiThreadQueue<RegexNfQueue> queue_manager(n_of_threads);
-	osyncstream(cout) << "QUEUE " << queue_manager.queue_num() << endl;
-	cerr << "[info] [main] Queue: " << queue_manager.queue_num() << " threads assigned: " << n_of_threads << " stream mode: " << stream_mode << " fail open: " << fail_open << endl;
+	osyncstream(cout) << "QUEUE " << queue_manager.queue_num() << " " << queue_manager.last_queue_num() << endl;
+	cerr << "[info] [main] Queues: " << queue_manager.queue_num() << "-" << queue_manager.last_queue_num() << " threads assigned: " << n_of_threads << " stream mode: " << stream_mode << " fail open: " << fail_open << " binary stats: " << blocked_stats.binary_mode << " pin streams: " << pin_stream_generations << endl;
+	blocked_stats.run_flusher();
+	Firegex::NfQueue::run_flow_stats_reporter([](const string& report){
+		osyncstream(cout) << report << flush;
+	});
 
 	thread qthr([&](){
 		queue_manager.start();
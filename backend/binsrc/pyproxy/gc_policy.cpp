@@ -0,0 +1,196 @@
+#ifndef PROXY_GC_POLICY_CPP
+#define PROXY_GC_POLICY_CPP
+
+#include <Python.h>
+#include <atomic>
+#include <chrono>
+#include <string>
+#include <thread>
+#include <cstdlib>
+#include <cstdio>
+#include <iostream>
+
+using namespace std;
+
+namespace Firegex {
+namespace PyProxy {
+
+/*
+Garbage collection policy of the filter interpreters (read from the environment in main):
+FIREGEX_PY_GC_THRESHOLDS - thresholds of the generational collector, as gc.set_threshold (e.g. "700,10,10"),
+	the python default if not set
+FIREGEX_PY_GC_EVERY_PACKETS - full collection every N packets handled by a worker (default 0, disabled)
+FIREGEX_PY_GC_EVERY_MS - full collection every T milliseconds, checked when a packet is handled (default 0, disabled)
+FIREGEX_PY_GC_IDLE_MS - full collection when the worker has no packets queued, at most once every T milliseconds
+	and only if packets were handled since the last one (default 1000, 0 disables it)
+All the collections (also the automatic generational ones) are counted and reported with
+"GC <collections> <pause us> <max pause us> <collected objects>" lines, every FIREGEX_FLOW_STATS_INTERVAL seconds.
+*/
+struct gc_policy_config {
+	int thresholds[3] = {-1, -1, -1};
+	unsigned int every_packets = 0;
+	unsigned int every_ms = 0;
+	unsigned int idle_ms = 1000;
+};
+
+gc_policy_config gc_settings;
+
+void load_gc_settings(){
+	char * thresholds = getenv("FIREGEX_PY_GC_THRESHOLDS");
+	if (thresholds != nullptr){
+		int t0 = -1, t1 = -1, t2 = -1;
+		if (sscanf(thresholds, "%d,%d,%d", &t0, &t1, &t2) >= 1){
+			gc_settings.thresholds[0] = t0;
+			gc_settings.thresholds[1] = t1;
+			gc_settings.thresholds[2] = t2;
+		}else{
+			cerr << "[warning] [load_gc_settings] Invalid FIREGEX_PY_GC_THRESHOLDS: " << thresholds << endl;
+		}
+	}
+	char * every_packets = getenv("FIREGEX_PY_GC_EVERY_PACKETS");
+	if (every_packets != nullptr && ::atoi(every_packets) >= 0) gc_settings.every_packets = ::atoi(every_packets);
+	char * every_ms = getenv("FIREGEX_PY_GC_EVERY_MS");
+	if (every_ms != nullptr && ::atoi(every_ms) >= 0) gc_settings.every_ms = ::atoi(every_ms);
+	char * idle_ms = getenv("FIREGEX_PY_GC_IDLE_MS");
+	if (idle_ms != nullptr && ::atoi(idle_ms) >= 0) gc_settings.idle_ms = ::atoi(idle_ms);
+}
+
+// Collections of all the interpreters of the process, reported to the backend
+struct gc_counters {
+	atomic<uint64_t> collections{0};
+	atomic<uint64_t> pause_us{0};
+	atomic<uint64_t> max_pause_us{0};
+	atomic<uint64_t> collected{0};
+
+	void add(uint64_t pause, uint64_t n_collected){
+		collections.fetch_add(1, memory_order_relaxed);
+		pause_us.fetch_add(pause, memory_order_relaxed);
+		collected.fetch_add(n_collected, memory_order_relaxed);
+		uint64_t max_pause = max_pause_us.load(memory_order_relaxed);
+		while (pause > max_pause && !max_pause_us.compare_exchange_weak(max_pause, pause, memory_order_relaxed)){}
+	}
+
+	string report(){
+		return "GC " + to_string(collections.load(memory_order_relaxed)) + " " +
+			to_string(pause_us.load(memory_order_relaxed)) + " " +
+			to_string(max_pause_us.load(memory_order_relaxed)) + " " +
+			to_string(collected.load(memory_order_relaxed)) + "\n";
+	}
+};
+
+gc_counters gc_stats;
+
+// Each interpreter runs in its own worker thread
+thread_local chrono::steady_clock::time_point gc_start_time;
+
+// gc.callbacks entry: callback(phase, info), measures every collection of the interpreter
+static PyObject* gc_callback(PyObject* self, PyObject* args){
+	PyObject* phase;
+	PyObject* info;
+	if (!PyArg_ParseTuple(args, "UO", &phase, &info)){
+		return nullptr;
+	}
+	if (PyUnicode_CompareWithASCIIString(phase, "start") == 0){
+		gc_start_time = chrono::steady_clock::now();
+	}else{
+		uint64_t pause = chrono::duration_cast<chrono::microseconds>(chrono::steady_clock::now() - gc_start_time).count();
+		uint64_t collected = 0;
+		PyObject* collected_py = PyDict_Check(info) ? PyDict_GetItemString(info, "collected") : nullptr;
+		if (collected_py != nullptr && PyLong_Check(collected_py)){
+			collected = PyLong_AsUnsignedLongLong(collected_py);
+		}
+		gc_stats.add(pause, collected);
+	}
+	Py_RETURN_NONE;
+}
+
+static PyMethodDef gc_callback_def = {"__firegex_gc_callback", gc_callback, METH_VARARGS, nullptr};
+
+/*
+Schedules the full collections of a worker interpreter, the methods are called by the worker thread with the GIL.
+Without FIREGEX_PY_GC_EVERY_PACKETS/EVERY_MS the collections during the traffic are only the generational ones.
+*/
+class GcPolicy {
+	private:
+		unsigned int packets_since_collect = 0;
+		chrono::steady_clock::time_point last_collect = chrono::steady_clock::now();
+
+		void collect(){
+			PyGC_Collect();
+			packets_since_collect = 0;
+			last_collect = chrono::steady_clock::now();
+		}
+
+		unsigned int ms_since_collect(){
+			return chrono::duration_cast<chrono::milliseconds>(chrono::steady_clock::now() - last_collect).count();
+		}
+
+	public:
+		// Applies the thresholds and registers the gc callback in the interpreter of the current thread
+		void setup(){
+			PyObject* gc_module = PyImport_ImportModule("gc");
+			if (gc_module == nullptr){
+				PyErr_Print();
+				return;
+			}
+			if (gc_settings.thresholds[0] >= 0){
+				PyObject* res = nullptr;
+				if (gc_settings.thresholds[1] < 0){
+					res = PyObject_CallMethod(gc_module, "set_threshold", "i", gc_settings.thresholds[0]);
+				}else if (gc_settings.thresholds[2] < 0){
+					res = PyObject_CallMethod(gc_module, "set_threshold", "ii", gc_settings.thresholds[0], gc_settings.thresholds[1]);
+				}else{
+					res = PyObject_CallMethod(gc_module, "set_threshold", "iii", gc_settings.thresholds[0], gc_settings.thresholds[1], gc_settings.thresholds[2]);
+				}
+				if (res == nullptr){
+					PyErr_Print();
+				}
+				Py_XDECREF(res);
+			}
+			PyObject* callbacks = PyObject_GetAttrString(gc_module, "callbacks");
+			PyObject* callback = PyCFunction_New(&gc_callback_def, nullptr);
+			if (callbacks == nullptr || callback == nullptr || PyList_Append(callbacks, callback) != 0){
+				PyErr_Print();
+			}
+			Py_XDECREF(callback);
+			Py_XDECREF(callbacks);
+			Py_DECREF(gc_module);
+		}
+
+		// After a packet has been handled by the filters
+		void on_packet(){
+			packets_since_collect++;
+			if (
+				(gc_settings.every_packets > 0 && packets_since_collect >= gc_settings.every_packets) ||
+				(gc_settings.every_ms > 0 && ms_since_collect() >= gc_settings.every_ms)
+			){
+				collect();
+			}
+		}
+
+		// When the worker has no packets to handle
+		void on_idle(){
+			if (gc_settings.idle_ms > 0 && packets_since_collect > 0 && ms_since_collect() >= gc_settings.idle_ms){
+				collect();
+			}
+		}
+};
+
+// Writes the report with write_line every FIREGEX_FLOW_STATS_INTERVAL seconds, when it changes
+template<typename F>
+void run_gc_stats_reporter(unsigned int interval, F write_line){
+	thread([interval, write_line](){
+		string last_report;
+		for(;;){
+			this_thread::sleep_for(chrono::seconds(interval));
+			string report = gc_stats.report();
+			if (report != last_report){
+				write_line(report);
+				last_report = report;
+			}
+		}
+	}).detach();
+}
+
+}}
+#endif // PROXY_GC_POLICY_CPP
@@ -19,6 +19,7 @@
 #include "../classes/nfqueue.cpp"
 #include "stream_ctx.cpp"
 #include "settings.cpp"
+#include "gc_policy.cpp"
 #include <Python.h>
 
 using Tins::TCPIP::Stream;
@@ -48,7 +49,9 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 	NfQueue::PktRequest<PyProxyQueue>* pkt;
 	NfQueue::tcp_ack_seq_ctx* current_tcp_ack = nullptr;
 
-	PyObject* handle_packet_code = nullptr;
+	PyObject* handle_packet_fast = nullptr;
+	GcPolicy gc_policy;
+	pyfilter_template filter_template;
 
     void before_loop() override {
 		PyStatus pystatus;
@@ -69,9 +72,23 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		if(!PyGC_IsEnabled()){
 			PyGC_Enable();
 		}
+		gc_policy.setup();
 
-		handle_packet_code = unmarshal_code(py_handle_packet_code);
+		// Entry point called for each packet by the filter contexts
+		PyObject* internals = PyImport_ImportModule("firegex.nfproxy.internals");
+		if (internals != nullptr){
+			handle_packet_fast = PyObject_GetAttrString(internals, "handle_packet_fast");
+			Py_DECREF(internals);
+		}
+		if (handle_packet_fast == nullptr){
+			PyErr_Print();
+			cerr << "[fatal] [main] Failed to load firegex.nfproxy.internals.handle_packet_fast" << endl;
+			throw invalid_argument("Failed to load firegex.nfproxy.internals.handle_packet_fast");
+		}
 		// Setting callbacks for the stream follower
+		if (NfQueue::flow_table_settings.idle_timeout > 0){
+			follower.stream_keep_alive(chrono::seconds(NfQueue::flow_table_settings.idle_timeout));
+		}
 		follower.new_stream_callback(bind(on_new_stream, placeholders::_1, this));
 		follower.stream_termination_callback(bind(on_stream_close, placeholders::_1, this));
     }
@@ -88,23 +105,12 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		control_socket << "EXCEPTION" << endl;
 	}
 
-	//If the stream has already been matched, drop all data, and try to close the connection
-	static void keep_fin_packet(PyProxyQueue* pyq){
-		pyq->pkt->reject();// This is needed because the callback has to take the updated pkt pointer!
-	}
-
-	static void keep_dropped(PyProxyQueue* pyq){
-		pyq->pkt->drop();// This is needed because the callback has to take the updated pkt pointer!
-	}
-
-	void filter_action(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, const string& data, bool is_client){
+	void filter_action(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, string_view data, bool is_client){
 		auto stream_search = sctx.streams_ctx.find(pkt->sid);
 		pyfilter_ctx* stream_match;
 		if (stream_search == sctx.streams_ctx.end()){
-			shared_ptr<PyCodeConfig> conf = config;
 			//If config is not set, ignore the stream
-			PyObject* compiled_code = conf->compiled_code();
-			if (compiled_code == nullptr){
+			if (!filter_template.load(config)){
 				stream.client_data_callback(nullptr);
 				stream.server_data_callback(nullptr);
 				stream.ignore_client_data();
@@ -112,7 +118,7 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 				return pkt->accept();
 			}else{
 				try{
-					stream_match = new pyfilter_ctx(compiled_code, handle_packet_code);
+					stream_match = filter_template.new_ctx(handle_packet_fast);
 				}catch(invalid_argument& e){
 					cerr << "[error] [filter_action] Failed to create the filter context" << endl;
 					print_exception_reason();
@@ -123,27 +129,95 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 					stream.ignore_server_data();
 					return pkt->accept();
 				}
-				sctx.streams_ctx.insert_or_assign(pkt->sid, stream_match);
+				if (!sctx.track_stream(pkt->sid, stream_match)){
+					delete stream_match;
+					stream.client_data_callback(nullptr);
+					stream.server_data_callback(nullptr);
+					stream.ignore_client_data();
+					stream.ignore_server_data();
+					return pkt->accept();
+				}
 			}
 		}else{
 			stream_match = stream_search->second;
-		}		
+		}
+
+		// Until a prefilter literal is found in the stream python is not called
+		if (!stream_match->prefilter_check(data, is_client, filter_template.prefilter_scratch)){
+			return pkt->accept();
+		}
+		if (stream_match->has_skipped_data()){
+			auto result = stream_match->handle_skipped_data(pkt);
+			if (result.action != PyFilterResponse::ACCEPT){
+				gc_policy.on_packet();
+				return apply_result(pkt, stream, result);
+			}
+		}
+
+		if (!stream_match->is_accepted(is_client)){
+			auto result = stream_match->handle_packet(pkt, data, is_client);
+			gc_policy.on_packet();
+			stream_match->accept_direction(result.action, is_client);
+			if (!stream_match->is_accepted(is_client)){
+				return apply_result(pkt, stream, result);
+			}
+		}
+		ignore_accepted_data(pkt, stream, stream_match);
+		return pkt->accept();
+	}
 
-		auto result = stream_match->handle_packet(pkt, data, is_client);
+	// The data of the directions left by the filters is no longer followed, the context is dropped once both are left
+	void ignore_accepted_data(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, pyfilter_ctx* stream_match){
+		if (stream_match->client_accepted){
+			stream.ignore_client_data();
+			stream.client_data_callback(nullptr);
+		}
+		if (stream_match->server_accepted){
+			stream.ignore_server_data();
+			stream.server_data_callback(nullptr);
+		}
+		if (stream_match->client_accepted && stream_match->server_accepted){
+			sctx.clean_stream_by_id(pkt->sid);
+		}
+	}
+
+	// The verdict is kept per flow and applied by handle_next_packet: the directions already left by the filters
+	// are no longer followed, so the data callbacks can't be used for them
+	void block_flow(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, PyFilterResponse verdict){
+		sctx.clean_stream_by_id(pkt->sid);
+		sctx.block_flow(pkt->sid, verdict);
+		stream.ignore_client_data();
+		stream.ignore_server_data();
+		stream.client_data_callback(nullptr);
+		stream.server_data_callback(nullptr);
+	}
+
+	//If the flow has already been matched, drop all data, and with REJECT try to close the connection
+	void apply_blocked_verdict(PyFilterResponse verdict){
+		pkt->parse();
+		if (pkt->data_original_size() == 0){
+			return; // The packets without data are left to the stream follower to track the closing of the flow
+		}
+		if (verdict == PyFilterResponse::REJECT){
+			pkt->reject();
+		}else{
+			pkt->drop();
+		}
+	}
+
+	void apply_result(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, py_filter_response& result){
 		switch(result.action){
 			case PyFilterResponse::ACCEPT:
+			case PyFilterResponse::ACCEPT_FLOW:
+			case PyFilterResponse::ACCEPT_DIRECTION:
 				return pkt->accept();
 			case PyFilterResponse::DROP:
 				print_blocked_reason(*result.filter_match_by);
-				sctx.clean_stream_by_id(pkt->sid);
-				stream.client_data_callback(bind(keep_dropped, this));
-				stream.server_data_callback(bind(keep_dropped, this));
+				block_flow(pkt, stream, result.action);
 				return pkt->drop();
 			case PyFilterResponse::REJECT:
 				print_blocked_reason(*result.filter_match_by);
-				sctx.clean_stream_by_id(pkt->sid);
-				stream.client_data_callback(bind(keep_fin_packet, this));
-				stream.server_data_callback(bind(keep_fin_packet, this));
+				block_flow(pkt, stream, result.action);
 				return pkt->reject();
 			case PyFilterResponse::MANGLE:
 				pkt->mangle_custom_pkt(result.mangled_packet->c_str(), result.mangled_packet->size());
@@ -169,21 +243,21 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 	}
 
 
-	static void on_data_recv(Stream& stream, PyProxyQueue* pyq, const string& data, bool is_client) {
+	static void on_data_recv(Stream& stream, PyProxyQueue* pyq, string_view data, bool is_client) {
 		pyq->pkt->fix_data_payload();
 		pyq->filter_action(pyq->pkt, stream, data, is_client); //Only here the rebuilt_tcp_data is set
 	}
 	
 	//Input data filtering
 	static void on_client_data(Stream& stream, PyProxyQueue* pyq) {
-		auto data = stream.client_payload();
-		on_data_recv(stream, pyq, string((char*)data.data(), data.size()), true);
+		auto& data = stream.client_payload();
+		on_data_recv(stream, pyq, string_view((const char*)data.data(), data.size()), true);
 	}
 	
 	//Server data filtering
 	static void on_server_data(Stream& stream, PyProxyQueue* pyq) {
-		auto data = stream.server_payload();
-		on_data_recv(stream, pyq, string((char*)data.data(), data.size()), false);
+		auto& data = stream.server_payload();
+		on_data_recv(stream, pyq, string_view((const char*)data.data(), data.size()), false);
 	}
 	
 	// A stream was terminated. The second argument is the reason why it was terminated
@@ -191,6 +265,7 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		stream_id stream_id = stream_id::make_identifier(stream);
 		pyq->sctx.clean_stream_by_id(stream_id);
 		pyq->sctx.clean_tcp_ack_by_id(stream_id);
+		pyq->sctx.clean_blocked_by_id(stream_id);
 	}
 	
 	static void on_new_stream(Stream& stream, PyProxyQueue* pyq) {
@@ -198,6 +273,7 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		if (stream.is_partial_stream()) {
 			stream.enable_recovery_mode(10 * 1024);
 		}
+		pyq->sctx.clean_blocked_by_id(pyq->pkt->sid); // A new connection reusing the ports of a blocked flow
 
 		if (pyq->current_tcp_ack != nullptr){
 			pyq->current_tcp_ack->reset();
@@ -225,6 +301,8 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 			throw invalid_argument("Only TCP and UDP are supported");
 		}
 
+		sctx.evict_idle();
+
 		auto tcp_ack_search = sctx.tcp_ack_ctx.find(pkt->sid);
 		if (tcp_ack_search != sctx.tcp_ack_ctx.end()){
 			current_tcp_ack = tcp_ack_search->second;
@@ -236,26 +314,35 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 
 		pkt->fix_tcp_ack();
 
-		if (pkt->is_ipv6){
-			follower.process_packet(*pkt->ipv6);
-		}else{
-			follower.process_packet(*pkt->ipv4);
+		auto blocked_search = sctx.blocked_flows.find(pkt->sid);
+		if (blocked_search != sctx.blocked_flows.end()){
+			apply_blocked_verdict(blocked_search->second);
 		}
 
+		follower.process_packet(pkt->ip_pdu());
+
 		//Fallback to the default action
 		if (pkt->get_action() == NfQueue::FilterAction::NOACTION){
 			return pkt->accept();
 		}
 	}
 
+	void on_queue_empty() override{
+		gc_policy.on_idle();
+	}
+
 	~PyProxyQueue() {
+		filter_template.clear();
+		Py_CLEAR(filter_template.new_stream_globals);
+		Py_CLEAR(filter_template.need_raw_packet_func);
+		Py_CLEAR(filter_template.prefilter_literals_func);
+		Py_CLEAR(handle_packet_fast);
 		// Closing first the interpreter
 		
 		Py_EndInterpreter(tstate);
 		PyEval_ReleaseThread(tstate);
 		PyThreadState_Clear(tstate);
 		PyThreadState_Delete(tstate);
-		Py_DECREF(handle_packet_code);
 	
 		sctx.clean();
 	}
@@ -74,29 +74,6 @@ void init_control_socket(){
 	control_socket = UnixClientConnection(socket_path);
 }
 
-string py_handle_packet_code;
-
-void init_handle_packet_code(){
-	PyObject* compiled_code = Py_CompileStringExFlags(
-		"firegex.nfproxy.internals.handle_packet(globals())\n", "<pyfilter>",
-	Py_file_input, NULL, 2);
-	PyObject* code_dump = PyMarshal_WriteObjectToString(compiled_code, 4);
-	Py_DECREF(compiled_code);
-	if (code_dump == nullptr){
-		if (PyErr_Occurred())
-			PyErr_Print();
-		std::cerr << "[fatal] [main] Failed to dump the code" << endl;
-		throw invalid_argument("Failed to dump the code");
-	}
-	if (!PyBytes_Check(code_dump)){
-		std::cerr << "[fatal] [main] Failed to dump the code" << endl;
-		Py_DECREF(code_dump);
-		throw invalid_argument("Failed to dump the code");
-	}
-	py_handle_packet_code = string(PyBytes_AsString(code_dump), PyBytes_Size(code_dump));
-	Py_DECREF(code_dump);
-}
-
 }}
 #endif // PROXY_TUNNEL_SETTINGS_CPP
 
@@ -5,6 +5,9 @@
 #include <iostream>
 #include <tins/tcp_ip/stream_identifier.h>
 #include <map>
+#include <vector>
+#include <memory>
+#include <hs.h>
 #include <Python.h>
 #include "../classes/netfilter.cpp"
 #include "../classes/nfqueue.cpp"
@@ -25,15 +28,19 @@ enum PyFilterResponse {
 	DROP = 1,
 	REJECT = 2,
 	MANGLE = 3,
-	EXCEPTION = 4,
-	INVALID = 5
+	ACCEPT_FLOW = 4,
+	ACCEPT_DIRECTION = 5,
+	EXCEPTION = 6,
+	INVALID = 7
 };
 
-const PyFilterResponse VALID_PYTHON_RESPONSE[4] = {
+const PyFilterResponse VALID_PYTHON_RESPONSE[6] = {
 	PyFilterResponse::ACCEPT,
 	PyFilterResponse::DROP,
 	PyFilterResponse::REJECT,
-	PyFilterResponse::MANGLE
+	PyFilterResponse::MANGLE,
+	PyFilterResponse::ACCEPT_FLOW,
+	PyFilterResponse::ACCEPT_DIRECTION
 };
 
 struct py_filter_response {
@@ -44,6 +51,12 @@ struct py_filter_response {
 	py_filter_response(PyFilterResponse action, string* filter_match_by = nullptr, string* mangled_packet = nullptr):
 		action(action), filter_match_by(filter_match_by), mangled_packet(mangled_packet){}
 
+	py_filter_response(py_filter_response&& other) noexcept:
+		action(other.action), filter_match_by(other.filter_match_by), mangled_packet(other.mangled_packet){
+		other.filter_match_by = nullptr;
+		other.mangled_packet = nullptr;
+	}
+
 	~py_filter_response(){
 		delete mangled_packet;
 		delete filter_match_by;
@@ -52,30 +65,127 @@ struct py_filter_response {
 
 typedef Tins::TCPIP::StreamIdentifier stream_id;
 
+struct prefilter_config {
+	// Max data of a stream kept while waiting for a prefilter match, then the stream is handled by python
+	size_t max_skipped = 16*1024;
+};
+
+prefilter_config prefilter_settings;
+
+void load_prefilter_settings(){
+	char * max_skipped = getenv("FIREGEX_NFPROXY_PREFILTER_BUFFER");
+	if (max_skipped != nullptr && ::atoi(max_skipped) >= 0) prefilter_settings.max_skipped = ::atoi(max_skipped);
+}
+
 struct pyfilter_ctx {
 
 	PyObject * glob = nullptr;
 	PyObject * py_handle_packet = nullptr;
+	// If false no filter uses RawPacket: the raw packet is not reserialized and not passed to python
+	bool need_raw_packet = true;
+
+	// Literals of the @pyfilter(prefilter=...) of the config, nullptr if python handles every packet
+	shared_ptr<hs_database_t> prefilter_db = nullptr;
+	hs_stream_t* prefilter_client = nullptr;
+	hs_stream_t* prefilter_server = nullptr;
+	bool prefilter_matched = false;
+	// Data accepted before the match (is_client, data), sent to python once a literal is found
+	vector<pair<bool, string>> prefilter_skipped;
+	size_t prefilter_skipped_size = 0;
+
+	// Directions left by the filters (ACCEPT_DIRECTION/ACCEPT_FLOW): their data is no longer sent to python
+	bool client_accepted = false;
+	bool server_accepted = false;
 	
-	pyfilter_ctx(PyObject * compiled_code, PyObject * handle_packet_code){
-		py_handle_packet = handle_packet_code;
+	// Takes the reference of the globals of the stream (see pyfilter_template)
+	pyfilter_ctx(PyObject * stream_glob, PyObject * handle_packet_fast, bool need_raw_packet = true, shared_ptr<hs_database_t> prefilter_db = nullptr){
+		this->need_raw_packet = need_raw_packet;
+		this->prefilter_db = prefilter_db;
+		prefilter_matched = prefilter_db == nullptr;
+		py_handle_packet = handle_packet_fast;
 		Py_INCREF(py_handle_packet);
-		glob = PyDict_New();
-		PyObject* result = PyEval_EvalCode(compiled_code, glob, glob);
-		Py_XDECREF(compiled_code);
-		if (PyErr_Occurred()){
-			PyErr_Print();
-			Py_XDECREF(glob);
-			std::cerr << "[fatal] [main] Failed to compile the code" << endl;
-			throw invalid_argument("Failed to execute the code, maybe an invalid filter code has been provided");
-		}
-		Py_XDECREF(result);
+		glob = stream_glob;
 	}
 
 	~pyfilter_ctx(){
+		close_prefilter_streams();
 		Py_DECREF(glob);
 		Py_DECREF(py_handle_packet);
-		PyGC_Collect();
+	}
+
+	/*
+	Scans the data with the prefilter: returns true if the packet has to be handled by python.
+	Until a literal is found the data is kept (up to FIREGEX_NFPROXY_PREFILTER_BUFFER bytes) and the packet can be accepted,
+	then handle_skipped_data gives python the stream from the start.
+	*/
+	bool prefilter_check(string_view data, bool is_client, hs_scratch_t* scratch){
+		if (prefilter_matched){
+			return true;
+		}
+		hs_stream_t* & hs_stream = is_client ? prefilter_client : prefilter_server;
+		if (hs_stream == nullptr && hs_open_stream(prefilter_db.get(), 0, &hs_stream) != HS_SUCCESS){
+			cerr << "[error] [prefilter_check] Error opening the stream matcher (hs)" << endl;
+			return prefilter_match();
+		}
+		bool has_matched = false;
+		auto match_func = [](unsigned int id, auto from, auto to, auto flags, auto ctx){
+			*(bool*)ctx = true;
+			return -1; // Stop matching
+		};
+		hs_error_t err = hs_scan_stream(hs_stream, data.data(), data.size(), 0, scratch, match_func, &has_matched);
+		if (err != HS_SUCCESS && err != HS_SCAN_TERMINATED){
+			cerr << "[error] [prefilter_check] Error while matching the stream (hs)" << endl;
+			return prefilter_match();
+		}
+		if (has_matched || prefilter_skipped_size + data.size() > prefilter_settings.max_skipped){
+			return prefilter_match();
+		}
+		prefilter_skipped.emplace_back(is_client, string(data));
+		prefilter_skipped_size += data.size();
+		return false;
+	}
+
+	void accept_direction(PyFilterResponse action, bool is_client){
+		if (action == PyFilterResponse::ACCEPT_FLOW){
+			client_accepted = server_accepted = true;
+		}else if (action == PyFilterResponse::ACCEPT_DIRECTION){
+			(is_client ? client_accepted : server_accepted) = true;
+		}
+	}
+
+	inline bool is_accepted(bool is_client){
+		return is_client ? client_accepted : server_accepted;
+	}
+
+	inline bool has_skipped_data(){
+		return !prefilter_skipped.empty();
+	}
+
+	/*
+	Sends to python the data accepted before the prefilter match, in the order it was received.
+	Those packets are gone: only a result that closes the stream is returned (ACCEPT otherwise)
+	*/
+	py_filter_response handle_skipped_data(NfQueue::PktRequest<PyProxyQueue>* pkt){
+		auto skipped = std::move(prefilter_skipped);
+		prefilter_skipped.clear();
+		prefilter_skipped_size = 0;
+		for (auto& [chunk_is_client, chunk]: skipped){
+			if (is_accepted(chunk_is_client)){
+				continue;
+			}
+			auto result = handle_packet(pkt, chunk, chunk_is_client);
+			accept_direction(result.action, chunk_is_client);
+			switch(result.action){
+				case PyFilterResponse::DROP:
+				case PyFilterResponse::REJECT:
+				case PyFilterResponse::EXCEPTION:
+				case PyFilterResponse::INVALID:
+					return result;
+				default:
+					break;
+			}
+		}
+		return py_filter_response(PyFilterResponse::ACCEPT);
 	}
 
 	inline void set_item_to_glob(const char* key, PyObject* value){
@@ -105,67 +215,73 @@ struct pyfilter_ctx {
 
 	py_filter_response handle_packet(
 		NfQueue::PktRequest<PyProxyQueue>* pkt,
-		const string& data,
+		string_view data,
 		bool is_client
 	){
-		PyObject * packet_info = PyDict_New();
-		
-		pkt->reserialize();
-		set_item_to_dict(packet_info, "data", PyBytes_FromStringAndSize(data.c_str(), data.size()));
-		set_item_to_dict(packet_info, "l4_size", PyLong_FromLong(pkt->data_size()));
-		set_item_to_dict(packet_info, "raw_packet", PyBytes_FromStringAndSize(pkt->packet.c_str(), pkt->packet.size()));
-		set_item_to_dict(packet_info, "is_input", PyBool_FromLong(is_client));
-		set_item_to_dict(packet_info, "is_ipv6", PyBool_FromLong(pkt->is_ipv6));
-		set_item_to_dict(packet_info, "is_tcp", PyBool_FromLong(pkt->l4_proto == NfQueue::L4Proto::TCP));
-
-		// Set packet info to the global context
-		set_item_to_glob("__firegex_packet_info", packet_info);
-		PyObject * result = PyEval_EvalCode(py_handle_packet, glob, glob);
-		PyGC_Collect();
-		del_item_from_glob("__firegex_packet_info");
+		PyObject* raw_packet = Py_None;
+		if (need_raw_packet){
+			pkt->reserialize();
+			raw_packet = PyBytes_FromStringAndSize(pkt->packet.c_str(), pkt->packet.size());
+		}else{
+			Py_INCREF(raw_packet);
+		}
+		// firegex.nfproxy.internals.handle_packet_fast(glob, data, raw_packet, is_input, is_ipv6, is_tcp, l4_size)
+		PyObject* args[7] = {
+			glob,
+			PyBytes_FromStringAndSize(data.data(), data.size()),
+			raw_packet,
+			PyBool_FromLong(is_client),
+			PyBool_FromLong(pkt->is_ipv6),
+			PyBool_FromLong(pkt->l4_proto == NfQueue::L4Proto::TCP),
+			PyLong_FromLong(pkt->data_size())
+		};
+		PyObject* result = PyObject_Vectorcall(py_handle_packet, args, 7, nullptr);
+		for (int i = 1; i < 7; i++){
+			Py_XDECREF(args[i]);
+		}
 
-		if (PyErr_Occurred()){
-			cerr << "[error] [handle_packet] Failed to execute the code " << result << endl;
+		if (result == nullptr){
+			cerr << "[error] [handle_packet] Failed to execute the code" << endl;
 			PyErr_Print();
 			#ifdef DEBUG
 			cerr << "[DEBUG] [handle_packet] Exception raised" << endl;
 			#endif
 			return py_filter_response(PyFilterResponse::EXCEPTION);
 		}
-			
+		py_filter_response response = parse_result(result, pkt);
 		Py_DECREF(result);
+		return response;
+	}
 
-		result = get_item_from_glob("__firegex_pyfilter_result");
-		if (result == nullptr){
-			#ifdef DEBUG
-			cerr << "[DEBUG] [handle_packet] No result found" << endl;
-			#endif
-			return py_filter_response(PyFilterResponse::INVALID);
-		}
+	private:
+	bool prefilter_match(){
+		prefilter_matched = true;
+		close_prefilter_streams();
+		return true;
+	}
 
-		if (!PyDict_Check(result)){
-			if (PyErr_Occurred()){
-				PyErr_Print();
+	void close_prefilter_streams(){
+		for (auto hs_stream: {&prefilter_client, &prefilter_server}){
+			if (*hs_stream != nullptr && hs_close_stream(*hs_stream, nullptr, nullptr, nullptr) != HS_SUCCESS){
+				cerr << "[warning] [close_prefilter_streams] Error closing the stream matcher (hs)" << endl;
 			}
-			#ifdef DEBUG
-			cerr << "[DEBUG] [handle_packet] Result is not a dict" << endl;
-			#endif
-			del_item_from_glob("__firegex_pyfilter_result");
-			return py_filter_response(PyFilterResponse::INVALID);
+			*hs_stream = nullptr;
 		}
-		PyObject* action = PyDict_GetItemString(result, "action");
-		if (action == nullptr){
+	}
+
+	// Result of handle_packet_fast: (action, matched_by, mangled_packet)
+	py_filter_response parse_result(PyObject* result, NfQueue::PktRequest<PyProxyQueue>* pkt){
+		if (!PyTuple_Check(result) || PyTuple_GET_SIZE(result) != 3){
 			#ifdef DEBUG
-			cerr << "[DEBUG] [handle_packet] No result action found" << endl;
+			cerr << "[DEBUG] [handle_packet] Result is not a 3-tuple" << endl;
 			#endif
-			del_item_from_glob("__firegex_pyfilter_result");
 			return py_filter_response(PyFilterResponse::INVALID);
 		}
+		PyObject* action = PyTuple_GET_ITEM(result, 0);
 		if (!PyLong_Check(action)){
 			#ifdef DEBUG
 			cerr << "[DEBUG] [handle_packet] Action is not a long" << endl;
 			#endif
-			del_item_from_glob("__firegex_pyfilter_result");
 			return py_filter_response(PyFilterResponse::INVALID);
 		}
 		PyFilterResponse action_enum = (PyFilterResponse)PyLong_AsLong(action);
@@ -182,24 +298,14 @@ struct pyfilter_ctx {
 			#ifdef DEBUG
 			cerr << "[DEBUG] [handle_packet] Invalid action" << endl;
 			#endif
-			del_item_from_glob("__firegex_pyfilter_result");
 			return py_filter_response(PyFilterResponse::INVALID);
 		}
 
-		if (action_enum == PyFilterResponse::ACCEPT){
-			del_item_from_glob("__firegex_pyfilter_result");
+		if (action_enum == PyFilterResponse::ACCEPT || action_enum == PyFilterResponse::ACCEPT_FLOW || action_enum == PyFilterResponse::ACCEPT_DIRECTION){
 			return py_filter_response(action_enum);
 		}
-		PyObject *func_name_py = PyDict_GetItemString(result, "matched_by");
-		if (func_name_py == nullptr){
-			del_item_from_glob("__firegex_pyfilter_result");
-			#ifdef DEBUG
-			cerr << "[DEBUG] [handle_packet] No result matched_by found" << endl;
-			#endif
-			return py_filter_response(PyFilterResponse::INVALID);
-		}
+		PyObject *func_name_py = PyTuple_GET_ITEM(result, 1);
 		if (!PyUnicode_Check(func_name_py)){
-			del_item_from_glob("__firegex_pyfilter_result");
 			#ifdef DEBUG
 			cerr << "[DEBUG] [handle_packet] matched_by is not a string" << endl;
 			#endif
@@ -207,38 +313,213 @@ struct pyfilter_ctx {
 		}
 		string* func_name = new string(PyUnicode_AsUTF8(func_name_py));
 		if (action_enum == PyFilterResponse::DROP || action_enum == PyFilterResponse::REJECT){
-			del_item_from_glob("__firegex_pyfilter_result");
 			return py_filter_response(action_enum, func_name);
 		}
 		if (action_enum == PyFilterResponse::MANGLE){
-			PyObject* mangled_packet = PyDict_GetItemString(result, "mangled_packet");
-			if (mangled_packet == nullptr){
-				del_item_from_glob("__firegex_pyfilter_result");
-				#ifdef DEBUG
-				cerr << "[DEBUG] [handle_packet] No result mangled_packet found" << endl;
-				#endif
-				return py_filter_response(PyFilterResponse::INVALID);
+			PyObject* mangled_packet = PyTuple_GET_ITEM(result, 2);
+			if (mangled_packet == Py_None && !need_raw_packet){
+				// The filter can't have changed the packet: it's sent as it is
+				pkt->reserialize();
+				return py_filter_response(PyFilterResponse::MANGLE, func_name, new string(pkt->packet));
 			}
 			if (!PyBytes_Check(mangled_packet)){
 				#ifdef DEBUG
 				cerr << "[DEBUG] [handle_packet] mangled_packet is not a bytes" << endl;
 				#endif
-				del_item_from_glob("__firegex_pyfilter_result");
+				delete func_name;
 				return py_filter_response(PyFilterResponse::INVALID);
 			}
 			string* pkt_str = new string(PyBytes_AsString(mangled_packet), PyBytes_Size(mangled_packet));
-			del_item_from_glob("__firegex_pyfilter_result");
 			return py_filter_response(PyFilterResponse::MANGLE, func_name, pkt_str);
 		}
 		
 		//Should never reach this point, but just in case of new action not managed...
-		del_item_from_glob("__firegex_pyfilter_result");
+		delete func_name;
 		return py_filter_response(PyFilterResponse::INVALID);
 	}
 
 };
 
-typedef map<stream_id, pyfilter_ctx*> matching_map;
+/*
+Filter code of the current config, unmarshalled and executed once per worker: the globals of a new stream
+are a copy of the executed ones (firegex.nfproxy.internals.new_stream_globals).
+If the module level values of the filter code can't be shared between streams the code is executed for each stream.
+*/
+struct pyfilter_template {
+	shared_ptr<PyCodeConfig> conf;
+	PyObject* code = nullptr;
+	PyObject* glob = nullptr;
+	PyObject* new_stream_globals = nullptr;
+	PyObject* need_raw_packet_func = nullptr;
+	PyObject* prefilter_literals_func = nullptr;
+	bool need_raw_packet = true;
+	shared_ptr<hs_database_t> prefilter_db = nullptr;
+	// Shared by the prefilters of all the configs loaded (hs_alloc_scratch only grows it)
+	hs_scratch_t* prefilter_scratch = nullptr;
+
+	static PyObject* internals_func(const char* name){
+		PyObject* func = nullptr;
+		PyObject* internals = PyImport_ImportModule("firegex.nfproxy.internals");
+		if (internals != nullptr){
+			func = PyObject_GetAttrString(internals, name);
+			Py_DECREF(internals);
+		}
+		if (func == nullptr){
+			PyErr_Print();
+		}
+		return func;
+	}
+
+	// Asks firegex.nfproxy.internals.need_raw_packet if the enabled filters use RawPacket
+	bool filters_need_raw_packet(){
+		if (glob == nullptr || need_raw_packet_func == nullptr){
+			return true;
+		}
+		PyObject* res = PyObject_CallOneArg(need_raw_packet_func, glob);
+		if (res == nullptr){
+			PyErr_Print();
+			return true;
+		}
+		bool need = PyObject_IsTrue(res) != 0;
+		Py_DECREF(res);
+		return need;
+	}
+
+	// Compiles in a hyperscan stream database the literals given by firegex.nfproxy.internals.prefilter_literals
+	void load_prefilter(){
+		prefilter_db = nullptr;
+		if (glob == nullptr || prefilter_literals_func == nullptr){
+			return;
+		}
+		PyObject* res = PyObject_CallOneArg(prefilter_literals_func, glob);
+		if (res == nullptr){
+			PyErr_Print();
+			return;
+		}
+		vector<string> literals;
+		if (PyList_Check(res)){
+			for (Py_ssize_t i = 0; i < PyList_GET_SIZE(res); i++){
+				PyObject* literal = PyList_GET_ITEM(res, i);
+				if (!PyBytes_Check(literal)){
+					cerr << "[error] [load_prefilter] Invalid prefilter literal, the prefilter is disabled" << endl;
+					Py_DECREF(res);
+					return;
+				}
+				literals.emplace_back(PyBytes_AsString(literal), PyBytes_Size(literal));
+			}
+		}
+		Py_DECREF(res);
+		if (literals.empty()){
+			return;
+		}
+		vector<const char*> expressions;
+		vector<size_t> lengths;
+		vector<unsigned int> flags, ids;
+		for (unsigned int i = 0; i < literals.size(); i++){
+			expressions.push_back(literals[i].data());
+			lengths.push_back(literals[i].size());
+			flags.push_back(HS_FLAG_SINGLEMATCH);
+			ids.push_back(i);
+		}
+		hs_database_t* db = nullptr;
+		hs_compile_error_t* compile_err = nullptr;
+		if (hs_compile_lit_multi(
+			expressions.data(), flags.data(), ids.data(), lengths.data(),
+			expressions.size(), HS_MODE_STREAM, nullptr, &db, &compile_err
+		) != HS_SUCCESS){
+			cerr << "[error] [load_prefilter] Failed to compile the prefilter: " << compile_err->message << endl;
+			hs_free_compile_error(compile_err);
+			return;
+		}
+		if (hs_alloc_scratch(db, &prefilter_scratch) != HS_SUCCESS){
+			cerr << "[error] [load_prefilter] Cannot alloc scratch, the prefilter is disabled" << endl;
+			hs_free_database(db);
+			return;
+		}
+		// The streams opened with this database keep it alive after a config change
+		prefilter_db = shared_ptr<hs_database_t>(db, hs_free_database);
+		cerr << "[info] [load_prefilter] Prefilter enabled with " << literals.size() << " literals" << endl;
+	}
+
+	static PyObject* exec_code(PyObject* code){
+		PyObject* glob = PyDict_New();
+		PyObject* result = PyEval_EvalCode(code, glob, glob);
+		if (PyErr_Occurred()){
+			PyErr_Print();
+			Py_XDECREF(result);
+			Py_DECREF(glob);
+			return nullptr;
+		}
+		Py_XDECREF(result);
+		return glob;
+	}
+
+	void clear(){
+		Py_CLEAR(code);
+		Py_CLEAR(glob);
+		prefilter_db = nullptr;
+		conf = nullptr;
+	}
+
+	// Returns false if the config has no filter code
+	bool load(shared_ptr<PyCodeConfig> new_conf){
+		if (conf == new_conf){
+			return code != nullptr;
+		}
+		clear();
+		conf = new_conf;
+		code = conf->compiled_code();
+		if (code == nullptr){
+			return false;
+		}
+		glob = exec_code(code);
+		if (new_stream_globals == nullptr){
+			new_stream_globals = internals_func("new_stream_globals");
+		}
+		if (need_raw_packet_func == nullptr){
+			need_raw_packet_func = internals_func("need_raw_packet");
+		}
+		if (prefilter_literals_func == nullptr){
+			prefilter_literals_func = internals_func("prefilter_literals");
+		}
+		need_raw_packet = filters_need_raw_packet();
+		load_prefilter();
+		return true;
+	}
+
+	pyfilter_ctx* new_ctx(PyObject* handle_packet_fast){
+		PyObject* stream_glob = nullptr;
+		if (glob != nullptr && new_stream_globals != nullptr){
+			stream_glob = PyObject_CallOneArg(new_stream_globals, glob);
+			if (stream_glob == nullptr){
+				PyErr_Print();
+			}else if (stream_glob == Py_None){
+				Py_CLEAR(stream_glob);
+			}
+		}
+		if (stream_glob == nullptr){
+			stream_glob = exec_code(code);
+		}
+		if (stream_glob == nullptr){
+			std::cerr << "[error] [pyfilter_template] Failed to execute the code" << endl;
+			throw invalid_argument("Failed to execute the code, maybe an invalid filter code has been provided");
+		}
+		return new pyfilter_ctx(stream_glob, handle_packet_fast, need_raw_packet, prefilter_db);
+	}
+
+	~pyfilter_template(){
+		clear();
+		Py_XDECREF(new_stream_globals);
+		Py_XDECREF(need_raw_packet_func);
+		Py_XDECREF(prefilter_literals_func);
+		if (prefilter_scratch != nullptr){
+			hs_free_scratch(prefilter_scratch);
+		}
+	}
+};
+
+typedef NfQueue::stream_table<pyfilter_ctx*> matching_map;
+typedef NfQueue::stream_table<PyFilterResponse> verdict_map;
 
 
 struct stream_ctx {
@@ -247,6 +528,29 @@ struct stream_ctx {
 
 	NfQueue::tcp_ack_map tcp_ack_ctx;
 
+	// DROP/REJECT verdicts of the blocked flows, applied to all their data packets (both directions)
+	verdict_map blocked_flows;
+
+	stream_ctx(){
+		blocked_flows.count_stats = false; // The flows are already counted by streams_ctx
+	}
+
+	// Frees the flows without packets for FIREGEX_FLOW_IDLE_TIMEOUT seconds, a few slots at a time
+	// (tcp_ack_ctx is excluded: its entries are removed when the stream follower terminates the stream)
+	void evict_idle(){
+		auto timeout = NfQueue::flow_table_settings.idle_timeout;
+		streams_ctx.evict_idle(timeout, NfQueue::FLOW_SWEEP_STEP, [](auto& ele){ delete ele.second; });
+		blocked_flows.evict_idle(timeout, NfQueue::FLOW_SWEEP_STEP, [](auto&){});
+	}
+
+	// Tracks a new stream: if the table is full the least recently used stream is evicted
+	bool track_stream(stream_id sid, pyfilter_ctx* ctx){
+		if (streams_ctx.full()){
+			streams_ctx.evict_oldest(NfQueue::FLOW_EVICT_SAMPLES, [](auto& ele){ delete ele.second; });
+		}
+		return streams_ctx.insert_or_assign(sid, ctx);
+	}
+
 	void clean_stream_by_id(stream_id sid){
 		auto stream_search = streams_ctx.find(sid);
 		if (stream_search != streams_ctx.end()){
@@ -256,6 +560,18 @@ struct stream_ctx {
 		}
 	}
 
+	// Keeps the verdict of a flow: if the table is full the least recently used verdict is evicted
+	void block_flow(stream_id sid, PyFilterResponse verdict){
+		if (blocked_flows.full()){
+			blocked_flows.evict_oldest(NfQueue::FLOW_EVICT_SAMPLES, [](auto&){});
+		}
+		blocked_flows.insert_or_assign(sid, verdict);
+	}
+
+	void clean_blocked_by_id(stream_id sid){
+		blocked_flows.erase(sid);
+	}
+
 	void clean_tcp_ack_by_id(stream_id sid){
 		auto tcp_ack_search = tcp_ack_ctx.find(sid);
 		if (tcp_ack_search != tcp_ack_ctx.end()){
@@ -274,6 +590,7 @@ struct stream_ctx {
 		}
 		tcp_ack_ctx.clear();
 		streams_ctx.clear();
+		blocked_flows.clear();
 	}
 };
 
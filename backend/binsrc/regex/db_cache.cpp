@@ -0,0 +1,142 @@
+#ifndef REGEX_DB_CACHE_CPP
+#define REGEX_DB_CACHE_CPP
+
+#include <hs.h>
+#include <iostream>
+#include <fstream>
+#include <filesystem>
+#include <string>
+#include <vector>
+#include <mutex>
+#include <thread>
+#include <algorithm>
+#include <cstdio>
+#include <cstdlib>
+#include <unistd.h>
+
+using namespace std;
+
+namespace Firegex {
+namespace Regex {
+
+/*
+Compiled hyperscan databases are serialized in FIREGEX_HS_CACHE_DIR, one file for each ruleset.
+The file name is a hash of everything that affects the compilation (hyperscan version, mode, expressions, flags and ids)
+so restarts and already seen configurations are loaded with hs_deserialize_database instead of being compiled again.
+Only the last FIREGEX_HS_CACHE_MAX_ENTRIES used databases are kept.
+*/
+class HsDatabaseCache {
+	private:
+		mutex prune_mut;
+
+		static uint64_t fnv1a(const string& data, uint64_t hash){
+			for (unsigned char c : data){
+				hash ^= c;
+				hash *= 0x100000001b3ULL;
+			}
+			return hash;
+		}
+
+		string entry_path(const string& key){
+			return (filesystem::path(cache_dir) / (key + ".hsdb")).string();
+		}
+
+		void prune(){
+			lock_guard<mutex> lock(prune_mut);
+			error_code ec;
+			vector<pair<filesystem::file_time_type, filesystem::path>> entries;
+			for (auto& entry : filesystem::directory_iterator(cache_dir, ec)){
+				if (entry.path().extension() == ".hsdb"){
+					entries.emplace_back(entry.last_write_time(ec), entry.path());
+				}
+			}
+			if (entries.size() <= max_entries){
+				return;
+			}
+			sort(entries.begin(), entries.end());
+			for (size_t i = 0; i < entries.size() - max_entries; i++){
+				filesystem::remove(entries[i].second, ec);
+			}
+		}
+
+	public:
+		string cache_dir;
+		size_t max_entries = 64;
+
+		bool enabled(){
+			return !cache_dir.empty();
+		}
+
+		static string ruleset_key(const vector<const char*>& regexes, const vector<unsigned int>& flags, unsigned int mode){
+			string material = string(hs_version()) + '\0' + to_string(mode);
+			for (size_t i = 0; i < regexes.size(); i++){
+				string regex(regexes[i]);
+				material += '\0' + to_string(flags[i]) + ':' + to_string(regex.size()) + ':' + regex;
+			}
+			char key[33];
+			snprintf(key, sizeof(key), "%016llx%016llx",
+				(unsigned long long)fnv1a(material, 0xcbf29ce484222325ULL),
+				(unsigned long long)fnv1a(material, 0x84222325cbf29ce4ULL)
+			);
+			return string(key);
+		}
+
+		hs_database_t* load(const string& key){
+			if (!enabled()){
+				return nullptr;
+			}
+			string path = entry_path(key);
+			ifstream file(path, ios::binary);
+			if (!file){
+				return nullptr;
+			}
+			string serialized((istreambuf_iterator<char>(file)), istreambuf_iterator<char>());
+			file.close();
+			hs_database_t* db = nullptr;
+			error_code ec;
+			if (hs_deserialize_database(serialized.data(), serialized.size(), &db) != HS_SUCCESS){
+				cerr << "[warning] [HsDatabaseCache.load] invalid cache entry " << key << ", removing it" << endl;
+				filesystem::remove(path, ec);
+				return nullptr;
+			}
+			// The modification time is used to prune the least recently used entries
+			filesystem::last_write_time(path, filesystem::file_time_type::clock::now(), ec);
+			return db;
+		}
+
+		void store(const string& key, const hs_database_t* db){
+			if (!enabled()){
+				return;
+			}
+			char* serialized = nullptr;
+			size_t serialized_size = 0;
+			if (hs_serialize_database(db, &serialized, &serialized_size) != HS_SUCCESS){
+				cerr << "[warning] [HsDatabaseCache.store] failed to serialize the database, skipping..." << endl;
+				return;
+			}
+			error_code ec;
+			filesystem::create_directories(cache_dir, ec);
+			string path = entry_path(key);
+			// Written on a temporary file and renamed: a concurrent load never reads a partial database
+			string tmp_path = path + ".tmp" + to_string(getpid()) + "_" + to_string(hash<thread::id>{}(this_thread::get_id()));
+			{
+				ofstream file(tmp_path, ios::binary | ios::trunc);
+				file.write(serialized, serialized_size);
+				if (!file){
+					cerr << "[warning] [HsDatabaseCache.store] failed to write " << tmp_path << ", skipping..." << endl;
+				}
+			}
+			free(serialized);
+			filesystem::rename(tmp_path, path, ec);
+			if (ec){
+				filesystem::remove(tmp_path, ec);
+				return;
+			}
+			prune();
+		}
+};
+
+HsDatabaseCache hs_db_cache;
+
+}}
+#endif // REGEX_DB_CACHE_CPP
@@ -8,6 +8,10 @@
 #include <vector>
 #include <hs.h>
 #include <memory>
+#include <atomic>
+#include <future>
+#include <mutex>
+#include "db_cache.cpp"
 
 using namespace std;
 
@@ -25,6 +29,7 @@ struct decoded_regex {
 struct regex_ruleset {
 	hs_database_t* hs_db = nullptr;
 	vector<string> regexes;
+	vector<uint32_t> rule_indexes; // Position of each regex in the raw rules list
 };
 
 decoded_regex decode_regex(string regex){
@@ -55,6 +60,33 @@ decoded_regex decode_regex(string regex){
 	return ruleset;
 }
 
+/*
+Versions of the configurations that are not referenced anymore (neither active nor pinned by a stream).
+They are collected only if enabled: the binary stats protocol reports them to the backend (see stats.cpp)
+*/
+struct retired_versions_list {
+	mutex mut;
+	vector<uint16_t> versions;
+	bool enabled = false;
+
+	void push(uint16_t version){
+		if (!enabled || version == 0){
+			return;
+		}
+		lock_guard<mutex> lock(mut);
+		versions.push_back(version);
+	}
+
+	vector<uint16_t> take(){
+		vector<uint16_t> taken;
+		lock_guard<mutex> lock(mut);
+		taken.swap(versions);
+		return taken;
+	}
+};
+
+retired_versions_list retired_versions;
+
 class RegexRules{
 	public:
 		regex_ruleset output_ruleset, input_ruleset;
@@ -83,6 +115,8 @@ class RegexRules{
 		uint16_t version;
 		vector<pair<string, decoded_regex>> decoded_input_rules;
 		vector<pair<string, decoded_regex>> decoded_output_rules;
+		vector<uint32_t> input_rule_indexes;
+		vector<uint32_t> output_rule_indexes;
 		bool is_stream = true;
 
 		void free_dbs(){
@@ -96,7 +130,7 @@ class RegexRules{
 			}
 		}
 		
-		void fill_ruleset(vector<pair<string, decoded_regex>> & decoded, regex_ruleset & ruleset){
+		void fill_ruleset(vector<pair<string, decoded_regex>> & decoded, vector<uint32_t> & indexes, regex_ruleset & ruleset){
 			size_t n_of_regex = decoded.size();
 			if (n_of_regex == 0){
 				return;
@@ -121,47 +155,71 @@ class RegexRules{
 				cerr << "[DEBUG] [RegexRules.fill_ruleset] regex_array_ids[" << i << "]: " << regex_array_ids[i] << endl;
 			}
 			#endif
-			hs_database_t* rebuilt_db = nullptr;
-			hs_compile_error_t *compile_err = nullptr;
-			if (
-				hs_compile_multi(
-					regex_match_rules.data(),
-					regex_flags.data(),
-					regex_array_ids.data(),
-					n_of_regex,
-					is_stream?HS_MODE_STREAM:HS_MODE_BLOCK,
-					nullptr, &rebuilt_db, &compile_err
-				) != HS_SUCCESS
-			) {
-				cerr << "[warning] [RegexRules.fill_ruleset] hs_db failed to compile: '" << compile_err->message << "' skipping..." << endl;
-				hs_free_compile_error(compile_err);
-				throw runtime_error( "Failed to compile hyperscan db" );
+			unsigned int mode = is_stream?HS_MODE_STREAM:HS_MODE_BLOCK;
+			string cache_key = HsDatabaseCache::ruleset_key(regex_match_rules, regex_flags, mode);
+			hs_database_t* rebuilt_db = hs_db_cache.load(cache_key);
+			if (rebuilt_db == nullptr){
+				hs_compile_error_t *compile_err = nullptr;
+				if (
+					hs_compile_multi(
+						regex_match_rules.data(),
+						regex_flags.data(),
+						regex_array_ids.data(),
+						n_of_regex,
+						mode,
+						nullptr, &rebuilt_db, &compile_err
+					) != HS_SUCCESS
+				) {
+					cerr << "[warning] [RegexRules.fill_ruleset] hs_db failed to compile: '" << compile_err->message << "' skipping..." << endl;
+					hs_free_compile_error(compile_err);
+					throw runtime_error( "Failed to compile hyperscan db" );
+				}
+				hs_db_cache.store(cache_key, rebuilt_db);
 			}
+			#ifdef DEBUG
+			else{
+				cerr << "[DEBUG] [RegexRules.fill_ruleset] loaded " << n_of_regex << " regexes from cache " << cache_key << endl;
+			}
+			#endif
 			ruleset.hs_db = rebuilt_db;
 			ruleset.regexes = vector<string>(n_of_regex);
 			for(int i = 0; i < n_of_regex; i++){
 				ruleset.regexes[i] = decoded[i].first;
 			}
+			ruleset.rule_indexes = indexes;
 		}
 
 	public:
 		RegexRules(vector<string> raw_rules, bool is_stream){
 			this->is_stream = is_stream;
-			for(string ele : raw_rules){
+			for(uint32_t i = 0; i < raw_rules.size(); i++){
+				const string& ele = raw_rules[i];
 				try{
 					decoded_regex rule = decode_regex(ele);
 					if (rule.direction == FilterDirection::CTOS){
 						decoded_input_rules.push_back(make_pair(ele, rule));
+						input_rule_indexes.push_back(i);
 					}else{
 						decoded_output_rules.push_back(make_pair(ele, rule));
+						output_rule_indexes.push_back(i);
 					}
 				}catch(...){
 					throw current_exception();
 				}
 			}
-			fill_ruleset(decoded_input_rules, input_ruleset);
+			// The two directions are independent databases: they are built in parallel
+			auto input_build = async(launch::async, [this](){
+				fill_ruleset(decoded_input_rules, input_rule_indexes, input_ruleset);
+			});
 			try{
-				fill_ruleset(decoded_output_rules, output_ruleset);
+				fill_ruleset(decoded_output_rules, output_rule_indexes, output_ruleset);
+			}catch(...){
+				try{ input_build.get(); }catch(...){}
+				free_dbs();
+				throw current_exception();
+			}
+			try{
+				input_build.get();
 			}catch(...){
 				free_dbs();
 				throw current_exception();
@@ -173,10 +231,7 @@ class RegexRules{
 			return version;
 		}
 
-		RegexRules(bool is_stream){
-			vector<string> no_rules;
-			RegexRules(no_rules, is_stream);
-		}
+		RegexRules(bool is_stream): RegexRules(vector<string>(), is_stream){}
 
 		bool stream_mode(){
 			return is_stream;
@@ -184,19 +239,20 @@ class RegexRules{
 
 
 
-		RegexRules(){
-			RegexRules(true);
-		}
+		RegexRules(): RegexRules(true){}
 		
 		~RegexRules(){
 			free_dbs();
+			retired_versions.push(version);
 		}
 };
 
-shared_ptr<RegexRules> regex_config;
+// Replaced by the updater thread once a new config is ready, workers keep using the previous one until then
+atomic<shared_ptr<RegexRules>> regex_config;
 
+// Allocates the scratch, or grows an existing one: it stays valid for the databases it was already used with
 void inline scratch_setup(regex_ruleset &conf, hs_scratch_t* & scratch){
-	if (scratch == nullptr && conf.hs_db != nullptr){
+	if (conf.hs_db != nullptr){
 		if (hs_alloc_scratch(conf.hs_db, &scratch) != HS_SUCCESS) {
 			throw invalid_argument("Cannot alloc scratch");
 		}
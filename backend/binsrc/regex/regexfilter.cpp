@@ -17,9 +17,11 @@
 #include <syncstream>
 #include <functional>
 #include <iostream>
+#include <string_view>
 #include "../classes/netfilter.cpp"
 #include "stream_ctx.cpp"
 #include "regex_rules.cpp"
+#include "stats.cpp"
 #include "../utils.cpp"
 
 using namespace std;
@@ -31,6 +33,13 @@ namespace Regex {
 using Tins::TCPIP::Stream;
 using Tins::TCPIP::StreamFollower;
 
+/*
+If enabled, after a config update the open TCP streams keep scanning with the config generation they were
+opened with (so their hyperscan stream state is preserved), while new streams use the new one.
+A generation is freed when the last stream pinning it is closed. Otherwise all the streams are reset.
+*/
+bool pin_stream_generations = true;
+
 class RegexNfQueue : public NfQueue::ThreadNfQueue<RegexNfQueue> {
 public:
 	stream_ctx sctx;
@@ -38,22 +47,19 @@ public:
 	StreamFollower follower;
 	NfQueue::PktRequest<RegexNfQueue>* pkt;
 
-	bool filter_action(NfQueue::PktRequest<RegexNfQueue>* pkt, const string& data){
-		shared_ptr<RegexRules> conf = regex_config;
+	bool filter_action(NfQueue::PktRequest<RegexNfQueue>* pkt, string_view data){
+		shared_ptr<RegexRules> conf = regex_config.load();
 
 		auto current_version = conf->ver();
 		if (current_version != latest_config_ver){
-			sctx.clean();
+			if (!pin_stream_generations){
+				sctx.clean();
+			}
+			scratch_setup(conf->input_ruleset, sctx.in_scratch);
+			scratch_setup(conf->output_ruleset, sctx.out_scratch);
 			latest_config_ver = current_version;
 		}
-		scratch_setup(conf->input_ruleset, sctx.in_scratch);
-		scratch_setup(conf->output_ruleset, sctx.out_scratch);
-	
-		hs_database_t* regex_matcher = pkt->is_input ? conf->input_ruleset.hs_db : conf->output_ruleset.hs_db;
-		if (regex_matcher == nullptr){
-			return true;
-		}
-		
+
 		struct matched_data{
 			unsigned int matched = 0;
 			bool has_matched = false;
@@ -68,33 +74,51 @@ public:
 			return -1; // Stop matching
 		};
 		hs_stream_t* stream_match;
+		bool keep_stream = false; // Only the TCP streams are kept between packets
 		if (conf->stream_mode()){
 			matching_map* match_map = pkt->is_input ? &sctx.in_hs_streams : &sctx.out_hs_streams;
 			auto stream_search = match_map->find(pkt->sid);
 			
 			if (stream_search == match_map->end()){
+				// A connection keeps the generation it was opened with, also for the direction that sends data later
+				if (pin_stream_generations && pkt->l4_proto == NfQueue::L4Proto::TCP){
+					shared_ptr<RegexRules> pinned = sctx.pinned_rules(pkt->sid, pkt->is_input);
+					if (pinned != nullptr){
+						conf = pinned;
+					}
+				}
+				hs_database_t* regex_matcher = pkt->is_input ? conf->input_ruleset.hs_db : conf->output_ruleset.hs_db;
+				if (regex_matcher == nullptr){
+					return true;
+				}
 				if (hs_open_stream(regex_matcher, 0, &stream_match) != HS_SUCCESS) {
 					cerr << "[error] [filter_callback] Error opening the stream matcher (hs)" << endl;
 					throw invalid_argument("Cannot open stream match on hyperscan");
 				}
 				if (pkt->l4_proto == NfQueue::L4Proto::TCP){
-					match_map->insert_or_assign(pkt->sid, stream_match);
+					keep_stream = sctx.track_stream(pkt->sid, pkt->is_input, pinned_stream{ stream: stream_match, rules: conf });
 				}
 			}else{
-				stream_match = stream_search->second;
+				stream_match = stream_search->second.stream;
+				conf = stream_search->second.rules;
+				keep_stream = true;
 			}
 			err = hs_scan_stream(
-				stream_match, data.c_str(), data.size(),
+				stream_match, data.data(), data.size(),
 				0, scratch_space, match_func, &match_res
 			);
 		}else{
+			hs_database_t* regex_matcher = pkt->is_input ? conf->input_ruleset.hs_db : conf->output_ruleset.hs_db;
+			if (regex_matcher == nullptr){
+				return true;
+			}
 			err = hs_scan(
-				regex_matcher, data.c_str(), data.size(),
+				regex_matcher, data.data(), data.size(),
 				0, scratch_space, match_func, &match_res
 			);
 		}
 		if (
-			pkt->l4_proto != NfQueue::L4Proto::TCP && conf->stream_mode() && 
+			conf->stream_mode() && !keep_stream &&
 			hs_close_stream(stream_match, scratch_space, nullptr, nullptr) != HS_SUCCESS
 		){
 			cerr << "[error] [filter_callback] Error closing the stream matcher (hs)" << endl;
@@ -105,8 +129,12 @@ public:
 			throw invalid_argument("Error while matching the stream with hyperscan");
 		}
 		if (match_res.has_matched){
-			auto& rules_vector = pkt->is_input ? conf->input_ruleset.regexes : conf->output_ruleset.regexes;
-			osyncstream(cout) << "BLOCKED " << rules_vector[match_res.matched] << endl;
+			// Reported with the generation that matched: the rule indexes refer to its config line
+			auto& ruleset = pkt->is_input ? conf->input_ruleset : conf->output_ruleset;
+			blocked_stats.add(
+				conf->ver(), pkt->is_input ? CTOS : STOC,
+				ruleset.rule_indexes[match_res.matched], ruleset.regexes[match_res.matched]
+			);
 			return false;
 		}
 		return true;
@@ -117,7 +145,7 @@ public:
         nfq->pkt->reject(); // This is needed because the callback has to take the updated pkt pointer!
 	}
 
-	static void on_data_recv(Stream& stream, RegexNfQueue* nfq, const string& data) {
+	static void on_data_recv(Stream& stream, RegexNfQueue* nfq, string_view data) {
 		if (!nfq->filter_action(nfq->pkt, data)){
 			nfq->sctx.clean_stream_by_id(nfq->pkt->sid);
 			stream.client_data_callback(bind(keep_fin_packet, nfq));
@@ -128,14 +156,14 @@ public:
 
 	//Input data filtering
 	static void on_client_data(Stream& stream, RegexNfQueue* nfq) {
-		auto data = stream.client_payload();
-		on_data_recv(stream, nfq, string((char*)data.data(), data.size()));
+		auto& data = stream.client_payload();
+		on_data_recv(stream, nfq, string_view((const char*)data.data(), data.size()));
 	}
 
 	//Server data filtering
 	static void on_server_data(Stream& stream, RegexNfQueue* nfq) {
-		auto data = stream.server_payload();
-		on_data_recv(stream, nfq, string((char*)data.data(), data.size()));
+		auto& data = stream.server_payload();
+		on_data_recv(stream, nfq, string_view((const char*)data.data(), data.size()));
 	}
 
 	// A stream was terminated. The second argument is the reason why it was terminated
@@ -156,23 +184,21 @@ public:
 
 	void handle_next_packet(NfQueue::PktRequest<RegexNfQueue>* _pkt) override{
         pkt = _pkt; // Setting packet context
-		if (pkt->tcp){
-			if (pkt->ipv4){
-				follower.process_packet(*pkt->ipv4);
-			}else{
-				follower.process_packet(*pkt->ipv6);
-			}
+		sctx.evict_idle();
+		if (pkt->l4_proto == NfQueue::L4Proto::TCP){
+			follower.process_packet(pkt->ip_pdu());
 			//Fallback to the default action
 			if (pkt->get_action() == NfQueue::FilterAction::NOACTION){
 				return pkt->accept();
 			}
 		}else{
-			if (!pkt->udp){
+			if (pkt->l4_proto != NfQueue::L4Proto::UDP){
 				throw invalid_argument("Only TCP and UDP are supported");
 			}
+			// Datagrams are matched in place, without building the libtins PDU tree
 			if(pkt->data_size() == 0){
 				return pkt->accept();
-			}else if (filter_action(pkt, string(pkt->data(), pkt->data_size()))){
+			}else if (filter_action(pkt, pkt->data_view())){
 				return pkt->accept();
 			}else{
 				return pkt->drop();
@@ -181,6 +207,9 @@ public:
 	}
 
 	void before_loop() override{
+		if (NfQueue::flow_table_settings.idle_timeout > 0){
+			follower.stream_keep_alive(chrono::seconds(NfQueue::flow_table_settings.idle_timeout));
+		}
 		follower.new_stream_callback(bind(on_new_stream, placeholders::_1, this));
 		follower.stream_termination_callback(bind(on_stream_close, placeholders::_1, this));
 	}
@@ -0,0 +1,139 @@
+#ifndef REGEX_STATS_CPP
+#define REGEX_STATS_CPP
+
+#include <iostream>
+#include <syncstream>
+#include <string>
+#include <cstring>
+#include <cstdint>
+#include <endian.h>
+#include <mutex>
+#include <thread>
+#include <chrono>
+#include <unordered_map>
+#include <vector>
+#include "regex_rules.cpp"
+
+using namespace std;
+
+namespace Firegex {
+namespace Regex {
+
+/*
+Binary stats protocol (FIREGEX_STATS_PROTOCOL=binary), written on stdout together with the text lines (QUEUE, ACK):
+	uint8  magic = 0x00 (a text line never starts with a NUL byte)
+	uint32 payload size
+	payload: a list of blocked_event_record
+All the integers are little endian. Blocked packets are aggregated per rule and flushed every
+FIREGEX_STATS_FLUSH_MS milliseconds, so a flood of matching packets costs a single frame per time slice.
+After the frame a "RETIRED <version>" line is written for each config version that is not used anymore
+(see retired_versions in regex_rules.cpp): no event of that version can follow, so the backend can forget it.
+Otherwise the text protocol is used: a "BLOCKED <rule>" line is written for each blocked packet.
+*/
+
+#pragma pack(push, 1)
+struct blocked_event_record {
+	uint32_t rule_index; // Position of the rule in the config line that generated the config version
+	uint16_t version; // Config version, sent back to the backend with "ACK OK <version>"
+	uint8_t direction; // FilterDirection
+	uint8_t padding = 0;
+	uint32_t count; // Blocked packets in the time slice
+	uint64_t timestamp; // Time slice start (ms since epoch)
+};
+#pragma pack(pop)
+
+static_assert(sizeof(blocked_event_record) == 20, "blocked_event_record must be packed");
+
+const char EVENTS_FRAME_MAGIC = 0x00;
+
+class BlockedStats {
+	private:
+		mutex mut;
+		unordered_map<uint64_t, uint32_t> counters;
+		uint64_t slice_start = 0;
+
+		static uint64_t now_ms(){
+			return chrono::duration_cast<chrono::milliseconds>(
+				chrono::system_clock::now().time_since_epoch()
+			).count();
+		}
+
+		static inline uint64_t counter_key(uint16_t version, FilterDirection direction, uint32_t rule_index){
+			return (uint64_t(version) << 40) | (uint64_t(direction) << 32) | rule_index;
+		}
+
+	public:
+		bool binary_mode = false;
+		unsigned int flush_interval_ms = 100;
+
+		void add(uint16_t version, FilterDirection direction, uint32_t rule_index, const string& rule){
+			if (!binary_mode){
+				osyncstream(cout) << "BLOCKED " << rule << endl;
+				return;
+			}
+			lock_guard<mutex> lock(mut);
+			if (counters.empty()){
+				slice_start = now_ms();
+			}
+			counters[counter_key(version, direction, rule_index)]++;
+		}
+
+		void flush(){
+			unordered_map<uint64_t, uint32_t> pending;
+			uint64_t pending_slice;
+			// Taken before the counters: all the events of a retired version were added before its retirement
+			vector<uint16_t> retired = retired_versions.take();
+			{
+				lock_guard<mutex> lock(mut);
+				pending.swap(counters);
+				pending_slice = slice_start;
+			}
+			if (pending.empty() && retired.empty()){
+				return;
+			}
+			osyncstream out(cout);
+			if (!pending.empty()){
+				uint32_t payload_size = pending.size() * sizeof(blocked_event_record);
+				string frame(1 + sizeof(uint32_t) + payload_size, '\0');
+				frame[0] = EVENTS_FRAME_MAGIC;
+				uint32_t le_payload_size = htole32(payload_size);
+				memcpy(frame.data() + 1, &le_payload_size, sizeof(uint32_t));
+				char* records = frame.data() + 1 + sizeof(uint32_t);
+				for (auto& [key, count] : pending){
+					blocked_event_record record{
+						rule_index: htole32(uint32_t(key & 0xffffffff)),
+						version: htole16(uint16_t(key >> 40)),
+						direction: uint8_t((key >> 32) & 0xff),
+						padding: 0,
+						count: htole32(count),
+						timestamp: htole64(pending_slice)
+					};
+					memcpy(records, &record, sizeof(blocked_event_record));
+					records += sizeof(blocked_event_record);
+				}
+				out.write(frame.data(), frame.size());
+			}
+			for (uint16_t version : retired){
+				out << "RETIRED " << version << "\n";
+			}
+			out << std::flush;
+		}
+
+		void run_flusher(){
+			if (!binary_mode){
+				return;
+			}
+			retired_versions.enabled = true;
+			thread([this](){
+				for(;;){
+					this_thread::sleep_for(chrono::milliseconds(flush_interval_ms));
+					flush();
+				}
+			}).detach();
+		}
+};
+
+BlockedStats blocked_stats;
+
+}}
+#endif // REGEX_STATS_CPP
@@ -6,8 +6,9 @@
 #include <hs.h>
 #include <tins/tcp_ip/stream_identifier.h>
 #include <functional>
-#include <map>
-#include "regexfilter.cpp"
+#include <memory>
+#include "../classes/nfqueue.cpp"
+#include "regex_rules.cpp"
 
 using namespace std;
 
@@ -15,7 +16,13 @@ namespace Firegex {
 namespace Regex {
 
 typedef Tins::TCPIP::StreamIdentifier stream_id;
-typedef map<stream_id, hs_stream_t*> matching_map;
+
+struct pinned_stream {
+	hs_stream_t* stream;
+	shared_ptr<RegexRules> rules; // Config generation the stream was opened with, released when the stream is closed
+};
+
+typedef NfQueue::stream_table<pinned_stream> matching_map;
 
 ostream& operator<<(ostream& os, const Tins::TCPIP::StreamIdentifier::address_type &sid){
 	bool first_print = false;
@@ -50,11 +57,35 @@ struct stream_ctx {
 		}
 	}
 
+	static void close_stream(hs_stream_t* stream, hs_scratch_t* scratch){
+		if (hs_close_stream(stream, scratch, nullptr, nullptr) != HS_SUCCESS) {
+			cerr << "[error] [NetfilterQueue.close_stream] Error closing the stream matcher (hs)" << endl;
+			throw invalid_argument("Cannot close stream match on hyperscan");
+		}
+	}
+
+	// Frees the streams without packets for FIREGEX_FLOW_IDLE_TIMEOUT seconds, a few slots at a time
+	void evict_idle(){
+		auto timeout = NfQueue::flow_table_settings.idle_timeout;
+		in_hs_streams.evict_idle(timeout, NfQueue::FLOW_SWEEP_STEP, [this](auto& ele){ close_stream(ele.second.stream, in_scratch); });
+		out_hs_streams.evict_idle(timeout, NfQueue::FLOW_SWEEP_STEP, [this](auto& ele){ close_stream(ele.second.stream, out_scratch); });
+	}
+
+	// Tracks a new stream: if the table is full the least recently used stream of the same direction is evicted
+	bool track_stream(stream_id sid, bool is_input, pinned_stream stream){
+		matching_map& match_map = is_input ? in_hs_streams : out_hs_streams;
+		hs_scratch_t* scratch = is_input ? in_scratch : out_scratch;
+		if (match_map.full()){
+			match_map.evict_oldest(NfQueue::FLOW_EVICT_SAMPLES, [scratch](auto& ele){ close_stream(ele.second.stream, scratch); });
+		}
+		return match_map.insert_or_assign(sid, stream);
+	}
+
 	void clean_stream_by_id(stream_id sid){
 		auto stream_search = in_hs_streams.find(sid);
 		hs_stream_t* stream_match;
 		if (stream_search != in_hs_streams.end()){
-			stream_match = stream_search->second;
+			stream_match = stream_search->second.stream;
 			if (hs_close_stream(stream_match, in_scratch, nullptr, nullptr) != HS_SUCCESS) {
                 cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
                 throw invalid_argument("Cannot close stream match on hyperscan");
@@ -64,7 +95,7 @@ struct stream_ctx {
 
 		stream_search = out_hs_streams.find(sid);
 		if (stream_search != out_hs_streams.end()){
-			stream_match = stream_search->second;
+			stream_match = stream_search->second.stream;
 			if (hs_close_stream(stream_match, out_scratch, nullptr, nullptr) != HS_SUCCESS) {
                 cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
                 throw invalid_argument("Cannot close stream match on hyperscan");
@@ -73,10 +104,20 @@ struct stream_ctx {
 		}
 	}
 
+	// Generation already pinned by the other direction of the same connection
+	shared_ptr<RegexRules> pinned_rules(stream_id sid, bool is_input){
+		matching_map& other_map = is_input ? out_hs_streams : in_hs_streams;
+		auto stream_search = other_map.find(sid);
+		if (stream_search != other_map.end()){
+			return stream_search->second.rules;
+		}
+		return nullptr;
+	}
+
 	void clean(){
 		if (in_scratch){
-			for(auto ele: in_hs_streams){
-				if (hs_close_stream(ele.second, in_scratch, nullptr, nullptr) != HS_SUCCESS) {
+			for(auto& ele: in_hs_streams){
+				if (hs_close_stream(ele.second.stream, in_scratch, nullptr, nullptr) != HS_SUCCESS) {
 					cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
 					throw invalid_argument("Cannot close stream match on hyperscan");
 				}
@@ -85,8 +126,8 @@ struct stream_ctx {
 		}
 		
 		if (out_scratch){
-			for(auto ele: out_hs_streams){
-				if (hs_close_stream(ele.second, out_scratch, nullptr, nullptr) != HS_SUCCESS) {
+			for(auto& ele: out_hs_streams){
+				if (hs_close_stream(ele.second.stream, out_scratch, nullptr, nullptr) != HS_SUCCESS) {
 					cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
 					throw invalid_argument("Cannot close stream match on hyperscan");
 				}
@@ -7,6 +7,13 @@
 #include <condition_variable>
 #include <sys/socket.h>
 #include <sys/un.h>
+#include <poll.h>
+#include <atomic>
+#include <thread>
+#include <algorithm>
+#include <mutex>
+#include <sys/syscall.h>
+#include <linux/futex.h>
 #include <stdexcept>
 #include <cstring>
 #include <iostream>
@@ -136,15 +143,21 @@ public:
 };
 
 
-#ifdef USE_PIPES_FOR_BLOKING_QUEUE
+/*
+Queues used to hand off the packets from the nfqueue readers to the workers (BlockingQueue), selected at build time:
+USE_PIPES_FOR_BLOKING_QUEUE - PipeBlockingQueue, the pointers are written in a pipe
+USE_RING_FOR_BLOCKING_QUEUE - RingBlockingQueue, lock free ring buffers with spin-then-futex waiting
+otherwise MutexBlockingQueue, a std::queue with mutex and condition variables
+See bench/queue_bench.cpp to compare them.
+*/
 
 template<typename T>
-class BlockingQueue
+class PipeBlockingQueue
 {
 private:
       int pipefd[2];
 public:
-   BlockingQueue(){
+   PipeBlockingQueue(){
       if (pipe(pipefd) == -1) {
          throw std::runtime_error("pipe");
       }
@@ -162,19 +175,22 @@ public:
             throw std::runtime_error("read");
         }
     }
+    bool empty()
+    {
+        pollfd pfd = { fd: pipefd[0], events: POLLIN, revents: 0 };
+        return poll(&pfd, 1, 0) <= 0;
+    }
 };
 
-#else
-
 template<typename T, int MAX = 1024> //same of kernel nfqueue max
-class BlockingQueue
+class MutexBlockingQueue
 {
 private:
     std::mutex mut;
     std::queue<T> private_std_queue;
     std::condition_variable condNotEmpty;
     std::condition_variable condNotFull;
-    size_t count; // Guard with Mutex
+    size_t count = 0; // Guard with Mutex
 public:
 
     void put(T new_value)
@@ -204,8 +220,207 @@ public:
         count--;
         condNotFull.notify_one();
     }
+    bool empty()
+    {
+        std::unique_lock<std::mutex> lk(mut);
+        return private_std_queue.empty();
+    }
+};
+
+inline void cpu_relax()
+{
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#elif defined(__aarch64__)
+    asm volatile("yield");
+#endif
+}
+
+inline void futex_wait(std::atomic<uint32_t>* addr, uint32_t expected)
+{
+    syscall(SYS_futex, reinterpret_cast<uint32_t*>(addr), FUTEX_WAIT_PRIVATE, expected, nullptr, nullptr, 0);
+}
+
+inline void futex_wake(std::atomic<uint32_t>* addr)
+{
+    syscall(SYS_futex, reinterpret_cast<uint32_t*>(addr), FUTEX_WAKE_PRIVATE, 1, nullptr, nullptr, 0);
+}
+
+// Bounded single producer single consumer ring buffer (SIZE must be a power of 2)
+template<typename T, size_t SIZE = 1024>
+class SpscRing
+{
+    static_assert((SIZE & (SIZE - 1)) == 0, "SIZE must be a power of 2");
+private:
+    // Producer and consumer indexes on different cache lines, each side caches the index of the other
+    alignas(64) std::atomic<size_t> head{0};
+    size_t cached_tail = 0;
+    alignas(64) std::atomic<size_t> tail{0};
+    size_t cached_head = 0;
+    alignas(64) T items[SIZE];
+public:
+    // Producer side
+    bool try_push(const T& value)
+    {
+        size_t t = tail.load(std::memory_order_relaxed);
+        if (t - cached_head == SIZE) {
+            cached_head = head.load(std::memory_order_acquire);
+            if (t - cached_head == SIZE) {
+                return false;
+            }
+        }
+        items[t & (SIZE - 1)] = value;
+        tail.store(t + 1, std::memory_order_release);
+        return true;
+    }
+    // Consumer side
+    bool try_pop(T& value)
+    {
+        size_t h = head.load(std::memory_order_relaxed);
+        if (h == cached_tail) {
+            cached_tail = tail.load(std::memory_order_acquire);
+            if (h == cached_tail) {
+                return false;
+            }
+        }
+        value = items[h & (SIZE - 1)];
+        head.store(h + 1, std::memory_order_release);
+        return true;
+    }
+    bool empty() const
+    {
+        return head.load(std::memory_order_acquire) == tail.load(std::memory_order_acquire);
+    }
+};
+
+// Index of the thread as a producer of the RingBlockingQueues
+inline size_t ring_producer_id()
+{
+    static std::atomic<size_t> next_id{0};
+    thread_local size_t id = next_id.fetch_add(1, std::memory_order_relaxed);
+    return id;
+}
+
+/*
+Single consumer queue made of a SpscRing for each producer thread (the rings are allocated by the producers
+at their first put). The consumer spins for a while on the rings, then sleeps on a futex: the spin budget grows
+when the packets arrive while spinning and shrinks when the consumer has to sleep.
+A producer waits (yielding) while its ring is full.
+*/
+template<typename T, size_t SIZE = 1024, size_t MAX_PRODUCERS = 256>
+class RingBlockingQueue
+{
+private:
+    std::atomic<SpscRing<T, SIZE>*> rings[MAX_PRODUCERS] = {};
+    std::atomic<size_t> n_rings{0};
+    size_t next_ring = 0;
+    unsigned int spin_budget = 1024;
+    alignas(64) std::atomic<uint32_t> signal{0};
+    std::atomic<bool> sleeping{false};
+
+    static constexpr unsigned int MIN_SPIN = 16;
+    static constexpr unsigned int MAX_SPIN = 16384;
+
+    SpscRing<T, SIZE>* producer_ring()
+    {
+        size_t id = ring_producer_id();
+        if (id >= MAX_PRODUCERS) {
+            throw std::runtime_error("too many producers for RingBlockingQueue");
+        }
+        SpscRing<T, SIZE>* ring = rings[id].load(std::memory_order_relaxed);
+        if (ring == nullptr) {
+            ring = new SpscRing<T, SIZE>();
+            rings[id].store(ring, std::memory_order_release);
+            size_t count = n_rings.load(std::memory_order_relaxed);
+            while (count < id + 1 && !n_rings.compare_exchange_weak(count, id + 1, std::memory_order_release)) {}
+        }
+        return ring;
+    }
+
+    bool try_take(T& value)
+    {
+        size_t count = n_rings.load(std::memory_order_acquire);
+        // Round robin between the producers
+        for (size_t i = 0; i < count; i++) {
+            size_t idx = (next_ring + i) % count;
+            SpscRing<T, SIZE>* ring = rings[idx].load(std::memory_order_acquire);
+            if (ring != nullptr && ring->try_pop(value)) {
+                next_ring = idx + 1;
+                return true;
+            }
+        }
+        return false;
+    }
+public:
+    ~RingBlockingQueue()
+    {
+        for (auto& ring : rings) {
+            delete ring.load();
+        }
+    }
+
+    void put(T new_value)
+    {
+        SpscRing<T, SIZE>* ring = producer_ring();
+        while (!ring->try_push(new_value)) {
+            std::this_thread::yield();
+        }
+        // Pairs with the fence of take: the consumer sees the new value or the producer sees it sleeping
+        std::atomic_thread_fence(std::memory_order_seq_cst);
+        // Only the first producer that sees it sleeping wakes it up
+        if (sleeping.load(std::memory_order_relaxed) && sleeping.exchange(false, std::memory_order_acq_rel)) {
+            signal.fetch_add(1, std::memory_order_release);
+            futex_wake(&signal);
+        }
+    }
+    void take(T& value)
+    {
+        // Spinning on a single CPU only delays the producer
+        static const unsigned int max_spin = std::thread::hardware_concurrency() > 1 ? MAX_SPIN : 0;
+        for (unsigned int i = 0; i < spin_budget; i++) {
+            if (try_take(value)) {
+                spin_budget = std::min(spin_budget * 2, max_spin);
+                return;
+            }
+            cpu_relax();
+        }
+        spin_budget = std::min(std::max(spin_budget / 2, MIN_SPIN), max_spin);
+        for (;;) {
+            uint32_t current_signal = signal.load(std::memory_order_acquire);
+            sleeping.store(true, std::memory_order_relaxed);
+            std::atomic_thread_fence(std::memory_order_seq_cst);
+            if (try_take(value)) {
+                sleeping.store(false, std::memory_order_relaxed);
+                return;
+            }
+            futex_wait(&signal, current_signal);
+            if (try_take(value)) {
+                return;
+            }
+        }
+    }
+    bool empty()
+    {
+        size_t count = n_rings.load(std::memory_order_acquire);
+        for (size_t i = 0; i < count; i++) {
+            SpscRing<T, SIZE>* ring = rings[i].load(std::memory_order_acquire);
+            if (ring != nullptr && !ring->empty()) {
+                return false;
+            }
+        }
+        return true;
+    }
 };
 
+#if defined(USE_PIPES_FOR_BLOKING_QUEUE)
+template<typename T>
+using BlockingQueue = PipeBlockingQueue<T>;
+#elif defined(USE_RING_FOR_BLOCKING_QUEUE)
+template<typename T>
+using BlockingQueue = RingBlockingQueue<T>;
+#else
+template<typename T>
+using BlockingQueue = MutexBlockingQueue<T>;
 #endif
 
 #endif // UTILS_CPP
\ No newline at end of file
@@ -6,7 +6,7 @@ import traceback
 from fastapi import HTTPException
 import time
 from utils import run_func
-from utils import nicenessify
+from utils import nicenessify, parse_flow_stats, FLOW_STATS_FIELDS, parse_gc_stats, GC_STATS_FIELDS
 
 nft = FiregexTables()
 
@@ -36,6 +36,8 @@ class FiregexInterceptor:
         self.expection_function = None
         self.outstrem_task: asyncio.Task
         self.outstrem_buffer = ""
+        self.flow_stats: dict[str, int] = dict.fromkeys(FLOW_STATS_FIELDS, 0)
+        self.gc_stats: dict[str, int] = dict.fromkeys(GC_STATS_FIELDS, 0)
     
     @classmethod
     async def start(cls, srv: Service, outstream_func=None, exception_func=None):
@@ -89,6 +91,9 @@ class FiregexInterceptor:
             stderr=asyncio.subprocess.STDOUT,
             env=dict(os.environ, **{
                 "NTHREADS": os.getenv("NTHREADS","1"),
+                "FIREGEX_NFQUEUE_RECV_BATCH": os.getenv("NFQUEUE_RECV_BATCH","16"),
+                "FIREGEX_NFQUEUE_VERDICT_BATCH": os.getenv("NFQUEUE_VERDICT_BATCH","32"),
+                "FIREGEX_NFQUEUE_VERDICT_FLUSH_US": os.getenv("NFQUEUE_VERDICT_FLUSH_US","200"),
                 "FIREGEX_NFQUEUE_FAIL_OPEN": "1" if self.srv.fail_open else "0",
                 "FIREGEX_NFPROXY_SOCK": self.sock_path
             }),
@@ -105,7 +110,7 @@ class FiregexInterceptor:
         line = line_fut.decode()
         if line.startswith("QUEUE "):
             params = line.split()
-            return (int(params[1]), int(params[1]))
+            return (int(params[1]), int(params[-1]))
         else:
             self.process.kill()
             raise Exception("Invalid binary output")
@@ -144,6 +149,10 @@ class FiregexInterceptor:
                         if filter_name in self.filter_map:
                             self.filter_map[filter_name].edited_packets+=1
                             await self.filter_map[filter_name].update()
+                if line.startswith("FLOWS "):
+                    self.flow_stats = parse_flow_stats(line)
+                if line.startswith("GC "):
+                    self.gc_stats = parse_gc_stats(line)
                 if line.startswith("EXCEPTION"):
                     self.last_time_exception = int(time.time()*1000) #ms timestamp
                     if self.expection_function:
@@ -94,6 +94,10 @@ class FiregexTables(NFTableManager):
         init, end = queue_range
         if init > end:
             init, end = end, init
+        # A queue for each worker: the kernel spreads the packets on the range by CPU (fanout),
+        # the binary sends every flow to the worker that owns it
+        queue_stmt = {"queue": {"num": str(init), "flags": ["bypass"]}} if init == end else \
+            {"queue": {"num": {"range":[init, end]}, "flags": ["bypass", "fanout"]}}
 
         self.cmd(
             { "insert":{ "rule": { # Send non-TLS outbound traffic to NFQUEUE (Client -> Server)
@@ -104,7 +108,7 @@ class FiregexTables(NFTableManager):
                         {'match': {'left': {'payload': {'protocol': ip_family(target_ip), 'field': 'saddr'}}, 'op': '==', 'right': nftables_int_to_json(target_ip)}},
                         {'match': {"left": { "payload": {"protocol": convert_protocol_to_l4(str(srv.proto)), "field": "dport"}}, "op": "==", "right": int(target_port)}},
                         {"mangle": {"key": {"meta": {"key": "mark"}},"value": 0x1338}},
-                        {"queue": {"num": str(init) if init == end else {"range":[init, end] }, "flags": ["bypass"]}}
+                        queue_stmt
                 ]
             }}},
             {"insert":{"rule":{ # Send non-TLS inbound traffic to NFQUEUE (Server -> Client)
@@ -115,7 +119,7 @@ class FiregexTables(NFTableManager):
                         {'match': {'left': {'payload': {'protocol': ip_family(target_ip), 'field': 'saddr'}}, 'op': '==', 'right': nftables_int_to_json(target_ip)}},
                         {'match': {"left": { "payload": {"protocol": convert_protocol_to_l4(str(srv.proto)), "field": "sport"}}, "op": "==", "right": int(target_port)}},
                         {"mangle": {"key": {"meta": {"key": "mark"}},"value": 0x1337}},
-                        {"queue": {"num": str(init) if init == end else {"range":[init, end] }, "flags": ["bypass"]}}
+                        queue_stmt
                     ]
             }}}
         )
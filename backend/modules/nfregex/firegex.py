@@ -3,13 +3,24 @@ from utils import run_func
 from modules.nfregex.models import Service, Regex
 import os
 import asyncio
+import struct
 import traceback
 from utils import DEBUG
 from fastapi import HTTPException
-from utils import nicenessify
+from utils import nicenessify, parse_flow_stats, FLOW_STATS_FIELDS
 
 nft = FiregexTables()
 
+# Binary stats protocol (see binsrc/regex/stats.cpp): a NUL byte (text lines can't start with it),
+# the payload size and a list of fixed-size records, each one with the blocked packets of a rule in a time slice
+EVENTS_FRAME_MAGIC = b"\x00"
+EVENTS_FRAME_HEADER = struct.Struct("<I")
+# rule index, config version, direction, counter delta, time slice start (ms)
+EVENTS_RECORD = struct.Struct("<IHBxIQ")
+# Config versions are forgotten when the binary reports them as RETIRED (streams opened before a reload
+# keep matching with the old version), this is only an upper bound
+MAX_TRACKED_CONFIG_VERSIONS = 256
+
 async def test_regex_validity(regex: str) -> bool:
     proxy_binary_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"../cppregex")
     process = await asyncio.create_subprocess_exec(
@@ -64,9 +75,9 @@ class RegexFilter:
         if self.output_mode:
             yield case_sensitive + "S" + self.regex.hex()
     
-    async def update(self):
+    async def update(self, count:int = 1):
         if self.update_func:
-            await run_func(self.update_func, self)
+            await run_func(self.update_func, self, count)
 
 class FiregexInterceptor:
     
@@ -78,6 +89,9 @@ class FiregexInterceptor:
         self.update_config_lock:asyncio.Lock
         self.process:asyncio.subprocess.Process
         self.update_task: asyncio.Task
+        self.sent_filter_codes: list[str] = []
+        self.config_versions: dict[int, list[str]] = {}
+        self.flow_stats: dict[str, int] = dict.fromkeys(FLOW_STATS_FIELDS, 0)
         self.ack_arrived = False
         self.ack_status = None
         self.ack_fail_what = "Queue response timed-out"
@@ -104,7 +118,13 @@ class FiregexInterceptor:
             env=dict(os.environ, **{
                 "MATCH_MODE": "stream" if self.srv.proto == "tcp" else "block",
                 "NTHREADS": os.getenv("NTHREADS","1"),
+                "FIREGEX_NFQUEUE_RECV_BATCH": os.getenv("NFQUEUE_RECV_BATCH","16"),
+                "FIREGEX_NFQUEUE_VERDICT_BATCH": os.getenv("NFQUEUE_VERDICT_BATCH","32"),
+                "FIREGEX_NFQUEUE_VERDICT_FLUSH_US": os.getenv("NFQUEUE_VERDICT_FLUSH_US","200"),
                 "FIREGEX_NFQUEUE_FAIL_OPEN": "1" if self.srv.fail_open else "0",
+                "FIREGEX_STATS_PROTOCOL": os.getenv("NFREGEX_STATS_PROTOCOL", "binary"),
+                "FIREGEX_HS_CACHE_DIR": os.getenv("NFREGEX_HS_CACHE_DIR", os.path.abspath("db/nfregex_cache")),
+                "FIREGEX_RELOAD_STREAMS": os.getenv("NFREGEX_RELOAD_STREAMS", "keep"),
             }),
         )
         nicenessify(-10, self.process.pid)
@@ -117,15 +137,43 @@ class FiregexInterceptor:
         line = line_fut.decode()
         if line.startswith("QUEUE "):
             params = line.split()
-            return (int(params[1]), int(params[1]))
+            return (int(params[1]), int(params[-1]))
         else:
             self.process.kill()
             raise Exception("Invalid binary output")
 
+    async def _blocked_events(self, payload:memoryview):
+        # filter_map_lock is not taken: reload holds it while waiting for an ACK that can be queued after this frame
+        for rule_index, version, _direction, count, _timestamp in EVENTS_RECORD.iter_unpack(payload):
+            filter_codes = self.config_versions.get(version)
+            if filter_codes is None or rule_index >= len(filter_codes):
+                continue
+            filter_obj = self.filter_map.get(filter_codes[rule_index])
+            if filter_obj is not None:
+                filter_obj.blocked += count
+                await filter_obj.update(count)
+
+    def _config_ack(self, params:list[str]):
+        self.ack_arrived = True
+        self.ack_status = params[1].upper() == "OK"
+        if not self.ack_status:
+            self.ack_fail_what = " ".join(params[2:])
+        elif len(params) > 2:
+            self.config_versions[int(params[2])] = self.sent_filter_codes
+            while len(self.config_versions) > MAX_TRACKED_CONFIG_VERSIONS:
+                del self.config_versions[next(iter(self.config_versions))]
+        self.ack_lock.release()
+
     async def update_blocked(self):
         try:
             while True:
-                line = (await self.process.stdout.readuntil()).decode()
+                head = await self.process.stdout.readexactly(1)
+                if head == EVENTS_FRAME_MAGIC:
+                    size, = EVENTS_FRAME_HEADER.unpack(await self.process.stdout.readexactly(EVENTS_FRAME_HEADER.size))
+                    payload = await self.process.stdout.readexactly(size)
+                    await self._blocked_events(memoryview(payload))
+                    continue
+                line = (head + await self.process.stdout.readuntil()).decode()
                 if DEBUG:
                     print(line)
                 if line.startswith("BLOCKED "):
@@ -135,11 +183,11 @@ class FiregexInterceptor:
                             self.filter_map[regex_id].blocked+=1
                             await self.filter_map[regex_id].update()
                 if line.startswith("ACK "):
-                    self.ack_arrived = True
-                    self.ack_status = line.split()[1].upper() == "OK"
-                    if not self.ack_status:
-                        self.ack_fail_what = " ".join(line.split()[2:])
-                    self.ack_lock.release()
+                    self._config_ack(line.split())
+                if line.startswith("FLOWS "):
+                    self.flow_stats = parse_flow_stats(line)
+                if line.startswith("RETIRED "):
+                    self.config_versions.pop(int(line.split()[1]), None)
         except asyncio.CancelledError:
             pass
         except asyncio.IncompleteReadError:
@@ -154,6 +202,7 @@ class FiregexInterceptor:
     
     async def _update_config(self, filters_codes):
         async with self.update_config_lock:
+            self.sent_filter_codes = filters_codes
             self.process.stdin.write((" ".join(filters_codes)+"\n").encode())
             await self.process.stdin.drain()
             try:
@@ -1,4 +1,5 @@
 import asyncio
+import os
 from modules.nfregex.firegex import FiregexInterceptor, RegexFilter
 from modules.nfregex.nftables import FiregexTables, FiregexFilter
 from modules.nfregex.models import Regex, Service
@@ -10,6 +11,10 @@ class STATUS:
 
 nft = FiregexTables()
 
+# Blocked packet counters are kept in memory and written to the db in a single
+# transaction every STATS_FLUSH_INTERVAL seconds or every STATS_FLUSH_THRESHOLD events
+STATS_FLUSH_INTERVAL = float(os.getenv("NFREGEX_STATS_FLUSH_INTERVAL", "1"))
+STATS_FLUSH_THRESHOLD = int(os.getenv("NFREGEX_STATS_FLUSH_THRESHOLD", "1000"))
 
 class ServiceManager:
     def __init__(self, srv: Service, db):
@@ -19,8 +24,13 @@ class ServiceManager:
         self.filters: dict[int, FiregexFilter] = {}
         self.lock = asyncio.Lock()
         self.interceptor = None
+        self.pending_stats: dict[int, int] = {}
+        self.pending_events = 0
+        self.stats_task: asyncio.Task = None
     
     async def _update_filters_from_db(self):
+        # New filters read their counters from the db, so pending ones must be written first
+        self._flush_stats()
         regexes = [
             Regex.from_dict(ele) for ele in
                 self.db.query("SELECT * FROM regexes WHERE service_id = ? AND active=1;", self.srv.id)
@@ -50,8 +60,29 @@ class ServiceManager:
             if to == STATUS.ACTIVE:
                 await self.restart()
 
-    def _stats_updater(self,filter:RegexFilter):
-        self.db.query("UPDATE regexes SET blocked_packets = ? WHERE regex_id = ?;", filter.blocked, filter.id)
+    def _stats_updater(self,filter:RegexFilter, count:int = 1):
+        self.pending_stats[filter.id] = self.pending_stats.get(filter.id, 0) + count
+        self.pending_events += count
+        if self.pending_events >= STATS_FLUSH_THRESHOLD:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        if not self.pending_stats:
+            return
+        pending, self.pending_stats = self.pending_stats, {}
+        self.pending_events = 0
+        self.db.queries([
+            ("UPDATE regexes SET blocked_packets = blocked_packets + ? WHERE regex_id = ?;", count, regex_id)
+            for regex_id, count in pending.items()
+        ])
+
+    async def _stats_flusher(self):
+        try:
+            while True:
+                await asyncio.sleep(STATS_FLUSH_INTERVAL)
+                self._flush_stats()
+        except asyncio.CancelledError:
+            pass
 
     def _set_status(self,status,persist:bool=True):
         self.status = status
@@ -62,6 +93,7 @@ class ServiceManager:
         if not self.interceptor:
             nft.delete(self.srv)
             self.interceptor = await FiregexInterceptor.start(self.srv)
+            self.stats_task = asyncio.create_task(self._stats_flusher())
             await self._update_filters_from_db()
             self._set_status(STATUS.ACTIVE)
 
@@ -70,6 +102,10 @@ class ServiceManager:
         if self.interceptor:
             await self.interceptor.stop()
             self.interceptor = None
+        if self.stats_task:
+            self.stats_task.cancel()
+            self.stats_task = None
+        self._flush_stats()
         self._set_status(STATUS.STOP,persist=persist)
     
     async def restart(self):
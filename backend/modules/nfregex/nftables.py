@@ -86,6 +86,10 @@ class FiregexTables(NFTableManager):
         init, end = queue_range
         if init > end:
             init, end = end, init
+        # A queue for each worker: the kernel spreads the packets on the range by CPU (fanout),
+        # the binary sends every flow to the worker that owns it
+        queue_stmt = {"queue": {"num": str(init), "flags": ["bypass"]}} if init == end else \
+            {"queue": {"num": {"range":[init, end]}, "flags": ["bypass", "fanout"]}}
 
         self.cmd(
             { "insert":{ "rule": {
@@ -96,7 +100,7 @@ class FiregexTables(NFTableManager):
                         {'match': {'left': {'payload': {'protocol': ip_family(target_ip), 'field': 'saddr'}}, 'op': '==', 'right': nftables_int_to_json(target_ip)}},
                         {'match': {"left": { "payload": {"protocol": str(srv.proto), "field": "sport"}}, "op": "==", "right": int(target_port)}},
                         {"mangle": {"key": {"meta": {"key": "mark"}},"value": 0x1338}},
-                        {"queue": {"num": str(init) if init == end else {"range":[init, end] }, "flags": ["bypass"]}}
+                        queue_stmt
                 ]
             }}},
             {"insert":{"rule":{
@@ -107,7 +111,7 @@ class FiregexTables(NFTableManager):
                         {'match': {'left': {'payload': {'protocol': ip_family(target_ip), 'field': 'daddr'}}, 'op': '==', 'right': nftables_int_to_json(target_ip)}},
                         {'match': {"left": { "payload": {"protocol": str(srv.proto), "field": "dport"}}, "op": "==", "right": int(target_port)}},
                         {"mangle": {"key": {"meta": {"key": "mark"}},"value": 0x1337}},
-                        {"queue": {"num": str(init) if init == end else {"range":[init, end] }, "flags": ["bypass"]}}
+                        queue_stmt
                     ]
             }}}
         )
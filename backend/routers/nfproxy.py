@@ -5,7 +5,7 @@ from pydantic import BaseModel
 from modules.nfproxy.nftables import FiregexTables
 from modules.nfproxy.firewall import STATUS, FirewallManager, ServiceNotFoundException
 from utils.sqlite import SQLite
-from utils import ip_parse, refactor_name, socketio_emit, PortType
+from utils import ip_parse, refactor_name, socketio_emit, PortType, flow_stats_metrics, gc_stats_metrics
 from modules.tls.service import activate_stream
 from utils.models import ResetRequest, StatusMessageModel
 import os
@@ -143,6 +143,18 @@ async def exception_func(service_id, timestamp):
 
 firewall = FirewallManager(db, outstream_func=outstream_func, exception_func=exception_func)
 
+@app.get('/metrics', response_class = PlainTextResponse)
+async def metrics():
+    """Flow tracking and python garbage collection metrics of the running services"""
+    metrics = []
+    def sanitize(s):
+        return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    for srv_manager in list(firewall.service_table.values()):
+        if srv_manager.interceptor:
+            metrics.extend(flow_stats_metrics("firegex_nfproxy", sanitize(srv_manager.srv.name), srv_manager.interceptor.flow_stats))
+            metrics.extend(gc_stats_metrics("firegex_nfproxy", sanitize(srv_manager.srv.name), srv_manager.interceptor.gc_stats))
+    return "\n".join(metrics)
+
 @app.get('/services', response_model=list[ServiceModel])
 async def get_service_list():
     """Get the list of existent firegex services"""
@@ -7,7 +7,7 @@ from pydantic import BaseModel
 from modules.nfregex.nftables import FiregexTables
 from modules.nfregex.firewall import STATUS, FirewallManager
 from utils.sqlite import SQLite
-from utils import ip_parse, refactor_name, socketio_emit, PortType
+from utils import ip_parse, refactor_name, socketio_emit, PortType, flow_stats_metrics
 from modules.tls.service import activate_stream
 from utils.models import ResetRequest, StatusMessageModel
 from modules.nfregex.firegex import test_regex_validity
@@ -404,6 +404,9 @@ async def metrics():
         props = f'service_name="{sanitize(stat["name"])}",regex="{sanitize(b64decode(stat["regex"]).decode())}",mode="{stat["mode"]}",is_case_sensitive="{stat["is_case_sensitive"]}"'
         metrics.append(f'firegex_blocked_packets{{{props}}} {stat["blocked_packets"]}')
         metrics.append(f'firegex_active{{{props}}} {int(stat["active"] and stat["status"] == "active")}')
+    for srv_manager in list(firewall.service_table.values()):
+        if srv_manager.interceptor:
+            metrics.extend(flow_stats_metrics("firegex", sanitize(srv_manager.srv.name), srv_manager.interceptor.flow_stats))
     return "\n".join(metrics)
 
 @app.get('/services/{service_id}/export')
@@ -137,6 +137,34 @@ async def run_func(func, *args, **kwargs):
 async def socketio_emit(elements:list[str]):
     await socketio.emit("update",elements)
 
+# Fields of the "FLOWS <tracked> <evicted idle> <evicted full>" reports sent by cppregex and cpproxy
+FLOW_STATS_FIELDS = ("tracked", "evicted_idle", "evicted_full")
+
+def parse_flow_stats(line:str) -> dict[str, int]:
+    return dict(zip(FLOW_STATS_FIELDS, map(int, line.split()[1:4])))
+
+def flow_stats_metrics(prefix:str, service_name:str, flow_stats:dict[str, int]) -> list[str]:
+    props = f'service_name="{service_name}"'
+    return [
+        f'{prefix}_tracked_flows{{{props}}} {flow_stats["tracked"]}',
+        f'{prefix}_evicted_flows{{{props},reason="idle"}} {flow_stats["evicted_idle"]}',
+        f'{prefix}_evicted_flows{{{props},reason="full"}} {flow_stats["evicted_full"]}',
+    ]
+
+GC_STATS_FIELDS = ("collections", "pause_us", "max_pause_us", "collected")
+
+def parse_gc_stats(line:str) -> dict[str, int]:
+    return dict(zip(GC_STATS_FIELDS, map(int, line.split()[1:5])))
+
+def gc_stats_metrics(prefix:str, service_name:str, gc_stats:dict[str, int]) -> list[str]:
+    props = f'service_name="{service_name}"'
+    return [
+        f'{prefix}_gc_collections_total{{{props}}} {gc_stats["collections"]}',
+        f'{prefix}_gc_pause_seconds_total{{{props}}} {gc_stats["pause_us"] / 1e6}',
+        f'{prefix}_gc_max_pause_seconds{{{props}}} {gc_stats["max_pause_us"] / 1e6}',
+        f'{prefix}_gc_collected_objects_total{{{props}}} {gc_stats["collected"]}',
+    ]
+
 def refactor_name(name:str):
     name = name.strip()
     while "  " in name:
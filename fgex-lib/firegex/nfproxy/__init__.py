@@ -14,12 +14,26 @@ ACCEPT = Action.ACCEPT
 DROP = Action.DROP
 REJECT = Action.REJECT
 UNSTABLE_MANGLE = Action.MANGLE
+ACCEPT_FLOW = Action.ACCEPT_FLOW
+ACCEPT_DIRECTION = Action.ACCEPT_DIRECTION
 
-def pyfilter(func):
+def pyfilter(func=None, *, prefilter: list[bytes]|None = None):
     """
     Decorator to mark functions that will be used in the proxy.
     Stores the function reference in a global registry.
+    prefilter is an optional list of literals: if all the enabled filters declare it,
+    a stream is handled by python only once one of the literals is found in it.
     """
+    if func is None:
+        return functools.partial(pyfilter, prefilter=prefilter)
+    
+    if prefilter is not None:
+        if isinstance(prefilter, bytes) or not all(isinstance(ele, bytes) and len(ele) > 0 for ele in prefilter):
+            raise Exception("Invalid prefilter: must be a list of non empty bytes")
+        prefilter = tuple(prefilter)
+        if len(prefilter) == 0:
+            raise Exception("Invalid prefilter: must be a list of non empty bytes")
+    
     if not hasattr(pyfilter, "registry"):
         pyfilter.registry = set()
     
@@ -29,6 +43,7 @@ def pyfilter(func):
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
     
+    wrapper.__firegex_prefilter__ = prefilter
     return wrapper
 
 def get_pyfilters():
@@ -43,7 +58,7 @@ def clear_pyfilter_registry():
         pyfilter.registry.clear()
 
 __all__ = [
-    "ACCEPT", "DROP", "REJECT", "UNSTABLE_MANGLE",
+    "ACCEPT", "DROP", "REJECT", "UNSTABLE_MANGLE", "ACCEPT_FLOW", "ACCEPT_DIRECTION",
     "Action", "FullStreamAction", "ExceptionAction", "pyfilter",
     "RawPacket", "TCPInputStream", "TCPOutputStream", "TCPClientStream", "TCPServerStream",
     "HttpHistory", "HttpStreamHistory"
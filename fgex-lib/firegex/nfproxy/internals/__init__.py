@@ -1,24 +1,18 @@
 from inspect import signature
-from firegex.nfproxy.internals.models import Action, FullStreamAction
-from firegex.nfproxy.internals.models import FilterHandler, PacketHandlerResult
+from firegex.nfproxy.internals.models import Action, FullStreamAction, ExceptionAction
+from firegex.nfproxy.internals.models import FilterHandler, FilterCall, DirectionPlan, ExecutionPlan, PacketHandlerResult
 import functools
+import dataclasses
+import itertools
+import sys
+import re
+import types
+from enum import Enum
 from firegex.nfproxy.internals.data import DataStreamCtx
 from firegex.nfproxy.internals.exceptions import NotReadyToRun, StreamFullReject, DropPacket, RejectConnection, StreamFullDrop
+from firegex.nfproxy.internals.exceptions import DecodeLimitDrop, DecodeLimitReject
 from firegex.nfproxy.internals.data import RawPacket
 
-def context_call(glob, func, *args, **kargs):
-    glob["__firegex_tmp_args"] = args
-    glob["__firegex_tmp_kargs"] = kargs
-    glob["__firege_tmp_call"] = func
-    res = eval("__firege_tmp_call(*__firegex_tmp_args, **__firegex_tmp_kargs)", glob, glob)
-    if "__firegex_tmp_args" in glob.keys():
-        del glob["__firegex_tmp_args"]
-    if "__firegex_tmp_kargs" in glob.keys():
-        del glob["__firegex_tmp_kargs"]
-    if "__firege_tmp_call" in glob.keys():
-        del glob["__firege_tmp_call"]
-    return res
-
 def generate_filter_structure(filters: list[str], proto:str, glob:dict) -> list[FilterHandler]:
     from firegex.nfproxy.models import type_annotations_associations
     if proto not in type_annotations_associations.keys():
@@ -42,7 +36,8 @@ def generate_filter_structure(filters: list[str], proto:str, glob:dict) -> list[
                 func=func,
                 name=func.__name__,
                 params=params_function,
-                proto=proto
+                proto=proto,
+                prefilter=getattr(func, "__firegex_prefilter__", None)
             )
         )
     
@@ -55,6 +50,84 @@ def generate_filter_structure(filters: list[str], proto:str, glob:dict) -> list[
             raise Exception(f"Filter {filter} not found")
     return res
 
+def _current_packet(internal_data: DataStreamCtx) -> RawPacket:
+    return internal_data.current_pkt
+
+def _callable_on(filter: FilterHandler, is_input: bool) -> bool:
+    from firegex.nfproxy.models import type_annotations_directions
+    # The filters with a param that is never fetched on a direction can't be called on it
+    return all(type_annotations_directions.get(data_type, is_input) == is_input for data_type in filter.params)
+
+def _build_direction_plan(filters: list[FilterHandler], is_input: bool, other_filters: list[FilterHandler]|None = None) -> DirectionPlan:
+    """
+    The plan of the filters that can be called on a direction; other_filters are the ones called on the other direction
+    (the same list if not given), that can need data handlers also on this direction (companions)
+    """
+    from firegex.nfproxy.models import type_annotations_dependencies, type_annotations_companions
+
+    companions = {}
+    for ele in (filters if other_filters is None else other_filters):
+        if _callable_on(ele, not is_input):
+            for data_type in ele.params:
+                if data_type in type_annotations_companions:
+                    companions.setdefault(type_annotations_companions[data_type], ele.name)
+
+    filters = [ele for ele in filters if _callable_on(ele, is_input)]
+    needed = {}
+    for ele in filters:
+        for data_type, data_func in ele.params.items():
+            needed.setdefault(data_type, _current_packet if data_type is RawPacket else data_func)
+
+    def dependencies(data_type: type) -> list[type]:
+        return [ele for ele in type_annotations_dependencies.get(data_type, ()) if ele in needed]
+
+    order: list[type] = []
+    def visit(data_type: type):
+        if data_type not in order:
+            for dep in dependencies(data_type):
+                visit(dep)
+            order.append(data_type)
+    for data_type in needed:
+        visit(data_type)
+    index = {data_type: i for i, data_type in enumerate(order)}
+
+    def fetch_closure(data_type: type, fetch: set):
+        fetch.add(index[data_type])
+        for dep in dependencies(data_type):
+            fetch_closure(dep, fetch)
+
+    calls = []
+    fetched = set()
+    for ele in filters:
+        fetch = set()
+        for data_type in ele.params:
+            fetch_closure(data_type, fetch)
+        fetch -= fetched # Already run for the filters before
+        fetched |= fetch
+        calls.append(FilterCall(
+            name=ele.name,
+            func=ele.func,
+            fetch=tuple(sorted(fetch)),
+            args=tuple(index[data_type] for data_type in ele.params),
+        ))
+    return DirectionPlan(
+        data_types=tuple(order),
+        fetchers=tuple(needed[data_type] for data_type in order),
+        filters=tuple(calls),
+        companions=tuple((name, func) for func, name in companions.items()),
+    )
+
+def build_execution_plan(filters: list[FilterHandler]) -> ExecutionPlan:
+    """
+    The filters as called for each packet, for each direction: the data handlers needed by the filters that
+    can be called on the direction, run at most once per packet in topological order, and the filters with
+    the data handlers they need
+    """
+    return ExecutionPlan(
+        input=_build_direction_plan(filters, True),
+        output=_build_direction_plan(filters, False),
+    )
+
 def get_filters_info(code:str, proto:str) -> list[FilterHandler]:
     glob = {}
     exec("import firegex.nfproxy", glob, glob)
@@ -70,64 +143,88 @@ def get_filters_info(code:str, proto:str) -> list[FilterHandler]:
 def get_filter_names(code:str, proto:str) -> list[str]:
     return [ele.name for ele in get_filters_info(code, proto)]    
 
-def handle_packet(glob: dict) -> None:
-    internal_data = DataStreamCtx(glob)
-    
-    cache_call = {} # Cache of the data handler calls
-    cache_call[RawPacket] = internal_data.current_pkt
+_FETCH_ERRORS = (StreamFullDrop, StreamFullReject, DecodeLimitDrop, DecodeLimitReject, DropPacket, RejectConnection)
+
+def _fetch_error_result(result: PacketHandlerResult, e: Exception, filter_name: str) -> PacketHandlerResult:
+    """Result of the packet when a data handler needed by filter_name raised one of _FETCH_ERRORS"""
+    match e:
+        case StreamFullDrop():
+            result.action = Action.DROP
+            result.matched_by = "@MAX_STREAM_SIZE_REACHED"
+        case StreamFullReject():
+            result.action = Action.REJECT
+            result.matched_by = "@MAX_STREAM_SIZE_REACHED"
+        case DecodeLimitDrop():
+            result.action = Action.DROP
+            result.matched_by = e.matched_by
+        case DecodeLimitReject():
+            result.action = Action.REJECT
+            result.matched_by = e.matched_by
+        case DropPacket():
+            result.action = Action.DROP
+            result.matched_by = filter_name
+        case RejectConnection():
+            result.action = Action.REJECT
+            result.matched_by = filter_name
+    return result
+
+def _run_filters(glob: dict, internal_data: DataStreamCtx) -> PacketHandlerResult:
+    plan = internal_data.filter_call_plan
+    plan = plan.input if internal_data.current_pkt.is_input else plan.output
+    fetchers = plan.fetchers
+    fetched = [None] * len(fetchers) # Results of the data handlers (None if not ready to run)
 
     result = PacketHandlerResult(glob)
+    accepted = [] # Filters that returned ACCEPT_FLOW or ACCEPT_DIRECTION
     
-    for filter in internal_data.filter_call_info:
-        final_params = []
+    if plan.companions:
+        finished = []
+        for name, companion in plan.companions:
+            try:
+                if companion(internal_data):
+                    finished.append(companion)
+            except NotReadyToRun:
+                pass
+            except _FETCH_ERRORS as e:
+                return _fetch_error_result(result, e, name)
+        if finished:
+            plan = dataclasses.replace(plan, companions=tuple(ele for ele in plan.companions if ele[1] not in finished))
+            if internal_data.current_pkt.is_input:
+                internal_data.filter_call_plan = dataclasses.replace(internal_data.filter_call_plan, input=plan)
+            else:
+                internal_data.filter_call_plan = dataclasses.replace(internal_data.filter_call_plan, output=plan)
+    
+    for filter in plan.filters:
+        for i in filter.fetch:
+            try:
+                fetched[i] = fetchers[i](internal_data)
+            except NotReadyToRun:
+                pass
+            except _FETCH_ERRORS as e:
+                return _fetch_error_result(result, e, filter.name)
+
+        final_params = [fetched[i] for i in filter.args]
         skip_call = False
-        for data_type, data_func in filter.params.items():
-            if data_type not in cache_call.keys():
-                try:
-                    cache_call[data_type] = data_func(internal_data)
-                except NotReadyToRun:
-                    cache_call[data_type] = None
-                    skip_call = True
-                    break
-                except StreamFullDrop:
-                    result.action = Action.DROP
-                    result.matched_by = "@MAX_STREAM_SIZE_REACHED"
-                    return result.set_result()
-                except StreamFullReject:
-                    result.action = Action.REJECT
-                    result.matched_by = "@MAX_STREAM_SIZE_REACHED"
-                    return result.set_result()
-                except DropPacket:
-                    result.action = Action.DROP
-                    result.matched_by = filter.name
-                    return result.set_result()
-                except RejectConnection:
-                    result.action = Action.REJECT
-                    result.matched_by = filter.name
-                    return result.set_result()
-            if cache_call[data_type] is None:
+        expand_call = False
+        for param in final_params:
+            if param is None:
                 skip_call = True
                 break
-            final_params.append(cache_call[data_type])
+            if isinstance(param, list):
+                expand_call = True
             
         if skip_call:
             continue
         
-        # Create an iterator with all the calls to be done
-        def try_to_call(params:list):
-            is_base_call = True
-            for i in range(len(params)):
-                if isinstance(params[i], list):
-                    new_params = params.copy()
-                    for ele in params[i]:
-                        new_params[i] = ele
-                        yield from try_to_call(new_params)
-                    is_base_call = False
-                    break
-            if is_base_call:
-                yield context_call(glob, filter.func, *params)
+        if expand_call:
+            # A list of data handlers: the filter is called for each combination of the elements
+            results = (filter.func(*params) for params in itertools.product(
+                *(ele if isinstance(ele, list) else (ele,) for ele in final_params)
+            ))
+        else:
+            results = (filter.func(*final_params),)
                     
-        for res in try_to_call(final_params):
+        for res in results:
             if res is None:
                 continue #ACCEPTED
             if not isinstance(res, Action):
@@ -136,13 +233,83 @@ def handle_packet(glob: dict) -> None:
                 result.matched_by = filter.name
                 result.mangled_packet = internal_data.current_pkt.raw_packet
                 result.action = Action.MANGLE
+            elif res == Action.ACCEPT_FLOW or res == Action.ACCEPT_DIRECTION:
+                accepted.append((filter.name, res))
+                break
             elif res != Action.ACCEPT:
                 result.matched_by = filter.name
                 result.action = res
                 result.mangled_packet = None
-                return result.set_result()
+                return result
+    
+    if accepted:
+        _accept_filters(internal_data, accepted)
+        plan = internal_data.filter_call_plan
+        plan = plan.input if internal_data.current_pkt.is_input else plan.output
+    
+    if result.action == Action.ACCEPT and not plan.filters and not plan.companions:
+        # Nothing is left on this direction: the C++ core stops sending its data (and drops the stream if both are done)
+        other_plan = internal_data.filter_call_plan
+        other_plan = other_plan.output if internal_data.current_pkt.is_input else other_plan.input
+        result.action = Action.ACCEPT_DIRECTION if other_plan.filters or other_plan.companions else Action.ACCEPT_FLOW
+    
+    return result # Will be MANGLE, ACCEPT, ACCEPT_DIRECTION or ACCEPT_FLOW
+
+
+def _accept_filters(internal_data: DataStreamCtx, accepted: list[tuple[str, Action]]) -> None:
+    """
+    Removes from the execution plan of the stream the filters that returned ACCEPT_DIRECTION (from the plan of the
+    direction of the packet) or ACCEPT_FLOW (from both): their data handlers (and companions on the other direction)
+    aren't run anymore if no other filter needs them
+    """
+    is_input = internal_data.current_pkt.is_input
+    on_direction = {name for name, _ in accepted}
+    on_flow = {name for name, res in accepted if res == Action.ACCEPT_FLOW}
+    
+    plan = internal_data.filter_call_plan
+    input_names = {ele.name for ele in plan.input.filters}
+    output_names = {ele.name for ele in plan.output.filters}
+    if not (input_names | output_names) & on_direction:
+        return
+    input_names -= on_direction if is_input else on_flow
+    output_names -= on_flow if is_input else on_direction
     
-    return result.set_result() # Will be MANGLE or ACCEPT
+    input_filters = [ele for ele in internal_data.filter_call_info if ele.name in input_names]
+    output_filters = [ele for ele in internal_data.filter_call_info if ele.name in output_names]
+    internal_data.filter_call_plan = ExecutionPlan(
+        input=_build_direction_plan(input_filters, True, output_filters),
+        output=_build_direction_plan(output_filters, False, input_filters),
+    )
+
+
+def handle_packet(glob: dict) -> None:
+    """Runs the filters on the packet in glob["__firegex_packet_info"], the result is saved in glob["__firegex_pyfilter_result"]"""
+    _run_filters(glob, DataStreamCtx(glob)).set_result()
+
+def handle_packet_fast(glob: dict, data: bytes, raw_packet: bytes, is_input: bool, is_ipv6: bool, is_tcp: bool, l4_size: int) -> tuple[int, str|None, bytes|None]:
+    """
+    Entry point used by the C++ core: runs the filters on the packet given as arguments
+    and returns (action, matched_by, mangled_packet), without using the globals to pass the packet and the result
+    """
+    packet = RawPacket(data, raw_packet, is_input, is_ipv6, is_tcp, l4_size)
+    result = _run_filters(glob, DataStreamCtx(glob, packet=packet))
+    return (result.action.value, result.matched_by, result.mangled_packet)
+
+
+def need_raw_packet(glob:dict) -> bool:
+    """Used by the C++ core: if False the enabled filters don't use RawPacket, so the raw packet is not built"""
+    return any(RawPacket in filter.params for filter in DataStreamCtx(glob, init_pkt=False).filter_call_info)
+
+
+def prefilter_literals(glob:dict) -> list[bytes]|None:
+    """
+    Used by the C++ core: the literals of the prefilters of the enabled filters.
+    None if a filter has no prefilter or uses RawPacket (the raw packets aren't kept): python handles every packet
+    """
+    filters = DataStreamCtx(glob, init_pkt=False).filter_call_info
+    if not filters or any(filter.prefilter is None or RawPacket in filter.params for filter in filters):
+        return None
+    return sorted(set(itertools.chain.from_iterable(filter.prefilter for filter in filters)))
 
 
 def compile(glob:dict) -> None:
@@ -154,6 +321,7 @@ def compile(glob:dict) -> None:
     proto = glob["__firegex_proto"]
     
     internal_data.filter_call_info = generate_filter_structure(filters, proto, glob)
+    internal_data.filter_call_plan = build_execution_plan(internal_data.filter_call_info)
 
     if "FGEX_STREAM_MAX_SIZE" in glob and int(glob["FGEX_STREAM_MAX_SIZE"]) > 0:
         internal_data.stream_max_size = int(glob["FGEX_STREAM_MAX_SIZE"])
@@ -164,6 +332,18 @@ def compile(glob:dict) -> None:
     if "FGEX_INVALID_ENCODING_ACTION" in glob and isinstance(glob["FGEX_INVALID_ENCODING_ACTION"], Action):
         internal_data.invalid_encoding_action = glob["FGEX_INVALID_ENCODING_ACTION"]
     
+    if "FGEX_MAX_DECODED_BODY" in glob and int(glob["FGEX_MAX_DECODED_BODY"]) > 0:
+        internal_data.max_decoded_body = int(glob["FGEX_MAX_DECODED_BODY"])
+    
+    if "FGEX_MAX_DECODE_TIME" in glob and float(glob["FGEX_MAX_DECODE_TIME"]) > 0:
+        internal_data.max_decode_time = float(glob["FGEX_MAX_DECODE_TIME"])
+    
+    if "FGEX_DECODE_LIMIT_ACTION" in glob and isinstance(glob["FGEX_DECODE_LIMIT_ACTION"], ExceptionAction):
+        internal_data.decode_limit_action = glob["FGEX_DECODE_LIMIT_ACTION"]
+    
+    if "FGEX_HISTORY_METADATA_ONLY" in glob:
+        internal_data.history_metadata_only = bool(glob["FGEX_HISTORY_METADATA_ONLY"])
+    
     PacketHandlerResult(glob).reset_result()
     
     def fake_exit(*_a, **_k):
@@ -171,3 +351,113 @@ def compile(glob:dict) -> None:
     
     glob["exit"] = fake_exit
 
+
+_IMMUTABLE_TYPES = (
+    type(None), type(Ellipsis), bool, int, float, complex, str, bytes, range, Enum,
+    types.ModuleType, types.BuiltinFunctionType, re.Pattern
+)
+
+def _is_foreign_class(value:type) -> bool:
+    module = sys.modules.get(value.__module__)
+    return module is not None and getattr(module, value.__qualname__, None) is value
+
+def _func_needs_rebind(func, template:dict) -> bool:
+    if func.__globals__ is template:
+        return True
+    for cell in func.__closure__ or ():
+        try:
+            content = cell.cell_contents
+        except ValueError:
+            continue
+        if isinstance(content, types.FunctionType) and _func_needs_rebind(content, template):
+            return True
+    return False
+
+def _is_shareable(value, template:dict, seen:set) -> bool:
+    if id(value) in seen:
+        return True
+    seen.add(id(value))
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_shareable(ele, template, seen) for ele in value)
+    if isinstance(value, type):
+        return _is_foreign_class(value)
+    if isinstance(value, types.FunctionType):
+        if not _func_needs_rebind(value, template):
+            return True # Function of another module
+        cells = []
+        for cell in value.__closure__ or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                pass
+        return all(
+            _is_shareable(ele, template, seen) for ele in
+            [*(value.__defaults__ or ()), *(value.__kwdefaults__ or {}).values(), *cells]
+        )
+    return False
+
+def _rebind_func(func, glob:dict, template:dict, memo:dict):
+    if id(func) in memo:
+        return memo[id(func)]
+    closure = None
+    if func.__closure__:
+        cells = []
+        for cell in func.__closure__:
+            try:
+                content = cell.cell_contents
+            except ValueError:
+                cells.append(cell)
+                continue
+            if isinstance(content, types.FunctionType) and _func_needs_rebind(content, template):
+                cells.append(types.CellType(_rebind_func(content, glob, template, memo)))
+            else:
+                cells.append(cell)
+        closure = tuple(cells)
+    new_func = types.FunctionType(
+        func.__code__, glob if func.__globals__ is template else func.__globals__,
+        func.__name__, func.__defaults__, closure
+    )
+    new_func.__kwdefaults__ = func.__kwdefaults__
+    new_func.__qualname__ = func.__qualname__
+    new_func.__dict__.update(func.__dict__)
+    memo[id(func)] = new_func
+    return new_func
+
+def new_stream_globals(template:dict) -> dict|None:
+    """
+    Builds the globals of a new stream from the globals of the filter code executed once (template), without
+    executing the code again. The functions of the filter code are bound to the new globals, so assigning
+    a global variable stays local to the stream.
+    Returns None if the module level values are not safe to share between the streams (mutable objects,
+    classes or mutable default arguments defined by the filter code): the code has to be executed for each stream.
+    """
+    rebind_names = template.get("__firegex_template_rebind")
+    if rebind_names is None:
+        seen = set()
+        shareable = all(
+            _is_shareable(value, template, seen) for name, value in template.items()
+            if not name.startswith("__") and name not in ("print", "exit")
+        )
+        rebind_names = [
+            name for name, value in template.items()
+            if isinstance(value, types.FunctionType) and _func_needs_rebind(value, template)
+        ] if shareable else False
+        template["__firegex_template_rebind"] = rebind_names
+    if rebind_names is False:
+        return None
+    glob = template.copy()
+    memo = {}
+    for name in rebind_names:
+        glob[name] = _rebind_func(template[name], glob, template, memo)
+    # The per stream state of the handlers is created on the first packet
+    ctx = dict(template["__firegex_pyfilter_ctx"])
+    ctx.pop("data_handler_context", None)
+    ctx["filter_call_info"] = [
+        dataclasses.replace(ele, func=memo.get(id(ele.func), ele.func)) for ele in ctx.get("filter_call_info", [])
+    ]
+    ctx["filter_call_plan"] = build_execution_plan(ctx["filter_call_info"])
+    glob["__firegex_pyfilter_ctx"] = ctx
+    PacketHandlerResult(glob).reset_result()
+    return glob
@@ -1,4 +1,4 @@
-from firegex.nfproxy.internals.models import FilterHandler
+from firegex.nfproxy.internals.models import FilterHandler, ExecutionPlan
 from firegex.nfproxy.internals.models import FullStreamAction, ExceptionAction
 
 class RawPacket:
@@ -6,19 +6,20 @@ class RawPacket:
     
     def __init__(self,
         data: bytes,
-        raw_packet: bytes,
+        raw_packet: bytes|None,
         is_input: bool,
         is_ipv6: bool,
         is_tcp: bool,
         l4_size: int,
     ):
-        self.__data = bytes(data)
-        self.__raw_packet = bytes(raw_packet)
+        # raw_packet is None when no enabled filter uses RawPacket (the c++ core doesn't build it)
+        self.__data = data if type(data) is bytes else bytes(data)
+        self.__raw_packet = raw_packet if raw_packet is None or type(raw_packet) is bytes else bytes(raw_packet)
         self.__is_input = bool(is_input)
         self.__is_ipv6 = bool(is_ipv6)
         self.__is_tcp = bool(is_tcp)
         self.__l4_size = int(l4_size)
-        self.__raw_packet_header_size = len(self.__raw_packet)-self.__l4_size
+        self.__raw_packet_header_size = None if raw_packet is None else len(self.__raw_packet)-self.__l4_size
     
     @property
     def is_input(self) -> bool:
@@ -64,14 +65,16 @@ class RawPacket:
         self.raw_packet = self.__raw_packet[:self.raw_packet_header_len]+v
     
     @property
-    def raw_packet(self) -> bytes:
-        "The raw packet with IP and TCP headers"
+    def raw_packet(self) -> bytes|None:
+        "The raw packet with IP and TCP headers (None if not provided by the c++ core)"
         return self.__raw_packet
 
     @raw_packet.setter
     def raw_packet(self, v:bytes):
         if not isinstance(v, bytes):
             raise Exception("Invalid data type, data MUST be of type bytes")
+        if self.__raw_packet is None:
+            raise Exception("The raw packet is not available")
         if len(v) > 2**16:
             raise Exception("Invalid data size, must be less than 2^16 bytes")
         #if len(v) != len(self.__raw_packet):
@@ -100,12 +103,15 @@ class RawPacket:
 class DataStreamCtx:
     "class to store the context of the data handler"
     
-    def __init__(self, glob: dict, init_pkt: bool = True):
+    def __init__(self, glob: dict, init_pkt: bool = True, packet: RawPacket|None = None):
         if "__firegex_pyfilter_ctx" not in glob.keys():
             glob["__firegex_pyfilter_ctx"] = {}
         self.__data = glob["__firegex_pyfilter_ctx"]
         self.filter_glob = glob
-        self.current_pkt = RawPacket._fetch_packet(self) if init_pkt else None
+        if packet is not None:
+            self.current_pkt = packet
+        else:
+            self.current_pkt = RawPacket._fetch_packet(self) if init_pkt else None
         self.call_mem = {} #A memory space valid only for the current packet handler
     
     @property
@@ -118,6 +124,16 @@ class DataStreamCtx:
     def filter_call_info(self, v: list[FilterHandler]):
         self.__data["filter_call_info"] = v
     
+    @property
+    def filter_call_plan(self) -> ExecutionPlan:
+        if "filter_call_plan" not in self.__data.keys():
+            self.__data["filter_call_plan"] = ExecutionPlan()
+        return self.__data.get("filter_call_plan")
+    
+    @filter_call_plan.setter
+    def filter_call_plan(self, v: ExecutionPlan):
+        self.__data["filter_call_plan"] = v
+    
     @property
     def stream_max_size(self) -> int:
         if "stream_max_size" not in self.__data.keys():
@@ -154,6 +170,54 @@ class DataStreamCtx:
             raise Exception("Invalid data type, data MUST be of type ExceptionAction")
         self.__data["invalid_encoding_action"] = v
     
+    @property
+    def max_decoded_body(self) -> int:
+        if "max_decoded_body" not in self.__data.keys():
+            return int(self.stream_max_size) # Same as the stream limit if not set
+        return self.__data.get("max_decoded_body")
+    
+    @max_decoded_body.setter
+    def max_decoded_body(self, v: int):
+        if not isinstance(v, int):
+            raise Exception("Invalid data type, data MUST be of type int")
+        self.__data["max_decoded_body"] = v
+    
+    @property
+    def max_decode_time(self) -> float:
+        if "max_decode_time" not in self.__data.keys():
+            self.__data["max_decode_time"] = 1.0 # 1 second default value
+        return self.__data.get("max_decode_time")
+    
+    @max_decode_time.setter
+    def max_decode_time(self, v: float):
+        if not isinstance(v, (int, float)):
+            raise Exception("Invalid data type, data MUST be of type float")
+        self.__data["max_decode_time"] = float(v)
+    
+    @property
+    def decode_limit_action(self) -> ExceptionAction:
+        if "decode_limit_action" not in self.__data.keys():
+            self.__data["decode_limit_action"] = ExceptionAction.NOACTION
+        return self.__data.get("decode_limit_action")
+
+    @decode_limit_action.setter
+    def decode_limit_action(self, v: ExceptionAction):
+        if not isinstance(v, ExceptionAction):
+            raise Exception("Invalid data type, data MUST be of type ExceptionAction")
+        self.__data["decode_limit_action"] = v
+    
+    @property
+    def history_metadata_only(self) -> bool:
+        if "history_metadata_only" not in self.__data.keys():
+            self.__data["history_metadata_only"] = False
+        return self.__data.get("history_metadata_only")
+
+    @history_metadata_only.setter
+    def history_metadata_only(self, v: bool):
+        if not isinstance(v, bool):
+            raise Exception("Invalid data type, data MUST be of type bool")
+        self.__data["history_metadata_only"] = v
+    
     @property
     def data_handler_context(self) -> dict:
         if "data_handler_context" not in self.__data.keys():
@@ -14,3 +14,15 @@ class RejectConnection(Exception):
 class StreamFullReject(Exception):
     "raise this exception if you want to reject the connection due to full stream"
 
+
+class DecodeLimitDrop(Exception):
+    "raise this exception if you want to drop the packet due to a body decoding limit (the reason is the matched_by of the result)"
+    def __init__(self, matched_by:str):
+        super().__init__(matched_by)
+        self.matched_by = matched_by
+
+class DecodeLimitReject(Exception):
+    "raise this exception if you want to reject the connection due to a body decoding limit (the reason is the matched_by of the result)"
+    def __init__(self, matched_by:str):
+        super().__init__(matched_by)
+        self.matched_by = matched_by
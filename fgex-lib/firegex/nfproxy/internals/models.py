@@ -7,6 +7,8 @@ class Action(Enum):
     DROP = 1
     REJECT = 2
     MANGLE = 3
+    ACCEPT_FLOW = 4 # The filter is no longer called on the stream
+    ACCEPT_DIRECTION = 5 # The filter is no longer called on the direction of the packet
 
 class ExceptionAction(Enum):
     """Action to be taken by the filter when an exception occurs (used in some cases)"""
@@ -21,6 +23,7 @@ class FullStreamAction(Enum):
     ACCEPT = 1
     REJECT = 2
     DROP = 3
+    KEEP_LAST = 4
 
 @dataclass
 class FilterHandler:
@@ -29,6 +32,30 @@ class FilterHandler:
     name: str
     params: dict[type, callable]
     proto: str
+    prefilter: tuple[bytes, ...]|None = None # Literals declared with @pyfilter(prefilter=...)
+
+@dataclass(frozen=True, slots=True)
+class FilterCall:
+    """Filter call of the execution plan built by compile"""
+    name: str
+    func: callable
+    fetch: tuple[int, ...] # Data handlers to run before the call and not run by the filters before, in plan order
+    args: tuple[int, ...] # Data handlers that give the params of the call
+
+@dataclass(frozen=True, slots=True)
+class DirectionPlan:
+    """Filters that can be called on the packets of a direction and the data handlers they need"""
+    data_types: tuple[type, ...] = ()
+    fetchers: tuple[callable, ...] = () # Topologically ordered: a data handler comes after the ones it depends on
+    filters: tuple[FilterCall, ...] = ()
+    # Data handlers needed by the filters of the other direction, run on every packet: (filter name, data handler)
+    companions: tuple[tuple[str, callable], ...] = ()
+
+@dataclass(frozen=True, slots=True)
+class ExecutionPlan:
+    """Execution plan of the enabled filters, for client (input) and server (output) packets"""
+    input: DirectionPlan = DirectionPlan()
+    output: DirectionPlan = DirectionPlan()
 
 @dataclass
 class PacketHandlerResult:
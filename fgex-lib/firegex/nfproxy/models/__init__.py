@@ -13,6 +13,13 @@ from firegex.nfproxy.models.http import (
     HttpFullResponse,
     HttpHistory,
     HttpStreamHistory,
+    HttpHistoryEntry,
+    HttpBodyChunk,
+)
+from firegex.nfproxy.models.http2 import (
+    Http2Frame,
+    Http2Request,
+    Http2Response,
 )
 from firegex.nfproxy.internals.data import RawPacket
 from enum import Enum
@@ -35,9 +42,47 @@ type_annotations_associations = {
         HttpFullResponse: HttpFullResponse._fetch_packet,
         HttpHistory: HttpHistory._fetch_packet,
         HttpStreamHistory: HttpStreamHistory._fetch_packet,
+        HttpBodyChunk: HttpBodyChunk._fetch_packet,
+        Http2Frame: Http2Frame._fetch_packet,
+        Http2Request: Http2Request._fetch_packet,
+        Http2Response: Http2Response._fetch_packet,
     },
 }
 
+# Direction of the packets the data models are fetched on: True for client packets, False for server packets
+# (the ones not listed are fetched on both)
+type_annotations_directions = {
+    TCPInputStream: True,
+    TCPOutputStream: False,
+    HttpRequest: True,
+    HttpRequestHeader: True,
+    HttpFullRequest: True,
+    HttpResponse: False,
+    HttpResponseHeader: False,
+    HttpFullResponse: False,
+    Http2Request: True,
+    Http2Response: False,
+}
+
+# Data handlers run on the packets of the other direction for the data models of a direction (no filter is called):
+# they return True once they aren't needed anymore on the stream
+type_annotations_companions = {
+    HttpRequest: HttpRequest._negotiate_upgrade,
+    HttpFullRequest: HttpFullRequest._negotiate_upgrade,
+}
+
+# Data models that use the objects fetched by other data models on the same packet: they are fetched after them
+type_annotations_dependencies = {
+    HttpHistory: (
+        HttpRequest,
+        HttpResponse,
+        HttpRequestHeader,
+        HttpResponseHeader,
+        HttpFullRequest,
+        HttpFullResponse,
+    ),
+}
+
 
 class Protocols(Enum):
     TCP = "tcp"
@@ -58,6 +103,11 @@ __all__ = [
     "HttpFullResponse",
     "HttpHistory",
     "HttpStreamHistory",
+    "HttpHistoryEntry",
+    "HttpBodyChunk",
+    "Http2Frame",
+    "Http2Request",
+    "Http2Response",
     "Protocols",
 ]
 
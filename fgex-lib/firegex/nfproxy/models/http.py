@@ -6,39 +6,45 @@ from firegex.nfproxy.internals.exceptions import (
     StreamFullReject,
     RejectConnection,
     DropPacket,
+    DecodeLimitDrop,
+    DecodeLimitReject,
 )
 from firegex.nfproxy.internals.models import FullStreamAction, ExceptionAction
 from dataclasses import dataclass, field
 from collections import deque
 from compression import zstd
-import gzip
-import io
 import zlib
 import brotli
 import traceback
-from websockets.frames import Frame
+import hashlib
+import sys
+import time
+import struct
+from websockets.frames import Frame, Opcode
+from websockets.exceptions import ProtocolError
 from websockets.extensions.permessage_deflate import PerMessageDeflate
 from pyllhttp import PAUSED_H2_UPGRADE, PAUSED_UPGRADE
 
+try:
+    from websockets.speedups import apply_mask
+except ImportError:
+    from websockets.utils import apply_mask
+
 
 @dataclass
 class InternalHTTPMessage:
     """Internal class to handle HTTP messages"""
 
     url: str | None = field(default=None)
-    headers: dict[str, str] = field(default_factory=dict)
-    lheaders: dict[str, str] = field(
-        default_factory=dict
-    )  # lowercase copy of the headers
+    raw_headers: list[tuple[bytes, bytes]] = field(
+        default_factory=list
+    )  # (name, value) pairs as received, decoded only when the headers are read
     body: bytes | None = field(default=None)
     body_decoded: bool = field(default=False)
     headers_complete: bool = field(default=False)
     message_complete: bool = field(default=False)
     status: str | None = field(default=None)
     total_size: int = field(default=0)
-    user_agent: str = field(default_factory=str)
-    content_encoding: str = field(default=str)
-    content_type: str = field(default=str)
     keep_alive: bool = field(default=False)
     should_upgrade: bool = field(default=False)
     http_version: str = field(default=str)
@@ -49,6 +55,55 @@ class InternalHTTPMessage:
     upgrading_to_h2: bool = field(default=False)
     upgrading_to_ws: bool = field(default=False)
     added_to_history: bool = field(default=False)
+    _headers: dict[str, str | list[str]] | None = field(default=None, repr=False)
+    _lheaders: dict[str, str] | None = field(default=None, repr=False)
+
+    def _reset_headers_cache(self):
+        self._headers = None
+        self._lheaders = None
+
+    @property
+    def headers(self) -> dict[str, str | list[str]]:
+        if self._headers is None:
+            headers = {}
+            for k, v in self.raw_headers:
+                k, v = k.decode(errors="ignore"), v.decode(errors="ignore")
+                old_value = headers.get(k, None)
+                # raw headers are stored as thay were, considering to check changes between headers encoding
+                if isinstance(old_value, list):
+                    old_value.append(v)
+                elif isinstance(old_value, str):
+                    headers[k] = [old_value, v]
+                else:
+                    headers[k] = v
+            self._headers = headers
+        return self._headers
+
+    @property
+    def lheaders(self) -> dict[str, str]:
+        """lowercase copy of the headers"""
+        if self._lheaders is None:
+            lheaders = {}
+            for k, v in self.raw_headers:
+                k, v = k.decode(errors="ignore").lower(), v.decode(errors="ignore")
+                if k in lheaders:
+                    lheaders[k] += f", {v}"  # Should be considered as a single list separated by commas as said in the RFC
+                else:
+                    lheaders[k] = v
+            self._lheaders = lheaders
+        return self._lheaders
+
+    @property
+    def user_agent(self) -> str:
+        return self.lheaders.get("user-agent", "")
+
+    @property
+    def content_encoding(self) -> str:
+        return self.lheaders.get("content-encoding", "")
+
+    @property
+    def content_type(self) -> str:
+        return self.lheaders.get("content-type", "")
 
 
 @dataclass
@@ -56,13 +111,247 @@ class InternalHttpBuffer:
     """Internal class to handle HTTP messages"""
 
     _url_buffer: bytes = field(default_factory=bytes)
-    _raw_header_fields: dict[str, str | list[str]] = field(default_factory=dict)
-    _header_fields: dict[str, str] = field(default_factory=dict)
-    _body_buffer: bytes = field(default_factory=bytes)
+    _body_buffer: bytearray = field(default_factory=bytearray)
+    _decoded_body_buffer: bytearray = field(default_factory=bytearray)
+    _body_decoder: "InternalBodyDecoder | None" = field(default=None)
+    _body_offset: int = field(default=0)  # Body bytes (decoded if possible) of the message seen so far
     _status_buffer: bytes = field(default_factory=bytes)
     _current_header_field: bytes = field(default_factory=bytes)
     _current_header_value: bytes = field(default_factory=bytes)
-    _ws_packet_stream: bytes = field(default_factory=bytes)
+    _ws_decoder: "InternalWebSocketDecoder | None" = field(default=None)
+
+
+MAX_DECODED_BODY_REACHED = "@MAX_DECODED_BODY_REACHED"
+MAX_DECODE_TIME_REACHED = "@MAX_DECODE_TIME_REACHED"
+
+
+class InternalBodyDecoder:
+    """
+    Incremental decoder of a body with the content encodings of the message (gzip, br, deflate and zstd):
+    the body is decoded chunk by chunk as it arrives, and decoding fails once more than max_size bytes are decoded
+    or after max_time seconds spent decoding
+    """
+
+    def __init__(self, content_encoding: str, max_size: int | None = None, max_time: float | None = None):
+        self.max_size = max_size if max_size is not None and max_size < sys.maxsize else None
+        self.max_time = max_time
+        self.size = 0
+        self.elapsed = 0.0
+        self.failed = False
+        self.limit_reached: str | None = None  # The limit that stopped decoding
+        self._stages: list[tuple[str, object]] = []
+        for enc in reversed([ele.strip() for ele in content_encoding.lower().split(",")]):
+            if not enc or enc == "identity":
+                continue  # https://datatracker.ietf.org/doc/html/rfc2616#section-3.5 (it's possible to be found also if it should't be used)
+            if enc not in ("deflate", "br", "gzip", "x-gzip", "zstd"):
+                self.failed = True
+                break
+            self._stages.append((enc, self._new_decompressor(enc)))
+
+    @property
+    def exceeded(self) -> bool:
+        """If decoding was stopped by a limit"""
+        return self.limit_reached is not None
+
+    def _stop(self, limit_reached: str):
+        if limit_reached == MAX_DECODED_BODY_REACHED:
+            print(f"[WARNING] Decoded body bigger than {self.max_size} bytes: skipping", flush=True)
+        else:
+            print(f"[WARNING] Body decoding took more than {self.max_time} seconds: skipping", flush=True)
+        self.failed = True
+        self.limit_reached = limit_reached
+
+    def _check_time(self, start: float) -> bool:
+        self.elapsed += time.perf_counter() - start
+        if self.max_time is not None and self.elapsed > self.max_time:
+            self._stop(MAX_DECODE_TIME_REACHED)
+            return False
+        return True
+
+    @property
+    def identity(self) -> bool:
+        """If the body is not encoded"""
+        return not self._stages and not self.failed
+
+    @staticmethod
+    def _new_decompressor(enc: str):
+        if enc == "deflate":
+            return zlib.decompressobj(-zlib.MAX_WBITS)
+        if enc == "br":
+            return brotli.Decompressor()
+        if enc == "zstd":
+            return zstd.ZstdDecompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip, x-gzip
+
+    def _decompress(self, i: int, data: bytes, limit: int | None) -> bytes:
+        enc, decompressor = self._stages[i]
+        if enc == "br":
+            if limit is None:
+                return decompressor.process(data)
+            # output_buffer_limit (brotli>=1.2) is a hint: brotli can still return a whole internal chunk
+            return decompressor.process(data, output_buffer_limit=limit)[:limit]
+        res = decompressor.decompress(data, limit or (0 if enc != "zstd" else -1))
+        # gzip and zstd bodies can be made of more members/frames
+        while enc != "deflate" and decompressor.eof and decompressor.unused_data and (limit is None or len(res) < limit):
+            data = decompressor.unused_data
+            decompressor = self._new_decompressor(enc)
+            self._stages[i] = (enc, decompressor)
+            res += decompressor.decompress(data, (limit - len(res)) if limit is not None else (0 if enc != "zstd" else -1))
+        return res
+
+    def feed(self, data: bytes) -> bytes | None:
+        """Decodes the next chunk of the body, None if decoding failed"""
+        if self.failed:
+            return None
+        start = time.perf_counter()
+        limit = None if self.max_size is None else self.max_size - self.size + 1
+        for i in range(len(self._stages)):
+            try:
+                data = self._decompress(i, data, limit)
+            except Exception as e:
+                print(f"Error decompressing {self._stages[i][0]}: {e}: skipping", flush=True)
+                self.failed = True
+                return None
+            if limit is not None and len(data) >= limit:
+                self._stop(MAX_DECODED_BODY_REACHED)
+                return None
+        if not self._check_time(start):
+            return None
+        self.size += len(data)
+        return data
+
+    def flush(self) -> bytes | None:
+        """Decodes the data still buffered by the decompressors at the end of the body, None if decoding failed"""
+        if self.failed:
+            return None
+        start = time.perf_counter()
+        data = b""
+        for i, (enc, decompressor) in enumerate(self._stages):
+            if data:
+                try:
+                    data = self._decompress(i, data, None)
+                except Exception as e:
+                    print(f"Error decompressing {enc}: {e}: skipping", flush=True)
+                    self.failed = True
+                    return None
+            if enc in ("deflate", "gzip", "x-gzip"):
+                data += decompressor.flush()
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self._stop(MAX_DECODED_BODY_REACHED)
+            return None
+        if not self._check_time(start):
+            return None
+        return data
+
+
+_WS_OPCODES = {opcode.value: opcode for opcode in Opcode}
+
+
+class InternalWebSocketDecoder:
+    """
+    Incremental decoder of a websocket stream: the data is collected in a single buffer and all the complete
+    frames are parsed at each feed moving an offset on it, the data of an incomplete frame is kept for the next feed
+    """
+
+    def __init__(self, mask: bool, max_frame_size: int | None = None):
+        self.mask = mask
+        self.max_frame_size = max_frame_size  # Frames declaring a bigger payload are invalid
+        self._buffer = bytearray()
+        self._skip = 0  # Bytes still to discard of a frame dropped by discard()
+
+    @property
+    def pending(self) -> bytes:
+        """Data of the incomplete frame not parsed yet"""
+        return bytes(self._buffer)
+
+    @property
+    def pending_size(self) -> int:
+        return len(self._buffer)
+
+    def clear(self):
+        self._buffer.clear()
+        self._skip = 0
+
+    @staticmethod
+    def _payload_position(buffer: bytearray, offset: int) -> tuple[int, int] | None:
+        """Returns the position and the length of the payload of the frame at offset, None if the header is incomplete"""
+        size = len(buffer)
+        if size - offset < 2:
+            return None
+        pos = offset + 2
+        length = buffer[offset + 1] & 0b01111111
+        if length == 126:
+            if size - pos < 2:
+                return None
+            (length,) = struct.unpack_from("!H", buffer, pos)
+            pos += 2
+        elif length == 127:
+            if size - pos < 8:
+                return None
+            (length,) = struct.unpack_from("!Q", buffer, pos)
+            pos += 8
+        if buffer[offset + 1] & 0b10000000:
+            pos += 4
+        return pos, length
+
+    def discard(self):
+        """
+        Drops the data of the incomplete frame: the rest of the frame is skipped as it arrives, so the next frame is
+        parsed from its header (if the header itself is incomplete it's kept, it's at most 14 bytes)
+        """
+        header = self._payload_position(self._buffer, 0)
+        if header is not None:
+            pos, length = header
+            self._skip = pos + length - len(self._buffer)
+            self._buffer.clear()
+
+    def feed(self, data: bytes, frames: list[Frame], extensions: list | None = None):
+        """
+        Parses the complete frames in the buffered data appending them to frames, extensions are applied in reverse order
+        (if a frame is invalid the frames before it are appended, and the invalid one is left in the buffer)
+        """
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        buffer = self._buffer
+        buffer += data
+        size = len(buffer)
+        offset = 0
+        try:
+            while size - offset >= 2:
+                head1, head2 = buffer[offset], buffer[offset + 1]
+                header = self._payload_position(buffer, offset)
+                if header is None:
+                    break
+                pos, length = header
+                if self.max_frame_size is not None and length > self.max_frame_size:
+                    raise ProtocolError("frame too large")
+                masked = bool(head2 & 0b10000000)
+                if masked != self.mask:
+                    raise ProtocolError("incorrect masking")
+                if size - pos < length:
+                    break
+                if masked:
+                    payload = apply_mask(buffer[pos:pos + length], bytes(buffer[pos - 4:pos]))
+                else:
+                    payload = bytes(buffer[pos:pos + length])
+                opcode = _WS_OPCODES.get(head1 & 0b00001111)
+                if opcode is None:
+                    raise ProtocolError("invalid opcode")
+                frame = Frame(
+                    opcode, payload, bool(head1 & 0b10000000),
+                    bool(head1 & 0b01000000), bool(head1 & 0b00100000), bool(head1 & 0b00010000),
+                )
+                for extension in reversed(extensions or ()):
+                    frame = extension.decode(frame)  # permessage-deflate keeps its decompressor between the frames
+                frame.check()
+                frames.append(frame)
+                offset = pos + length
+        finally:
+            if offset:
+                del buffer[:offset]
 
 
 class InternalCallbackHandler:
@@ -75,6 +364,12 @@ class InternalCallbackHandler:
     _ws_extentions = None
     _ws_raised_error = False
     release_message_headers = True
+    stream_body = False  # The body chunks are collected in body_chunks as they arrive (HttpBodyChunk)
+    body_chunks: list["HttpBodyChunk"] | None = None
+    max_decoded_body: int | None = None
+    max_decode_time: float | None = None
+    max_ws_frame_size: int | None = None
+    decode_limit_reached: str | None = None  # Set when a limit stops the decoding of a body, reset by the data handler
 
     def reset_data(self):
         self.msg = InternalHTTPMessage()
@@ -114,37 +409,15 @@ class InternalCallbackHandler:
         self.buffers._current_header_value += value
 
     def on_header_value_complete(self):
-        if self.buffers._current_header_field:
-            k, v = (
-                self.buffers._current_header_field.decode(errors="ignore"),
-                self.buffers._current_header_value.decode(errors="ignore"),
-            )
-            old_value = self.buffers._raw_header_fields.get(k, None)
-
-            # raw headers are stored as thay were, considering to check changes between headers encoding
-            if isinstance(old_value, list):
-                old_value.append(v)
-            elif isinstance(old_value, str):
-                self.buffers._raw_header_fields[k] = [old_value, v]
-            else:
-                self.buffers._raw_header_fields[k] = v
-
-            # Decoding headers normally
-            kl = k.lower()
-            if kl in self.buffers._header_fields:
-                self.buffers._header_fields[kl] += (
-                    f", {v}"  # Should be considered as a single list separated by commas as said in the RFC
-                )
-            else:
-                self.buffers._header_fields[kl] = v
-
-        self.buffers._current_header_field = b""
-        self.buffers._current_header_value = b""
+        buffers = self.buffers
+        if buffers._current_header_field:
+            self.msg.raw_headers.append((buffers._current_header_field, buffers._current_header_value))
+            if self.msg.headers_complete:  # Trailer headers
+                self.msg._reset_headers_cache()
+        buffers._current_header_field = b""
+        buffers._current_header_value = b""
 
     def on_headers_complete(self):
-        self.msg.headers = self.buffers._raw_header_fields
-        self.msg.lheaders = self.buffers._header_fields
-        self.buffers._raw_header_fields = {}
         self.buffers._current_header_field = b""
         self.buffers._current_header_value = b""
         self.msg.headers_complete = True
@@ -153,68 +426,63 @@ class InternalCallbackHandler:
         self.msg.should_upgrade = self.should_upgrade
         self.msg.keep_alive = self.keep_alive
         self.msg.http_version = self.http_version
-        self.msg.content_type = self.content_type
-        self.msg.content_encoding = self.content_encoding
-        self.msg.user_agent = self.user_agent
+
+    @property
+    def body_decoder(self) -> InternalBodyDecoder:
+        if self.buffers._body_decoder is None:
+            self.buffers._body_decoder = InternalBodyDecoder(
+                self.content_encoding, self.max_decoded_body, self.max_decode_time
+            )
+        return self.buffers._body_decoder
+
+    def _push_body_chunk(self, data: bytes, decoded: bool, is_last: bool = False):
+        if self.body_chunks is None:
+            self.body_chunks = []
+        last_chunk = self.body_chunks[-1] if self.body_chunks else None
+        if last_chunk is not None and last_chunk._message is self.msg and last_chunk._decoded == decoded:
+            last_chunk._data += data
+            last_chunk._is_last = is_last
+        else:
+            self.body_chunks.append(
+                HttpBodyChunk(self.msg, data, self.buffers._body_offset, decoded, is_last, self._is_input())
+            )
+        self.buffers._body_offset += len(data)
 
     def on_body(self, body: bytes):
+        if not self.save_body and not self.stream_body:
+            return
+        body = bytes(body)  # The parser gives a view valid only during the callback
+        decoder = self.body_decoder
+        decoded = body if decoder.identity else decoder.feed(body)
+        if decoder.limit_reached is not None and decoded is None and self.decode_limit_reached is None:
+            self.decode_limit_reached = decoder.limit_reached
         if self.save_body:
             self.msg.total_size += len(body)
             self.buffers._body_buffer += body
+            if decoded is not None and not decoder.identity:
+                self.buffers._decoded_body_buffer += decoded
+        if self.stream_body and (body if decoded is None else decoded):
+            self._push_body_chunk(body if decoded is None else decoded, decoded is not None)
 
     def on_message_complete(self):
-        self.msg.body = self.buffers._body_buffer
         self.msg.should_upgrade = self.should_upgrade
-        self.buffers._body_buffer = b""
-        encodings = [ele.strip() for ele in self.content_encoding.lower().split(",")]
-        decode_success = True
-        decoding_body = self.msg.body
-        for enc in reversed(encodings):
-            if not enc:
-                continue
-            if enc == "deflate":
-                try:
-                    decompress = zlib.decompressobj(-zlib.MAX_WBITS)
-                    decoding_body = decompress.decompress(decoding_body)
-                    decoding_body += decompress.flush()
-                except Exception as e:
-                    print(f"Error decompressing deflate: {e}: skipping", flush=True)
-                    decode_success = False
-                    break
-            elif enc == "br":
-                try:
-                    decoding_body = brotli.decompress(decoding_body)
-                except Exception as e:
-                    print(f"Error decompressing brotli: {e}: skipping", flush=True)
-                    decode_success = False
-                    break
-            elif (
-                enc == "gzip" or enc == "x-gzip"
-            ):  # https://datatracker.ietf.org/doc/html/rfc2616#section-3.5
-                try:
-                    if "gzip" in self.content_encoding.lower():
-                        with gzip.GzipFile(fileobj=io.BytesIO(decoding_body)) as f:
-                            decoding_body = f.read()
-                except Exception as e:
-                    print(f"Error decompressing gzip: {e}: skipping", flush=True)
-                    decode_success = False
-                    break
-            elif enc == "zstd":
-                try:
-                    decoding_body = zstd.decompress(decoding_body)
-                except Exception as e:
-                    print(f"Error decompressing zstd: {e}: skipping", flush=True)
-                    decode_success = False
-                    break
-            elif enc == "identity":
-                pass  # No need to do anything https://datatracker.ietf.org/doc/html/rfc2616#section-3.5 (it's possible to be found also if it should't be used)
-            else:
-                decode_success = False
-                break
-
-        if decode_success:
-            self.msg.body = decoding_body
+        decoder = self.buffers._body_decoder  # None if no body data was handled
+        tail = None
+        if decoder is not None:
+            tail = decoder.flush()
+            if decoder.limit_reached is not None and tail is None and self.decode_limit_reached is None:
+                self.decode_limit_reached = decoder.limit_reached
+        if decoder is None or decoder.identity or decoder.failed:
+            self.msg.body = bytes(self.buffers._body_buffer)
+        else:
+            self.buffers._decoded_body_buffer += tail
+            self.msg.body = bytes(self.buffers._decoded_body_buffer)
             self.msg.body_decoded = True
+        self.buffers._body_buffer = bytearray()
+        self.buffers._decoded_body_buffer = bytearray()
+
+        if self.stream_body and decoder is not None and (tail or self.buffers._body_offset > 0):
+            self._push_body_chunk(tail or b"", not decoder.failed, is_last=True)
 
         self.msg.message_complete = True
         self.has_begun = False
@@ -258,6 +526,8 @@ class InternalCallbackHandler:
         tot = self.msg.total_size
         for msg in self.messages:
             tot += msg.total_size
+        if self.buffers._ws_decoder is not None:
+            tot += self.buffers._ws_decoder.pending_size
         return tot
 
     @property
@@ -276,30 +546,27 @@ class InternalCallbackHandler:
                 self.msg.stream += data
                 self.msg.total_size += len(data)
                 return
-            self.buffers._ws_packet_stream += data
-            while True:
-                try:
-                    new_frame, self.buffers._ws_packet_stream = (
-                        self._parse_websocket_frame(self.buffers._ws_packet_stream)
-                    )
-                except Exception:
-                    print(
-                        "[WARNING] Websocket parsing failed, passing data to stream...",
-                        flush=True,
-                    )
-                    traceback.print_exc()
-                    self._ws_raised_error = True
-                    self.msg.stream += self.buffers._ws_packet_stream
-                    self.buffers._ws_packet_stream = b""
-                    self.msg.total_size += len(data)
-                    return
-                if new_frame is None:
-                    break
-                self.msg.ws_stream.append(new_frame)
+            ws_stream = self.msg.ws_stream
+            parsed = len(ws_stream)
+            try:
+                self._parse_websocket_frames(data, ws_stream)
+            except Exception:
+                print(
+                    "[WARNING] Websocket parsing failed, passing data to stream...",
+                    flush=True,
+                )
+                traceback.print_exc()
+                self._ws_raised_error = True
+                pending = self.buffers._ws_decoder.pending
+                self.msg.stream += pending
+                self.buffers._ws_decoder.clear()
+                self.msg.total_size += len(pending)
+            for new_frame in ws_stream[parsed:]:
                 self.msg.total_size += len(new_frame.data)
         if self.msg.upgrading_to_h2:
-            self.msg.total_size += len(data)
-            self.msg.stream += data
+            # HTTP/2 is parsed by the Http2* data models: only the data of the current packet is kept
+            self.msg.total_size += len(data) - len(self.msg.stream)
+            self.msg.stream = data
 
     def _parse_websocket_ext(self):
         ext_ws = []
@@ -313,7 +580,7 @@ class InternalCallbackHandler:
                 ext_ws.append(PerMessageDeflate(False, False, 15, 15))
         return ext_ws
 
-    def _parse_websocket_frame(self, data: bytes) -> tuple[Frame | None, bytes]:
+    def _parse_websocket_frames(self, data: bytes, frames: list[Frame]):
         if self._ws_extentions is None:
             if self._is_input():
                 self._ws_extentions = []  # Fallback to no options
@@ -321,30 +588,11 @@ class InternalCallbackHandler:
                 self._ws_extentions = (
                     self._parse_websocket_ext()
                 )  # Extentions used are choosen by the server response
-        read_buffering = bytearray()
-
-        def read_exact(n: int):
-            nonlocal read_buffering
-            buffer = bytearray(read_buffering)
-            while len(buffer) < n:
-                data = yield
-                if data is None:
-                    raise RuntimeError("Should not send None to this generator")
-                buffer.extend(data)
-            new_data = bytes(buffer[:n])
-            read_buffering = buffer[n:]
-            return new_data
-
-        parsing = Frame.parse(
-            read_exact, extensions=self._ws_extentions, mask=self._is_input()
-        )
-        parsing.send(None)
-        try:
-            parsing.send(bytearray(data))
-        except StopIteration as e:
-            return e.value, read_buffering
-
-        return None, read_buffering
+        if self.buffers._ws_decoder is None:
+            self.buffers._ws_decoder = InternalWebSocketDecoder(
+                mask=self._is_input(), max_frame_size=self.max_ws_frame_size
+            )
+        self.buffers._ws_decoder.feed(data, frames, self._ws_extentions)
 
     def parse_data(self, data: bytes):
         if self._packet_to_stream():  # This is a websocket upgrade!
@@ -353,7 +601,10 @@ class InternalCallbackHandler:
             try:
                 reason, consumed = self.execute(data)
                 if reason == PAUSED_UPGRADE:
-                    self.msg.upgrading_to_ws = True
+                    if "h2c" in self.msg.lheaders.get("upgrade", "").lower():
+                        self.msg.upgrading_to_h2 = True
+                    else:
+                        self.msg.upgrading_to_ws = True
                     self.msg.message_complete = True
                     self._stream_parser(data[consumed:])
                 elif reason == PAUSED_H2_UPGRADE:
@@ -372,6 +623,11 @@ class InternalCallbackHandler:
         self.messages = deque()
         return tmp
 
+    def pop_body_chunks(self) -> list["HttpBodyChunk"]:
+        tmp = self.body_chunks or []
+        self.body_chunks = None
+        return tmp
+
     def __repr__(self):
         return f"<InternalCallbackHandler msg={self.msg} buffers={self.buffers} save_body={self.save_body} raised_error={self.raised_error} has_begun={self.has_begun} messages={self.messages}>"
 
@@ -394,6 +650,119 @@ class InternalHttpResponse(InternalCallbackHandler, pyllhttp.Response):
         return False
 
 
+def _setup_parser_limits(parser: InternalHttpRequest | InternalHttpResponse, internal_data: DataStreamCtx):
+    parser.max_decoded_body = internal_data.max_decoded_body
+    parser.max_decode_time = internal_data.max_decode_time
+    parser.max_ws_frame_size = internal_data.stream_max_size
+
+
+def _invalid_encoding_action(internal_data: DataStreamCtx, e: Exception):
+    match internal_data.invalid_encoding_action:
+        case ExceptionAction.REJECT:
+            raise RejectConnection()
+        case ExceptionAction.DROP:
+            raise DropPacket()
+        case ExceptionAction.NOACTION:
+            raise e
+        case ExceptionAction.ACCEPT:
+            raise NotReadyToRun()
+
+
+def _decode_limit_action(internal_data: DataStreamCtx, limit_reached: str):
+    match internal_data.decode_limit_action:
+        case ExceptionAction.REJECT:
+            raise DecodeLimitReject(limit_reached)
+        case ExceptionAction.DROP:
+            raise DecodeLimitDrop(limit_reached)
+        case ExceptionAction.ACCEPT:
+            raise NotReadyToRun()
+        case ExceptionAction.NOACTION:
+            pass  # The body is left encoded
+
+
+def _parse_packet_data(parser: InternalHttpRequest | InternalHttpResponse, internal_data: DataStreamCtx):
+    try:
+        parser.parse_data(internal_data.current_pkt.data)
+    except Exception as e:
+        traceback.print_exc()
+        _invalid_encoding_action(internal_data, e)
+    if parser.decode_limit_reached is not None:
+        limit_reached = parser.decode_limit_reached
+        parser.decode_limit_reached = None
+        _decode_limit_action(internal_data, limit_reached)
+
+
+class InternalHttpHistoryRing:
+    """
+    Append-only store of the completed messages of a stream, keeping the last maxlen entries:
+    the snapshots are views on the entries appended so far, so they are built in O(1) and never change
+    """
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.generation = 0  # Number of entries appended so far
+        self._items: list = []
+        self._start = 0  # Index in _items of the oldest entry kept
+
+    def resize(self, maxlen: int):
+        self.maxlen = maxlen
+        self._start = max(self._start, len(self._items) - maxlen)
+
+    def append(self, item):
+        self.generation += 1
+        if self.maxlen == 0:
+            return
+        self._items.append(item)
+        if len(self._items) - self._start > self.maxlen:
+            self._start += 1
+            if self._start > self.maxlen // 8:
+                # The dropped entries are released copying the kept ones in a new list
+                # (the snapshots taken before still use the old list, that is never modified)
+                self._items = self._items[self._start:]
+                self._start = 0
+
+    def snapshot(self) -> tuple[list, int, int]:
+        return (self._items, self._start, len(self._items))
+
+    def __len__(self):
+        return len(self._items) - self._start
+
+
+@dataclass(frozen=True, slots=True)
+class HttpHistoryEntry:
+    """
+    Metadata of a completed request or response, kept by HttpHistory instead of the full message
+    when FGEX_HISTORY_METADATA_ONLY is set
+    """
+
+    is_input: bool
+    method: str | None
+    url: str | None
+    status_code: str | None
+    http_version: str
+    total_size: int
+    body_size: int
+    content_length: int | None
+    headers_digest: str  # blake2b digest of the raw headers
+
+    @classmethod
+    def _from_message(cls, msg: InternalHTTPMessage, is_input: bool) -> "HttpHistoryEntry":
+        digest = hashlib.blake2b(digest_size=16)
+        for k, v in msg.raw_headers:
+            digest.update(k + b": " + v + b"\r\n")
+        return cls(
+            is_input=is_input,
+            method=msg.method if is_input else None,
+            url=msg.url,
+            status_code=None if is_input else msg.status,
+            http_version=msg.http_version,
+            total_size=msg.total_size,
+            body_size=len(msg.body) if msg.body else 0,
+            content_length=msg.content_length,
+            headers_digest=digest.hexdigest(),
+        )
+
+
 class HttpHistory:
     """
     HTTP History handler for pyfilters.
@@ -402,21 +771,32 @@ class HttpHistory:
 
     def __init__(
         self,
-        requests: list["HttpFullRequest"] | None = None,
-        responses: list["HttpFullResponse"] | None = None,
+        requests: list["HttpFullRequest | HttpHistoryEntry"] | None = None,
+        responses: list["HttpFullResponse | HttpHistoryEntry"] | None = None,
     ):
-        self._requests = list(requests) if requests is not None else []
-        self._responses = list(responses) if responses is not None else []
+        requests = list(requests) if requests is not None else []
+        responses = list(responses) if responses is not None else []
+        self._requests = (requests, 0, len(requests))
+        self._responses = (responses, 0, len(responses))
+
+    @classmethod
+    def _from_rings(cls, req_ring: InternalHttpHistoryRing, resp_ring: InternalHttpHistoryRing) -> "HttpHistory":
+        history = cls.__new__(cls)
+        history._requests = req_ring.snapshot()
+        history._responses = resp_ring.snapshot()
+        return history
 
     @property
-    def requests(self) -> list["HttpFullRequest"]:
+    def requests(self) -> list["HttpFullRequest | HttpHistoryEntry"]:
         """List of previous completed HTTP requests"""
-        return self._requests.copy()
+        items, start, end = self._requests
+        return items[start:end]
 
     @property
-    def responses(self) -> list["HttpFullResponse"]:
+    def responses(self) -> list["HttpFullResponse | HttpHistoryEntry"]:
         """List of previous completed HTTP responses"""
-        return self._responses.copy()
+        items, start, end = self._responses
+        return items[start:end]
 
     @classmethod
     def _fetch_packet(cls, internal_data: DataStreamCtx):
@@ -434,16 +814,29 @@ class HttpHistory:
                 elif hasattr(obj, "history"):
                     return obj.history
 
-        req_history_deque = internal_data.data_handler_context.get(
-            "http_history_requests", deque()
-        )
-        resp_history_deque = internal_data.data_handler_context.get(
-            "http_history_responses", deque()
-        )
-        return HttpHistory(list(req_history_deque), list(resp_history_deque))
+        return cls._from_rings(*_history_rings(internal_data))
 
     def __repr__(self):
-        return f"<HttpHistory requests={len(self._requests)} responses={len(self._responses)}>"
+        return f"<HttpHistory requests={self._requests[2] - self._requests[1]} responses={self._responses[2] - self._responses[1]}>"
+
+
+def _history_rings(internal_data: DataStreamCtx) -> tuple[InternalHttpHistoryRing, InternalHttpHistoryRing]:
+    raw_max = internal_data.filter_glob.get("FGEX_MAX_HISTORY_SIZE", 100)
+    try:
+        max_history = max(0, int(raw_max))
+    except (ValueError, TypeError):
+        max_history = 100
+
+    rings = []
+    for key in ("http_history_requests", "http_history_responses"):
+        ring: InternalHttpHistoryRing | None = internal_data.data_handler_context.get(key)
+        if ring is None:
+            ring = InternalHttpHistoryRing(max_history)
+            internal_data.data_handler_context[key] = ring
+        elif ring.maxlen != max_history:
+            ring.resize(max_history)
+        rings.append(ring)
+    return rings[0], rings[1]
 
 
 HttpStreamHistory = HttpHistory
@@ -590,6 +983,7 @@ class InternalBasicHttpMetaClass:
             internal_data.data_handler_context[parser_key] = parser
 
         parser.release_message_headers = cls._should_release_message_headers()
+        _setup_parser_limits(parser, internal_data)
 
 
         if not internal_data.call_mem.get(
@@ -612,13 +1006,15 @@ class InternalBasicHttpMetaClass:
                 > internal_data.stream_max_size
             ):
                 match internal_data.full_stream_action:
-                    case FullStreamAction.FLUSH:
+                    case FullStreamAction.FLUSH | FullStreamAction.KEEP_LAST:
                         # Deleting parser and re-creating it
                         parser.messages.clear()
                         parser.msg.total_size -= len(parser.msg.stream)
                         parser.msg.stream = b""
                         parser.msg.total_size -= len(parser.msg.body)
                         parser.msg.body = b""
+                        if parser.buffers._ws_decoder is not None:
+                            parser.buffers._ws_decoder.discard()
                         print("[WARNING] Flushing stream", flush=True)
                         if (
                             parser.total_size + len(internal_data.current_pkt.data)
@@ -636,19 +1032,7 @@ class InternalBasicHttpMetaClass:
                 parser.msg.headers_complete
             )  # This information is usefull for building the real object
 
-            try:
-                parser.parse_data(internal_data.current_pkt.data)
-            except Exception as e:
-                traceback.print_exc()
-                match internal_data.invalid_encoding_action:
-                    case ExceptionAction.REJECT:
-                        raise RejectConnection()
-                    case ExceptionAction.DROP:
-                        raise DropPacket()
-                    case ExceptionAction.NOACTION:
-                        raise e
-                    case ExceptionAction.ACCEPT:
-                        raise NotReadyToRun()
+            _parse_packet_data(parser, internal_data)
 
             if parser.should_upgrade and not internal_data.current_pkt.is_input:
                 # Creating ws_option for the client
@@ -692,45 +1076,23 @@ class InternalBasicHttpMetaClass:
         if messages_to_call == 0:
             raise NotReadyToRun()
 
-        raw_max = internal_data.filter_glob.get("FGEX_MAX_HISTORY_SIZE", 100)
-        try:
-            max_history = max(0, int(raw_max))
-        except (ValueError, TypeError):
-            max_history = 100
-
-        req_history_deque: deque = (
-            internal_data.data_handler_context.setdefault(
-                "http_history_requests", deque(maxlen=max_history)
-            )
-        )
-        if req_history_deque.maxlen != max_history:
-            req_history_deque = deque(req_history_deque, maxlen=max_history)
-            internal_data.data_handler_context["http_history_requests"] = req_history_deque
-
-        resp_history_deque: deque = (
-            internal_data.data_handler_context.setdefault(
-                "http_history_responses", deque(maxlen=max_history)
-            )
-        )
-        if resp_history_deque.maxlen != max_history:
-            resp_history_deque = deque(resp_history_deque, maxlen=max_history)
-            internal_data.data_handler_context["http_history_responses"] = resp_history_deque
+        req_history, resp_history = _history_rings(internal_data)
+        metadata_only = internal_data.history_metadata_only
 
         built_instances = []
         for msg in messages_tosend:
-            history_snapshot = HttpHistory(
-                list(req_history_deque), list(resp_history_deque)
-            )
             instance = cls(parser, msg)
-            instance._history = history_snapshot
+            instance._history = HttpHistory._from_rings(req_history, resp_history)
             built_instances.append(instance)
 
             if msg.message_complete and not msg.added_to_history:
                 msg.added_to_history = True
-                if internal_data.current_pkt.is_input:
-                    req_history_deque.append(HttpFullRequest(parser, msg))
+                is_input = internal_data.current_pkt.is_input
+                if metadata_only:
+                    entry = HttpHistoryEntry._from_message(msg, is_input)
                 else:
-                    resp_history_deque.append(HttpFullResponse(parser, msg))
+                    entry = HttpFullRequest(parser, msg) if is_input else HttpFullResponse(parser, msg)
+                (req_history if is_input else resp_history).append(entry)
 
         if len(built_instances) == 1:
             res = built_instances[0]
@@ -740,6 +1102,21 @@ class InternalBasicHttpMetaClass:
         internal_data.call_mem[f"_fetched_obj_{cls._parser_class()}"] = built_instances
         return built_instances
 
+    @classmethod
+    def _negotiate_upgrade(cls, internal_data: DataStreamCtx) -> bool:
+        """
+        Run on the server packets for the filters that only get requests: the responses are parsed until the
+        upgrade, to give the client parser the websocket extensions chosen by the server.
+        Returns True once the upgrade has been seen
+        """
+        options_key = f"{cls._parser_class()}_ws_options_client"
+        if internal_data.data_handler_context.get(options_key) is None:
+            try:
+                cls._fetch_packet(internal_data)
+            except NotReadyToRun:
+                pass
+        return internal_data.data_handler_context.get(options_key) is not None
+
 
 
 class HttpRequest(InternalBasicHttpMetaClass):
@@ -858,3 +1235,106 @@ class HttpResponseHeader(HttpResponse):
     @staticmethod
     def _parser_class() -> str:
         return "http_header"
+
+
+class HttpBodyChunk:
+    """
+    HTTP Body Chunk handler
+    This data handler will be called for each packet carrying body data of a request or a response,
+    with the data received in the packet (decoded as it arrives if possible): the body is never buffered
+    """
+
+    def __init__(
+        self,
+        msg: InternalHTTPMessage,
+        data: bytes,
+        offset: int,
+        decoded: bool,
+        is_last: bool,
+        is_input: bool,
+    ):
+        self._message = msg
+        self._data = data
+        self._offset = offset
+        self._decoded = decoded
+        self._is_last = is_last
+        self._is_input = is_input
+
+    @property
+    def data(self) -> bytes:
+        """Body data received in the current packet"""
+        return self._data
+
+    @property
+    def offset(self) -> int:
+        """Position of the data in the body"""
+        return self._offset
+
+    @property
+    def body_decoded(self) -> bool:
+        """If the data is decoded according to the content encoding of the message"""
+        return self._decoded
+
+    @property
+    def is_last(self) -> bool:
+        """If this is the last chunk of the body (the message is complete)"""
+        return self._is_last
+
+    @property
+    def is_input(self) -> bool:
+        """If the chunk is part of a request (client data), false if part of a response"""
+        return self._is_input
+
+    @property
+    def url(self) -> str | None:
+        """URL of the request (None for responses)"""
+        return self._message.url
+
+    @property
+    def headers(self) -> dict[str, str]:
+        """Headers of the message"""
+        return self._message.headers
+
+    @property
+    def content_encoding(self) -> str:
+        """Content encoding of the message"""
+        return self._message.content_encoding
+
+    def get_header(self, header: str, default=None) -> str:
+        """Get a header from the message without caring about the case"""
+        return self._message.lheaders.get(header.lower(), default)
+
+    @classmethod
+    def _fetch_packet(cls, internal_data: DataStreamCtx):
+        if (
+            internal_data.current_pkt is None
+            or internal_data.current_pkt.is_tcp is False
+        ):
+            raise NotReadyToRun()
+
+        parser_key = f"http_body_chunk_{'in' if internal_data.current_pkt.is_input else 'out'}"
+        parser = internal_data.data_handler_context.get(parser_key, None)
+        if parser is None or parser.raised_error:
+            parser: InternalHttpRequest | InternalHttpResponse = (
+                InternalHttpRequest()
+                if internal_data.current_pkt.is_input
+                else InternalHttpResponse()
+            )
+            parser.save_body = False
+            parser.stream_body = True
+            internal_data.data_handler_context[parser_key] = parser
+        _setup_parser_limits(parser, internal_data)
+
+        parser.pop_all_messages()
+        _parse_packet_data(parser, internal_data)
+        parser.pop_all_messages()  # Only the body chunks are needed
+
+        chunks = parser.pop_body_chunks()
+        if len(chunks) == 0:
+            raise NotReadyToRun()
+        if len(chunks) == 1:
+            return chunks[0]
+        return chunks
+
+    def __repr__(self):
+        return f"<HttpBodyChunk url={self.url} offset={self.offset} data=[{len(self.data)} bytes] body_decoded={self.body_decoded} is_last={self.is_last} is_input={self.is_input}>"
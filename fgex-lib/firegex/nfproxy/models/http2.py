@@ -0,0 +1,541 @@
+from firegex.nfproxy.internals.data import DataStreamCtx
+from firegex.nfproxy.internals.exceptions import (
+    NotReadyToRun,
+    StreamFullDrop,
+    StreamFullReject,
+)
+from firegex.nfproxy.internals.models import FullStreamAction
+from firegex.nfproxy.models.http import (
+    InternalHttpRequest,
+    InternalHttpResponse,
+    InternalBodyDecoder,
+    _invalid_encoding_action,
+    _decode_limit_action,
+)
+from dataclasses import dataclass, field
+from hpack import Decoder as HpackDecoder
+from pyllhttp import PAUSED_H2_UPGRADE, PAUSED_UPGRADE
+import traceback
+import struct
+
+# https://datatracker.ietf.org/doc/html/rfc9113#section-6
+H2_DATA = 0x0
+H2_HEADERS = 0x1
+H2_PRIORITY = 0x2
+H2_RST_STREAM = 0x3
+H2_SETTINGS = 0x4
+H2_PUSH_PROMISE = 0x5
+H2_PING = 0x6
+H2_GOAWAY = 0x7
+H2_WINDOW_UPDATE = 0x8
+H2_CONTINUATION = 0x9
+
+H2_FRAME_TYPES = {
+    H2_DATA: "DATA",
+    H2_HEADERS: "HEADERS",
+    H2_PRIORITY: "PRIORITY",
+    H2_RST_STREAM: "RST_STREAM",
+    H2_SETTINGS: "SETTINGS",
+    H2_PUSH_PROMISE: "PUSH_PROMISE",
+    H2_PING: "PING",
+    H2_GOAWAY: "GOAWAY",
+    H2_WINDOW_UPDATE: "WINDOW_UPDATE",
+    H2_CONTINUATION: "CONTINUATION",
+}
+
+H2_FLAG_END_STREAM = 0x1
+H2_FLAG_END_HEADERS = 0x4
+H2_FLAG_PADDED = 0x8
+H2_FLAG_PRIORITY = 0x20
+
+# The decoders don't see the SETTINGS of both the endpoints, so the dynamic table updates are accepted up to this size
+H2_MAX_HEADER_TABLE_SIZE = 1 << 20
+
+
+@dataclass
+class InternalHttp2Stream:
+    """Internal class to reassemble the messages of the HTTP/2 streams"""
+
+    stream_id: int
+    headers: list[tuple[str, str]] = field(default_factory=list)
+    trailers: list[tuple[str, str]] = field(default_factory=list)
+    body: bytearray = field(default_factory=bytearray)
+    headers_received: bool = field(default=False)
+    total_size: int = field(default=0)
+
+
+class InternalHttp2Connection:
+    """Internal class with the two directions of a HTTP/2 connection"""
+
+    def __init__(self):
+        self.prior_knowledge = False  # The client started HTTP/2 with the connection preface
+        self.client = InternalHttp2Parser(True, self)
+        self.server = InternalHttp2Parser(False, self)
+
+    def parser(self, is_input: bool) -> "InternalHttp2Parser":
+        return self.client if is_input else self.server
+
+
+class InternalHttp2Parser:
+    """
+    Incremental parser of a direction of a HTTP/2 connection, started with prior knowledge or upgraded from HTTP/1.1 (h2c):
+    the frames are parsed from a single buffer, the header blocks are decoded with the HPACK dynamic table of the direction,
+    and the frames of each stream are reassembled until END_STREAM
+    """
+
+    def __init__(self, is_input: bool, connection: InternalHttp2Connection):
+        self.is_input = is_input
+        self.connection = connection
+        self.http1 = self._new_http1_parser()
+        self.is_h2 = False
+        self.is_other_protocol = False  # Upgraded to something that is not HTTP/2 (e.g. websocket)
+        self.raised_error = False
+        self.has_data = False
+        self.hpack = HpackDecoder()
+        self.hpack.max_allowed_table_size = H2_MAX_HEADER_TABLE_SIZE
+        self.streams: dict[int, InternalHttp2Stream] = {}
+        self.frames: list["Http2Frame"] = []  # Frames parsed from the last data
+        self.completed: list[InternalHttp2Stream] = []  # Streams completed with the last data
+        self._buffer = bytearray()
+        self._header_block: bytearray | None = None  # Header block waiting for CONTINUATION frames
+        self._header_block_frame: "Http2Frame | None" = None
+        self._upgrade_request: InternalHttp2Stream | None = None  # HTTP/1.1 request upgraded to h2c (stream 1)
+
+    def _new_http1_parser(self) -> InternalHttpRequest | InternalHttpResponse:
+        parser = InternalHttpRequest() if self.is_input else InternalHttpResponse()
+        parser.save_body = False
+        return parser
+
+    @property
+    def total_size(self) -> int:
+        """Data buffered by the parser"""
+        tot = len(self._buffer)
+        if self._header_block is not None:
+            tot += len(self._header_block)
+        for stream in self.streams.values():
+            tot += stream.total_size
+        return tot
+
+    def flush(self):
+        """Deletes the body data of the open streams"""
+        for stream in self.streams.values():
+            stream.total_size -= len(stream.body)
+            stream.body = bytearray()
+
+    def parse_data(self, data: bytes):
+        self.frames = []
+        self.completed = []
+        try:
+            if not self.is_h2:
+                if self.is_other_protocol:
+                    return
+                if not self.is_input and (self.connection.prior_knowledge or self._is_server_preface(data)):
+                    self.is_h2 = True  # The server answers the preface directly with HTTP/2 frames
+                else:
+                    data = self._parse_http1(data)
+                    if not self.is_h2:
+                        return
+            self._parse_frames(data)
+        except Exception as e:
+            self.raised_error = True
+            raise e
+
+    def _is_server_preface(self, data: bytes) -> bool:
+        # The first frame of the server is a SETTINGS frame (checked only on the first data of the server)
+        if self.has_data:
+            return False
+        self.has_data = True
+        return len(data) >= 9 and data[3] == H2_SETTINGS and data[5:9] == b"\x00\x00\x00\x00"
+
+    def _parse_http1(self, data: bytes) -> bytes:
+        reason, consumed = self.http1.execute(data)
+        self.http1.pop_all_messages()
+        if reason == PAUSED_H2_UPGRADE:  # The client sent the connection preface
+            self.connection.prior_knowledge = True
+            self.is_h2 = True
+            if self._upgrade_request is not None:
+                self.completed.append(self._upgrade_request)
+                self._upgrade_request = None
+        elif reason == PAUSED_UPGRADE:
+            msg = self.http1.msg
+            if "h2c" not in msg.lheaders.get("upgrade", "").lower():
+                self.is_other_protocol = True
+            elif self.is_input:
+                # The upgrade request is the stream 1 of the connection, if the server accepts the upgrade
+                # the client sends the connection preface, else it goes on with HTTP/1.1
+                self._upgrade_request = InternalHttp2Stream(
+                    1,
+                    headers=[
+                        (":method", msg.method),
+                        (":scheme", "http"),
+                        (":authority", msg.lheaders.get("host", "")),
+                        (":path", msg.url or "/"),
+                    ] + [(k, v) for k, v in msg.lheaders.items() if k not in ("host", "connection", "upgrade", "http2-settings")],
+                    headers_received=True,
+                )
+                self.http1 = self._new_http1_parser()
+                return self._parse_http1(data[consumed:])
+            else:
+                self.is_h2 = True  # 101 Switching Protocols: the server goes on with HTTP/2 frames
+        return data[consumed:]
+
+    @staticmethod
+    def _unpad(flags: int, payload: bytes) -> bytes:
+        if flags & H2_FLAG_PADDED:
+            pad_length = payload[0]
+            if pad_length >= len(payload):
+                raise Exception("Invalid HTTP/2 frame padding")
+            return payload[1:len(payload) - pad_length]
+        return payload
+
+    def _parse_frames(self, data: bytes):
+        buffer = self._buffer
+        buffer += data
+        size = len(buffer)
+        offset = 0
+        try:
+            while size - offset >= 9:
+                length_hi, length_lo, frame_type, flags, stream_id = struct.unpack_from("!BHBBI", buffer, offset)
+                length = (length_hi << 16) | length_lo
+                if size - offset - 9 < length:
+                    break
+                payload = bytes(buffer[offset + 9:offset + 9 + length])
+                offset += 9 + length
+                self._handle_frame(Http2Frame(frame_type, flags, stream_id & 0x7FFFFFFF, payload, self.is_input))
+        finally:
+            if offset:
+                del buffer[:offset]
+
+    def _handle_frame(self, frame: "Http2Frame"):
+        self.frames.append(frame)
+        if self._header_block is not None and frame.type != H2_CONTINUATION:
+            raise Exception(f"Expected a CONTINUATION frame, found {frame.type_name}")
+        if frame.type == H2_DATA:
+            frame._data = self._unpad(frame.flags, frame.payload)
+            stream = self.streams.get(frame.stream_id)
+            if stream is not None:
+                stream.body += frame._data
+                stream.total_size += len(frame._data)
+            if frame.flags & H2_FLAG_END_STREAM:
+                self._end_stream(frame.stream_id)
+        elif frame.type == H2_HEADERS:
+            block = self._unpad(frame.flags, frame.payload)
+            if frame.flags & H2_FLAG_PRIORITY:
+                block = block[5:]
+            self._start_header_block(frame, block)
+        elif frame.type == H2_PUSH_PROMISE:
+            self._start_header_block(frame, self._unpad(frame.flags, frame.payload)[4:])
+        elif frame.type == H2_CONTINUATION:
+            if self._header_block is None:
+                raise Exception("Unexpected CONTINUATION frame")
+            self._header_block += frame.payload
+            if frame.flags & H2_FLAG_END_HEADERS:
+                block, opening_frame = self._header_block, self._header_block_frame
+                self._header_block = self._header_block_frame = None
+                self._end_header_block(opening_frame, frame, block)
+        elif frame.type == H2_RST_STREAM:
+            self.streams.pop(frame.stream_id, None)
+
+    def _start_header_block(self, frame: "Http2Frame", block: bytes):
+        if frame.flags & H2_FLAG_END_HEADERS:
+            self._end_header_block(frame, frame, block)
+        else:
+            self._header_block = bytearray(block)
+            self._header_block_frame = frame
+
+    def _end_header_block(self, opening_frame: "Http2Frame", last_frame: "Http2Frame", block: bytes):
+        # All the header blocks are decoded (also the ones not used) to keep the dynamic table in sync
+        headers = self.hpack.decode(bytes(block), raw=False)
+        last_frame._headers = headers
+        if opening_frame.type == H2_PUSH_PROMISE:
+            return
+        stream = self.streams.get(opening_frame.stream_id)
+        if stream is None:
+            stream = InternalHttp2Stream(opening_frame.stream_id)
+            self.streams[opening_frame.stream_id] = stream
+        headers_size = sum(len(k) + len(v) for k, v in headers)
+        if not stream.headers_received or dict(stream.headers).get(":status", "").startswith("1"):
+            stream.headers = headers  # Interim (1xx) responses are replaced by the final one
+            stream.headers_received = True
+        else:
+            stream.trailers = headers
+        stream.total_size += headers_size
+        if opening_frame.flags & H2_FLAG_END_STREAM:
+            self._end_stream(opening_frame.stream_id)
+
+    def _end_stream(self, stream_id: int):
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None and stream.headers_received:
+            self.completed.append(stream)
+
+
+def _fetch_http2_parser(internal_data: DataStreamCtx) -> InternalHttp2Parser:
+    """Parses the data of the current packet (once for all the Http2* data models) and returns the parser of its direction"""
+    if (
+        internal_data.current_pkt is None
+        or internal_data.current_pkt.is_tcp is False
+    ):
+        raise NotReadyToRun()
+
+    connection: InternalHttp2Connection | None = internal_data.data_handler_context.get("http2_connection", None)
+    if connection is None:
+        connection = InternalHttp2Connection()
+        internal_data.data_handler_context["http2_connection"] = connection
+    parser = connection.parser(internal_data.current_pkt.is_input)
+
+    if not internal_data.call_mem.get("http2_parsed", False):
+        internal_data.call_mem["http2_parsed"] = True
+        if parser.raised_error:
+            raise NotReadyToRun()  # The HPACK state is lost, the connection can't be parsed anymore
+
+        # Memory size managment
+        if parser.total_size + len(internal_data.current_pkt.data) > internal_data.stream_max_size:
+            match internal_data.full_stream_action:
+                case FullStreamAction.FLUSH | FullStreamAction.KEEP_LAST:
+                    print("[WARNING] Flushing stream", flush=True)
+                    parser.flush()
+                case FullStreamAction.REJECT:
+                    raise StreamFullReject()
+                case FullStreamAction.DROP:
+                    raise StreamFullDrop()
+                case FullStreamAction.ACCEPT:
+                    raise NotReadyToRun()
+
+        try:
+            parser.parse_data(internal_data.current_pkt.data)
+        except Exception as e:
+            traceback.print_exc()
+            _invalid_encoding_action(internal_data, e)
+    return parser
+
+
+class Http2Frame:
+    """
+    HTTP/2 Frame handler
+    This data handler will be called for each HTTP/2 frame received in the packet (both directions)
+    """
+
+    def __init__(self, frame_type: int, flags: int, stream_id: int, payload: bytes, is_input: bool):
+        self._type = frame_type
+        self._flags = flags
+        self._stream_id = stream_id
+        self._payload = payload
+        self._is_input = is_input
+        self._data: bytes | None = None
+        self._headers: list[tuple[str, str]] | None = None
+
+    @property
+    def type(self) -> int:
+        """Type of the frame"""
+        return self._type
+
+    @property
+    def type_name(self) -> str:
+        """Name of the type of the frame (DATA, HEADERS, SETTINGS...)"""
+        return H2_FRAME_TYPES.get(self._type, f"UNKNOWN({self._type})")
+
+    @property
+    def flags(self) -> int:
+        """Flags of the frame"""
+        return self._flags
+
+    @property
+    def stream_id(self) -> int:
+        """Stream identifier of the frame (0 for the connection)"""
+        return self._stream_id
+
+    @property
+    def payload(self) -> bytes:
+        """Raw payload of the frame"""
+        return self._payload
+
+    @property
+    def data(self) -> bytes | None:
+        """Data of a DATA frame without padding (None for the other frames)"""
+        return self._data
+
+    @property
+    def headers(self) -> list[tuple[str, str]] | None:
+        """Decoded header list, on the frame that ends a header block (HEADERS, PUSH_PROMISE or CONTINUATION)"""
+        return self._headers
+
+    @property
+    def end_stream(self) -> bool:
+        """If the frame ends the stream"""
+        return self._type in (H2_DATA, H2_HEADERS) and bool(self._flags & H2_FLAG_END_STREAM)
+
+    @property
+    def is_input(self) -> bool:
+        """If the frame is sent by the client"""
+        return self._is_input
+
+    @classmethod
+    def _fetch_packet(cls, internal_data: DataStreamCtx):
+        frames = _fetch_http2_parser(internal_data).frames
+        if len(frames) == 0:
+            raise NotReadyToRun()
+        if len(frames) == 1:
+            return frames[0]
+        return frames
+
+    def __repr__(self):
+        return f"<Http2Frame type={self.type_name} flags={self.flags:#04x} stream_id={self.stream_id} payload=[{len(self.payload)} bytes] is_input={self.is_input}>"
+
+
+class InternalHttp2Message:
+    """Internal class to handle HTTP/2 requests and responses"""
+
+    def __init__(self, stream: InternalHttp2Stream, body: bytes, body_decoded: bool):
+        self._stream = stream
+        self._body = body
+        self._body_decoded = body_decoded
+        self._headers: dict[str, str] | None = None
+
+    @property
+    def stream_id(self) -> int:
+        """Stream identifier of the message"""
+        return self._stream.stream_id
+
+    @property
+    def raw_headers(self) -> list[tuple[str, str]]:
+        """Decoded header list, pseudo-headers included"""
+        return self._stream.headers
+
+    @property
+    def headers(self) -> dict[str, str]:
+        """Headers of the message (without the pseudo-headers)"""
+        if self._headers is None:
+            headers = {}
+            for k, v in self._stream.headers:
+                if k.startswith(":"):
+                    continue
+                if k in headers:
+                    headers[k] += f"; {v}" if k == "cookie" else f", {v}"
+                else:
+                    headers[k] = v
+            self._headers = headers
+        return self._headers
+
+    @property
+    def trailers(self) -> dict[str, str]:
+        """Trailer headers of the message"""
+        return dict(self._stream.trailers)
+
+    @property
+    def body(self) -> bytes:
+        """Body of the message"""
+        return self._body
+
+    @property
+    def body_decoded(self) -> bool:
+        """If the body is decoded according to the content encoding of the message"""
+        return self._body_decoded
+
+    @property
+    def content_encoding(self) -> str:
+        """Content encoding of the message"""
+        return self.headers.get("content-encoding", "")
+
+    @property
+    def total_size(self) -> int:
+        """Total size of the message"""
+        return self._stream.total_size
+
+    def get_header(self, header: str, default=None) -> str:
+        """Get a header from the message without caring about the case"""
+        return self.headers.get(header.lower(), default)
+
+    def _pseudo_header(self, name: str) -> str | None:
+        for k, v in self._stream.headers:
+            if k == name:
+                return v
+        return None
+
+    @staticmethod
+    def _is_input_message() -> bool:
+        raise NotImplementedError()
+
+    @classmethod
+    def _fetch_packet(cls, internal_data: DataStreamCtx):
+        if internal_data.current_pkt is not None and internal_data.current_pkt.is_input != cls._is_input_message():
+            raise NotReadyToRun()
+        parser = _fetch_http2_parser(internal_data)
+        if len(parser.completed) == 0:
+            raise NotReadyToRun()
+
+        messages = []
+        for stream in parser.completed:
+            body, decoded = bytes(stream.body), False
+            content_encoding = next((v for k, v in stream.headers if k == "content-encoding"), "")
+            if content_encoding and body:
+                decoder = InternalBodyDecoder(content_encoding, internal_data.max_decoded_body, internal_data.max_decode_time)
+                decoded_body = decoder.feed(body)
+                tail = decoder.flush()
+                if decoder.limit_reached is not None:
+                    _decode_limit_action(internal_data, decoder.limit_reached)
+                elif not decoder.identity and decoded_body is not None and tail is not None:
+                    body, decoded = decoded_body + tail, True
+            messages.append(cls(stream, body, decoded))
+
+        if len(messages) == 1:
+            return messages[0]
+        return messages
+
+
+class Http2Request(InternalHttp2Message):
+    """
+    HTTP/2 Request handler
+    This data handler will be called when a request is complete (on each stream of the connection)
+    """
+
+    @staticmethod
+    def _is_input_message() -> bool:
+        return True
+
+    @property
+    def method(self) -> str | None:
+        """Method of the request"""
+        return self._pseudo_header(":method")
+
+    @property
+    def path(self) -> str | None:
+        """Path of the request"""
+        return self._pseudo_header(":path")
+
+    @property
+    def url(self) -> str | None:
+        """URL of the request (same as path)"""
+        return self.path
+
+    @property
+    def scheme(self) -> str | None:
+        """Scheme of the request"""
+        return self._pseudo_header(":scheme")
+
+    @property
+    def authority(self) -> str | None:
+        """Authority of the request (host)"""
+        return self._pseudo_header(":authority")
+
+    def __repr__(self):
+        return f"<Http2Request stream_id={self.stream_id} method={self.method} path={self.path} authority={self.authority} headers={self.headers} body=[{len(self.body)} bytes]>"
+
+
+class Http2Response(InternalHttp2Message):
+    """
+    HTTP/2 Response handler
+    This data handler will be called when a response is complete (on each stream of the connection)
+    """
+
+    @staticmethod
+    def _is_input_message() -> bool:
+        return False
+
+    @property
+    def status_code(self) -> int | None:
+        """Status code of the response"""
+        status = self._pseudo_header(":status")
+        return int(status) if status is not None and status.isdigit() else None
+
+    def __repr__(self):
+        return f"<Http2Response stream_id={self.stream_id} status_code={self.status_code} headers={self.headers} body=[{len(self.body)} bytes]>"
@@ -7,15 +7,32 @@ class InternalTCPStream:
         data: bytes,
         is_ipv6: bool,
     ):
-        self.__data = bytes(data)
+        self.__buffer = bytearray(data)
+        self.__data = None # bytes of the buffer, built on the first access after new data
+        self.__new_data = bytes(data)
         self.__is_ipv6 = bool(is_ipv6)
         self.__total_stream_size = len(data)
     
     @property
     def data(self) -> bytes:
         """The data of the packets assembled and sorted from TCP"""
+        if self.__data is None:
+            self.__data = bytes(self.__buffer)
         return self.__data
     
+    @property
+    def view(self) -> memoryview:
+        """
+        Read-only view of the stream data, without copying it: use it (or new_data) to scan the stream at each packet
+        e.g. with re.search(pattern, stream.view). The view is valid only during the filter call
+        """
+        return memoryview(self.__buffer).toreadonly()
+    
+    @property
+    def new_data(self) -> bytes:
+        """The data added to the stream by the last packet (no copy)"""
+        return self.__new_data
+    
     @property
     def is_ipv6(self) -> bool:
         """It's true if the packet is an ipv6 packet, false if it's an ipv4 packet"""
@@ -26,8 +43,18 @@ class InternalTCPStream:
         """The size of the stream"""
         return self.__total_stream_size
     
-    def _push_new_data(self, data: bytes):
-        self.__data += data
+    def _push_new_data(self, data: bytes, keep_last: int|None = None):
+        try:
+            self.__buffer += data
+        except BufferError: # A view of the buffer is still referenced: it can't be resized
+            self.__buffer = self.__buffer + data
+        if keep_last is not None and len(self.__buffer) > keep_last:
+            try:
+                del self.__buffer[:len(self.__buffer)-keep_last]
+            except BufferError:
+                self.__buffer = self.__buffer[len(self.__buffer)-keep_last:]
+        self.__data = None
+        self.__new_data = data
         self.__total_stream_size += len(data)
     
     @classmethod
@@ -38,8 +65,11 @@ class InternalTCPStream:
             raise NotReadyToRun()
         datahandler: TCPInputStream = internal_data.data_handler_context.get(cls, None)
         if datahandler is None:
-            datahandler = cls(internal_data.current_pkt.data, internal_data.current_pkt.is_ipv6)
+            datahandler = cls(b"", internal_data.current_pkt.is_ipv6)
             internal_data.data_handler_context[cls] = datahandler
+            # The window applies also to a first packet bigger than the stream limit
+            keep_last = int(internal_data.stream_max_size) if internal_data.full_stream_action == FullStreamAction.KEEP_LAST else None
+            datahandler._push_new_data(internal_data.current_pkt.data, keep_last=keep_last)
         else:
             if datahandler.total_stream_size+len(internal_data.current_pkt.data) > internal_data.stream_max_size:
                 match internal_data.full_stream_action:
@@ -52,6 +82,8 @@ class InternalTCPStream:
                         raise StreamFullDrop()
                     case FullStreamAction.ACCEPT:
                         raise NotReadyToRun()
+                    case FullStreamAction.KEEP_LAST:
+                        datahandler._push_new_data(internal_data.current_pkt.data, keep_last=int(internal_data.stream_max_size))
             else:
                 datahandler._push_new_data(internal_data.current_pkt.data)
         return datahandler
@@ -3,7 +3,7 @@ import os
 from firegex.nfproxy.internals import get_filter_names
 import traceback
 from multiprocessing import Process
-from firegex.nfproxy import ACCEPT, DROP, REJECT, UNSTABLE_MANGLE
+from firegex.nfproxy import ACCEPT, DROP, REJECT, UNSTABLE_MANGLE, ACCEPT_FLOW, ACCEPT_DIRECTION
 from rich.markup import escape
 from rich import print
 import asyncio
@@ -123,6 +123,13 @@ async def _forward_and_filter(filter_ctx: dict,
                     await writer.drain()
                     continue
 
+                if action == ACCEPT_FLOW.value or action == ACCEPT_DIRECTION.value:
+                    # No filter is left on this direction (the other one gets the same result on its next packet)
+                    has_to_filter = False
+                    writer.write(data)
+                    await writer.drain()
+                    continue
+
                 filter_name = result.get("matched_by")
                 if filter_name is None or not isinstance(filter_name, str):
                     log_print("filter-parsing", "No matched_by found", level=LogLevels.ERROR)
@@ -183,6 +183,7 @@ def http_filter(http:HttpRequest):
 #   - FullStreamAction.DROP: Drop the next stream packets - like a DROP action by filter
 #   - FullStreamAction.REJECT: Reject the stream and close the connection - like a REJECT action by filter
 #   - FullStreamAction.ACCEPT: Stops to call pyfilters and accept the traffic
+#   - FullStreamAction.KEEP_LAST: Keep only the last FGEX_STREAM_MAX_SIZE bytes of the TCP streams (HTTP data types will FLUSH)
 
 from firegex.nfproxy import FullStreamAction
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Per packet overhead of the nfproxy filter dispatch (firegex.nfproxy.internals.handle_packet_fast),
+without the C++ core: for 1, 10 and 50 filters that accept every packet, the time spent to run
+all the filters on a packet is reported.
+"""
+
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../fgex-lib")))
+
+from firegex.nfproxy import clear_pyfilter_registry
+from firegex.nfproxy.internals import compile, handle_packet_fast, new_stream_globals
+
+def build_filter_code(n_filters: int) -> str:
+    code = "from firegex.nfproxy import pyfilter, ACCEPT\nfrom firegex.nfproxy.models import RawPacket\n"
+    for i in range(n_filters):
+        code += f"\n@pyfilter\ndef filter_{i}(packet: RawPacket):\n    return ACCEPT\n"
+    return code
+
+def build_stream_globals(n_filters: int) -> dict:
+    template = {}
+    clear_pyfilter_registry()
+    template["__firegex_pyfilter_enabled"] = [f"filter_{i}" for i in range(n_filters)]
+    template["__firegex_proto"] = "tcp"
+    exec(build_filter_code(n_filters), template, template)
+    compile(template)
+    return new_stream_globals(template)
+
+def run_bench(n_filters: int, n_packets: int) -> float:
+    glob = build_stream_globals(n_filters)
+    data = b"A" * 512
+    raw_packet = b"\x00" * 40 + data
+    start = time.perf_counter()
+    for _ in range(n_packets):
+        handle_packet_fast(glob, data, raw_packet, True, False, True, len(data))
+    return (time.perf_counter() - start) / n_packets
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packets", "-n", type=int, required=False, help="Number of packets for each run", default=100000)
+    args = parser.parse_args()
+
+    print(f"{'filters':>8} {'us/packet':>12} {'us/filter':>12}")
+    for n_filters in (1, 10, 50):
+        per_packet = run_bench(n_filters, args.packets)
+        print(f"{n_filters:>8} {per_packet*1e6:>12.2f} {per_packet*1e6/n_filters:>12.3f}")
@@ -152,6 +152,7 @@ def main():
     parser.add_argument("--port", "-P", type=int, default=1337, help="Service port (default: 1337)")
     parser.add_argument("--ipv6", "-6", action="store_true", default=False, help="Use IPv6")
     parser.add_argument("--connections", "-c", type=int, default=4, help="Number of concurrent client connections (default: 4)")
+    parser.add_argument("--metadata-only", "-m", action="store_true", default=False, help="Keep only the metadata of the messages in the history (FGEX_HISTORY_METADATA_ONLY)")
     args = parser.parse_args()
 
     sep()
@@ -159,6 +160,7 @@ def main():
     puts(f"Firegex API:     {args.address}", color=colors.yellow)
     puts(f"Target Port:     {args.port}", color=colors.yellow)
     puts(f"Connections:     {args.connections}", color=colors.yellow)
+    puts(f"Metadata only:   {args.metadata_only}", color=colors.yellow)
     puts("Press Ctrl+C at any time to stop the stress test.", color=colors.magenta, is_bold=True)
     sep()
 
@@ -198,7 +200,10 @@ def main():
 
     # 4. Upload HttpHistory filter code
     puts("Deploying HttpHistory pyfilter code to Firegex...", color=colors.cyan)
-    if not firegex.nfproxy_set_code(service_id, HTTP_STRESS_FILTER_CODE):
+    filter_code = HTTP_STRESS_FILTER_CODE
+    if args.metadata_only:
+        filter_code += "\nFGEX_HISTORY_METADATA_ONLY = True\n"
+    if not firegex.nfproxy_set_code(service_id, filter_code):
         puts("Error: Failed to upload pyfilter code ✗", color=colors.red)
         cleanup_and_exit(1)
     puts("Successfully deployed HttpHistory filter ✔", color=colors.green)
@@ -0,0 +1,117 @@
+from firegex.nfproxy.models import HttpFullRequest, HttpFullResponse, HttpHistory
+from firegex.nfproxy.internals.models import Action
+from utils.pyfilter_helpers import build_glob, send
+
+
+def test_filters_skipped_on_the_other_direction():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpFullRequest, HttpFullResponse
+
+@pyfilter
+def on_response(resp: HttpFullResponse):
+    return ACCEPT
+
+@pyfilter
+def on_request(req: HttpFullRequest):
+    return ACCEPT
+""", ["on_response", "on_request"], proto="http")
+
+    plan = glob["__firegex_pyfilter_ctx"]["filter_call_plan"]
+    assert [ele.name for ele in plan.input.filters] == ["on_request"]
+    assert plan.input.data_types == (HttpFullRequest,)
+    assert [ele.name for ele in plan.output.filters] == ["on_response"]
+    assert plan.output.data_types == (HttpFullResponse,)
+
+    send(glob, b"GET / HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    # The response parser never saw the client data
+    assert "http_full_in" in glob["__firegex_pyfilter_ctx"]["data_handler_context"]
+    assert "http_full_out" not in glob["__firegex_pyfilter_ctx"]["data_handler_context"]
+
+
+def test_dependencies_fetched_first_and_once():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpFullRequest, HttpHistory
+
+calls_log = []
+
+@pyfilter
+def history_only(history: HttpHistory):
+    calls_log.append(("history_only", len(history.requests)))
+    return ACCEPT
+
+@pyfilter
+def request_and_history(history: HttpHistory, req: HttpFullRequest):
+    calls_log.append(("request_and_history", req.url, len(history.requests)))
+    return ACCEPT
+""", ["history_only", "request_and_history"], proto="http")
+
+    plan = glob["__firegex_pyfilter_ctx"]["filter_call_plan"].input
+    assert plan.data_types == (HttpFullRequest, HttpHistory)
+    assert plan.filters[0].fetch == (0, 1)
+    assert plan.filters[1].fetch == ()
+    assert plan.filters[1].args == (1, 0)
+
+    send(glob, b"GET /first HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    send(glob, b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    assert glob["calls_log"] == [
+        ("history_only", 0), ("request_and_history", "/first", 0),
+        ("history_only", 1), ("request_and_history", "/second", 1),
+    ]
+
+
+def test_accepted_filters_leave_the_stream():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT_FLOW, ACCEPT_DIRECTION
+from firegex.nfproxy.models import HttpRequestHeader, HttpResponseHeader
+
+calls_log = []
+
+@pyfilter
+def first_request(req: HttpRequestHeader):
+    calls_log.append(("first_request", req.url))
+    return ACCEPT_FLOW
+
+@pyfilter
+def requests_until_login(req: HttpRequestHeader):
+    calls_log.append(("requests_until_login", req.url))
+    if req.url == "/login":
+        return ACCEPT_DIRECTION
+
+@pyfilter
+def first_response(resp: HttpResponseHeader):
+    calls_log.append(("first_response", resp.http_version))
+    return ACCEPT_DIRECTION
+""", ["first_request", "requests_until_login", "first_response"], proto="http")
+
+    action, _, _ = send(glob, b"GET /index HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    assert action == Action.ACCEPT.value
+    plan = glob["__firegex_pyfilter_ctx"]["filter_call_plan"]
+    assert [ele.name for ele in plan.input.filters] == ["requests_until_login"]
+    assert [ele.name for ele in plan.output.filters] == ["first_response"]
+
+    # The last filter of the direction leaves it: the c++ core stops sending its data
+    action, _, _ = send(glob, b"GET /login HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    assert action == Action.ACCEPT_DIRECTION.value
+    action, _, _ = send(glob, b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", is_input=False)
+    assert action == Action.ACCEPT_FLOW.value
+
+    assert [ele for ele in dict.fromkeys(glob["calls_log"])] == [
+        ("first_request", "/index"), ("requests_until_login", "/index"),
+        ("requests_until_login", "/login"), ("first_response", "1.1"),
+    ]
+
+
+def test_direction_without_filters_accepted():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpRequestHeader
+
+@pyfilter
+def on_request(req: HttpRequestHeader):
+    return ACCEPT
+""", ["on_request"], proto="http")
+
+    assert send(glob, b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", is_input=False)[0] == Action.ACCEPT_DIRECTION.value
+    assert send(glob, b"GET / HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)[0] == Action.ACCEPT.value
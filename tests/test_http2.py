@@ -0,0 +1,110 @@
+import gzip
+import struct
+from hpack import Encoder
+from utils.pyfilter_helpers import build_glob, send
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+
+def frame(frame_type: int, flags: int, stream_id: int, payload: bytes = b"") -> bytes:
+    return struct.pack("!BHBBI", len(payload) >> 16, len(payload) & 0xFFFF, frame_type, flags, stream_id) + payload
+
+
+SETTINGS = frame(0x4, 0, 0)
+
+FILTER_CODE = """
+from firegex.nfproxy import pyfilter, ACCEPT, REJECT
+from firegex.nfproxy.models import Http2Frame, Http2Request, Http2Response
+
+frames = []
+requests = []
+responses = []
+
+@pyfilter
+def on_frame(frame: Http2Frame):
+    frames.append((frame.is_input, frame.type_name, frame.stream_id))
+    return ACCEPT
+
+@pyfilter
+def on_request(req: Http2Request):
+    requests.append((req.stream_id, req.method, req.path, req.authority, req.headers, req.body))
+    if req.path == "/admin":
+        return REJECT
+    return ACCEPT
+
+@pyfilter
+def on_response(resp: Http2Response):
+    responses.append((resp.stream_id, resp.status_code, resp.body, resp.body_decoded, resp.trailers))
+    return ACCEPT
+"""
+
+
+def test_prior_knowledge_streams():
+    glob = build_glob(FILTER_CODE, ["on_frame", "on_request", "on_response"], proto="http")
+    client, server = Encoder(), Encoder()
+    headers = [(":method", "POST"), (":scheme", "http"), (":authority", "test"), (":path", "/upload"), ("user-agent", "test-agent")]
+
+    block = client.encode(headers)
+    first = PREFACE + SETTINGS + frame(0x1, 0x4, 1, block) + frame(0x0, 0x0, 1, b"hello ")
+    assert send(glob, first, True)[0] == 0
+    assert glob["requests"] == []
+    # DATA split between two packets, the end of the stream in the second one
+    data_frame = frame(0x0, 0x1, 1, b"world")
+    send(glob, data_frame[:7], True)
+    send(glob, data_frame[7:], True)
+    assert glob["requests"] == [(1, "POST", "/upload", "test", {"user-agent": "test-agent"}, b"hello world")]
+
+    # The same headers are now encoded with the dynamic table, the header block is split with CONTINUATION
+    block = client.encode([(":method", "GET"), (":scheme", "http"), (":authority", "test"), (":path", "/admin"), ("user-agent", "test-agent")])
+    assert b"test" not in block  # authority and user-agent from the dynamic table
+    action, matched_by, _ = send(glob, frame(0x1, 0x1, 3, block[:2]) + frame(0x9, 0x4, 3, block[2:]), True)
+    assert (action, matched_by) == (2, "on_request")  # REJECT
+    assert glob["requests"][-1][:3] == (3, "GET", "/admin")
+
+    body = gzip.compress(b"compressed response")
+    response = (
+        SETTINGS
+        + frame(0x1, 0x4, 1, server.encode([(":status", "200"), ("content-encoding", "gzip")]))
+        + frame(0x0, 0x0, 1, body)
+        + frame(0x1, 0x5, 1, server.encode([("grpc-status", "0")]))  # trailers
+    )
+    send(glob, response, False)
+    assert glob["responses"] == [(1, 200, b"compressed response", True, {"grpc-status": "0"})]
+    assert glob["frames"][-4:] == [(False, "SETTINGS", 0), (False, "HEADERS", 1), (False, "DATA", 1), (False, "HEADERS", 1)]
+
+
+def test_h2c_upgrade():
+    glob = build_glob(FILTER_CODE, ["on_request", "on_response"], proto="http")
+    server = Encoder()
+    send(glob, (
+        b"GET /upgrade HTTP/1.1\r\nHost: test\r\nConnection: Upgrade, HTTP2-Settings\r\n"
+        b"Upgrade: h2c\r\nHTTP2-Settings: AAMAAABkAAQAoAAAAAIAAAAA\r\n\r\n"
+    ), True)
+    assert glob["requests"] == []
+    send(glob, (
+        b"HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n"
+        + SETTINGS + frame(0x1, 0x5, 1, server.encode([(":status", "204")]))
+    ), False)
+    assert glob["responses"] == [(1, 204, b"", False, {})]
+    # The upgrade request is the stream 1, reported once the client starts HTTP/2
+    send(glob, PREFACE + SETTINGS, True)
+    assert glob["requests"] == [(1, "GET", "/upgrade", "test", {}, b"")]
+
+
+def test_http1_stream_not_buffered_after_h2():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpRequest
+
+streams = []
+
+@pyfilter
+def on_request(req: HttpRequest):
+    streams.append(req.stream)
+    return ACCEPT
+""", ["on_request"], proto="http")
+    send(glob, PREFACE + SETTINGS, True)
+    ping = frame(0x6, 0x0, 0, b"\x00" * 8)
+    send(glob, ping, True)
+    send(glob, ping, True)
+    assert glob["streams"][-1] == ping
@@ -0,0 +1,121 @@
+import gzip
+import zlib
+from firegex.nfproxy.models.http import InternalBodyDecoder
+from utils.pyfilter_helpers import build_glob, send
+
+
+FILTER_CODE = """
+from firegex.nfproxy import pyfilter, ACCEPT, DROP
+from firegex.nfproxy.models import HttpBodyChunk, HttpFullResponse
+
+chunks = []
+bodies = []
+
+@pyfilter
+def body_chunk(chunk: HttpBodyChunk):
+    chunks.append((chunk.data, chunk.offset, chunk.body_decoded, chunk.is_last))
+    if b"flag" in chunk.data:
+        return DROP
+    return ACCEPT
+
+@pyfilter
+def full_response(resp: HttpFullResponse):
+    bodies.append((resp.body, resp._message.body_decoded))
+    return ACCEPT
+"""
+
+
+def test_decoder_gzip_in_chunks():
+    body = b"hello world " * 1000
+    encoded = gzip.compress(body) + gzip.compress(b"!")
+    decoder = InternalBodyDecoder("gzip")
+    decoded = b"".join(decoder.feed(encoded[i:i + 100]) for i in range(0, len(encoded), 100))
+    assert decoded + decoder.flush() == body + b"!"
+
+
+def test_decoder_size_cap():
+    decoder = InternalBodyDecoder("deflate", max_size=1000)
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    bomb = compressor.compress(b"\x00" * 100000) + compressor.flush()
+    assert decoder.feed(bomb) is None
+    assert decoder.failed and decoder.exceeded
+
+
+def test_decoder_brotli_size_cap():
+    import brotli
+    decoder = InternalBodyDecoder("br", max_size=10)
+    assert decoder._decompress(0, brotli.compress(b"\x00" * 100000), 11) == b"\x00" * 11
+    decoder = InternalBodyDecoder("br", max_size=1000)
+    assert decoder.feed(brotli.compress(b"\x00" * 100000)) is None
+    assert decoder.failed and decoder.exceeded
+
+
+def test_body_chunks_streamed_and_decoded():
+    glob = build_glob(FILTER_CODE, ["full_response", "body_chunk"], proto="http")
+    body = gzip.compress(b"A" * 50 + b"fl" + b"ag")
+    headers = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n"
+    assert send(glob, headers + body[:10], is_input=False) == (0, None, None)
+    assert glob["chunks"] == []
+    assert send(glob, body[10:], is_input=False) == (1, "body_chunk", None)
+    decoded = b"".join(ele[0] for ele in glob["chunks"])
+    assert decoded == b"A" * 50 + b"flag"
+    assert glob["chunks"][-1][3] is True
+    assert glob["bodies"] == [(b"A" * 50 + b"flag", True)]
+
+
+def test_body_chunks_unknown_encoding():
+    glob = build_glob(FILTER_CODE, ["body_chunk", "full_response"], proto="http")
+    send(glob, b"HTTP/1.1 200 OK\r\nContent-Encoding: custom\r\nContent-Length: 4\r\n\r\nabcd", is_input=False)
+    assert glob["chunks"] == [(b"abcd", 0, False, True)]
+    assert glob["bodies"] == [(b"abcd", False)]
+
+
+def test_decoder_stacked_encodings():
+    import brotli
+    from compression import zstd
+    body = b"firegex " * 500
+    encoded = brotli.compress(zstd.compress(body))
+    decoder = InternalBodyDecoder("zstd, br", max_size=len(body))
+    decoded = b"".join(decoder.feed(encoded[i:i + 50]) for i in range(0, len(encoded), 50))
+    assert decoded + decoder.flush() == body
+    assert not decoder.failed
+
+
+LIMIT_FILTER_CODE = """
+from firegex.nfproxy import pyfilter, ACCEPT, ExceptionAction
+from firegex.nfproxy.models import HttpFullResponse
+
+FGEX_MAX_DECODED_BODY = 1000
+FGEX_DECODE_LIMIT_ACTION = ExceptionAction.{action}
+
+bodies = []
+
+@pyfilter
+def full_response(resp: HttpFullResponse):
+    bodies.append((len(resp.body), resp._message.body_decoded))
+    return ACCEPT
+"""
+
+
+def gzip_bomb_response() -> bytes:
+    body = gzip.compress(b"\x00" * 100000)
+    return b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+
+
+def test_decode_limit_reject():
+    glob = build_glob(LIMIT_FILTER_CODE.format(action="REJECT"), ["full_response"], proto="http")
+    assert send(glob, gzip_bomb_response(), is_input=False) == (2, "@MAX_DECODED_BODY_REACHED", None)
+    assert glob["bodies"] == []
+
+
+def test_decode_limit_noaction_keeps_the_body_encoded():
+    glob = build_glob(LIMIT_FILTER_CODE.format(action="NOACTION"), ["full_response"], proto="http")
+    response = gzip_bomb_response()
+    assert send(glob, response, is_input=False) == (0, None, None)
+    assert glob["bodies"] == [(len(response) - response.index(b"\r\n\r\n") - 4, False)]
+
+
+def test_decoder_time_cap():
+    decoder = InternalBodyDecoder("gzip", max_time=0.0000001)
+    assert decoder.feed(gzip.compress(b"\x00" * 1000000)) is None
+    assert decoder.limit_reached == "@MAX_DECODE_TIME_REACHED"
@@ -0,0 +1,36 @@
+from utils.pyfilter_helpers import build_glob, send
+
+
+def test_headers_parsed_on_access():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpRequestHeader
+
+seen = []
+
+@pyfilter
+def header_filter(req: HttpRequestHeader):
+    seen.append(req)
+    return ACCEPT
+""", ["header_filter"], proto="http")
+
+    send(glob, (
+        b"GET /first HTTP/1.1\r\nHost: test\r\nUser-Agent: curl/8.0\r\n"
+        b"X-Tag: a\r\nx-tag: b\r\nX-Tag: c\r\n\r\n"
+    ), is_input=True)
+    send(glob, b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+
+    by_url = {req.url: req for req in glob["seen"]}
+    first, second = by_url["/first"], by_url["/second"]
+    msg = first._message
+    assert msg.raw_headers[0] == (b"Host", b"test")
+    assert msg._headers is None and msg._lheaders is None
+
+    assert first.get_header("X-TAG") == "a, b, c"
+    assert first.user_agent == "curl/8.0"
+    assert first.headers == {"Host": "test", "User-Agent": "curl/8.0", "X-Tag": ["a", "c"], "x-tag": "b"}
+    assert first.headers is first.headers
+    # Every message of the keep-alive stream has its own headers
+    assert second.url == "/second"
+    assert second.headers == {"Host": "test"}
+    assert second.get_header("user-agent", "") == ""
@@ -6,7 +6,9 @@ from firegex.nfproxy.models import (
     HttpFullResponse,
     HttpHistory,
     HttpStreamHistory,
+    HttpHistoryEntry,
 )
+from firegex.nfproxy.models.http import InternalHttpHistoryRing
 from firegex.nfproxy.internals import compile, handle_packet
 
 
@@ -283,6 +285,72 @@ def test_http_history_list_mutation():
     assert history_obj.responses == ["dummy_resp"]
 
 
+def test_http_history_ring_snapshots():
+    ring = InternalHttpHistoryRing(4)
+    empty = HttpHistory._from_rings(ring, ring)
+    for i in range(3):
+        ring.append(i)
+    first = HttpHistory._from_rings(ring, ring)
+    for i in range(3, 50):
+        ring.append(i)
+    last = HttpHistory._from_rings(ring, ring)
+
+    # The snapshots don't change when new entries are added or the old ones are dropped
+    assert empty.requests == []
+    assert first.requests == [0, 1, 2]
+    assert last.requests == [46, 47, 48, 49]
+    assert ring.generation == 50
+    assert len(ring) == 4
+    assert len(ring._items) <= 4 + 4 // 8 + 1
+
+    ring.resize(2)
+    assert HttpHistory._from_rings(ring, ring).requests == [48, 49]
+    assert last.requests == [46, 47, 48, 49]
+
+
+def test_http_history_metadata_only():
+    glob = {}
+    clear_pyfilter_registry()
+
+    code = """
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpFullRequest, HttpFullResponse, HttpHistory
+
+recorded_history = []
+
+@pyfilter
+def filter_req(req: HttpFullRequest):
+    return ACCEPT
+
+@pyfilter
+def filter_resp(resp: HttpFullResponse, history: HttpHistory):
+    recorded_history.append((history.requests, history.responses))
+    return ACCEPT
+
+FGEX_HISTORY_METADATA_ONLY = True
+"""
+
+    glob["__firegex_pyfilter_enabled"] = ["filter_req", "filter_resp"]
+    glob["__firegex_proto"] = "http"
+    exec(code, glob, glob)
+    compile(glob)
+
+    glob["__firegex_packet_info"] = create_packet_info(b"POST /upload HTTP/1.1\r\nHost: a\r\nContent-Length: 5\r\n\r\nHELLO", is_input=True)
+    handle_packet(glob)
+    glob["__firegex_packet_info"] = create_packet_info(b"HTTP/1.1 201 Created\r\nContent-Length: 2\r\n\r\nOK", is_input=False)
+    handle_packet(glob)
+    glob["__firegex_packet_info"] = create_packet_info(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n", is_input=False)
+    handle_packet(glob)
+
+    requests, responses = glob["recorded_history"][-1]
+    assert len(requests) == 1 and len(responses) == 1
+    req, resp = requests[0], responses[0]
+    assert isinstance(req, HttpHistoryEntry) and isinstance(resp, HttpHistoryEntry)
+    assert (req.is_input, req.method, req.url, req.body_size, req.content_length) == (True, "POST", "/upload", 5, 5)
+    assert (resp.is_input, resp.status_code, resp.body_size) == (False, "Created", 2)
+    assert len(req.headers_digest) == 32 and req.headers_digest != resp.headers_digest
+
+
 if __name__ == "__main__":
     test_http_history_model()
     test_http_history_stream_execution()
@@ -293,6 +361,8 @@ if __name__ == "__main__":
     test_http_history_negative_max_size()
     test_http_history_nfproxy_import()
     test_http_history_list_mutation()
+    test_http_history_ring_snapshots()
+    test_http_history_metadata_only()
     print("All HTTP history unit tests passed successfully!")
 
 
@@ -0,0 +1,66 @@
+import pytest
+
+from firegex.nfproxy import pyfilter
+from firegex.nfproxy.internals import prefilter_literals
+from utils.pyfilter_helpers import build_glob
+
+
+def test_literals_gathered_from_enabled_filters():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, REJECT
+from firegex.nfproxy.models import TCPInputStream, TCPOutputStream
+
+@pyfilter(prefilter=[b"/admin", b"union select"])
+def sqli(stream: TCPInputStream):
+    return REJECT
+
+@pyfilter(prefilter=[b"flag{", b"/admin"])
+def leak(stream: TCPOutputStream):
+    return REJECT
+
+@pyfilter
+def disabled(stream: TCPInputStream):
+    return REJECT
+""", ["sqli", "leak"])
+
+    assert prefilter_literals(glob) == [b"/admin", b"flag{", b"union select"]
+    # The decorated function is still called as it is
+    assert glob["sqli"](None).name == "REJECT"
+
+
+def test_no_literals_if_a_filter_has_no_prefilter():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, REJECT
+from firegex.nfproxy.models import TCPInputStream
+
+@pyfilter(prefilter=[b"/admin"])
+def with_prefilter(stream: TCPInputStream):
+    return REJECT
+
+@pyfilter
+def without_prefilter(stream: TCPInputStream):
+    return REJECT
+""", ["with_prefilter", "without_prefilter"])
+
+    assert prefilter_literals(glob) is None
+
+
+def test_no_literals_if_a_filter_uses_raw_packet():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, REJECT
+from firegex.nfproxy.models import RawPacket
+
+@pyfilter(prefilter=[b"/admin"])
+def raw(packet: RawPacket):
+    return REJECT
+""", ["raw"])
+
+    assert prefilter_literals(glob) is None
+
+
+@pytest.mark.parametrize("prefilter", [[], b"/admin", ["/admin"], [b""]])
+def test_invalid_prefilter(prefilter):
+    with pytest.raises(Exception, match="Invalid prefilter"):
+        @pyfilter(prefilter=prefilter)
+        def invalid():
+            pass
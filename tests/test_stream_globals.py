@@ -0,0 +1,100 @@
+from firegex.nfproxy.internals import handle_packet, handle_packet_fast, need_raw_packet, new_stream_globals
+from utils.pyfilter_helpers import build_glob, create_packet_info
+
+
+def test_stream_globals_are_isolated():
+    template = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT, DROP
+from firegex.nfproxy.models import TCPInputStream
+
+packets = 0
+
+def limit():
+    return 2
+
+@pyfilter
+def count_packets(data: TCPInputStream):
+    global packets
+    packets += 1
+    if packets > limit():
+        return DROP
+    return ACCEPT
+""", ["count_packets"])
+
+    stream1 = new_stream_globals(template)
+    stream2 = new_stream_globals(template)
+    assert stream1 is not None and stream2 is not None
+
+    for _ in range(3):
+        stream1["__firegex_packet_info"] = create_packet_info(b"a", is_input=True)
+        handle_packet(stream1)
+    stream2["__firegex_packet_info"] = create_packet_info(b"a", is_input=True)
+    handle_packet(stream2)
+
+    assert stream1["packets"] == 3
+    assert stream1["__firegex_pyfilter_result"]["matched_by"] == "count_packets"
+    assert stream2["packets"] == 1
+    assert stream2["__firegex_pyfilter_result"]["action"] == 0
+    assert template["packets"] == 0
+    assert stream1["__firegex_pyfilter_ctx"]["data_handler_context"] is not stream2["__firegex_pyfilter_ctx"]["data_handler_context"]
+
+
+def test_stream_globals_not_shared_with_mutable_values():
+    template = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import TCPInputStream
+
+seen = []
+
+@pyfilter
+def record(data: TCPInputStream):
+    seen.append(data)
+    return ACCEPT
+""", ["record"])
+
+    assert new_stream_globals(template) is None
+
+
+def test_handle_packet_fast_returns_the_result():
+    template = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT, DROP
+from firegex.nfproxy.models import TCPInputStream
+
+@pyfilter
+def block_flag(data: TCPInputStream):
+    if b"flag" in data.data:
+        return DROP
+    return ACCEPT
+""", ["block_flag"])
+
+    stream = new_stream_globals(template)
+    payload = b"hello"
+    assert handle_packet_fast(stream, payload, b"\x00" * 40 + payload, True, False, True, len(payload)) == (0, None, None)
+    payload = b"flag"
+    assert handle_packet_fast(stream, payload, b"\x00" * 40 + payload, True, False, True, len(payload)) == (1, "block_flag", None)
+    assert "__firegex_packet_info" not in stream
+
+
+def test_raw_packet_only_when_needed():
+    code = """
+from firegex.nfproxy import pyfilter, ACCEPT, UNSTABLE_MANGLE
+from firegex.nfproxy.models import TCPInputStream, RawPacket
+
+@pyfilter
+def stream_filter(data: TCPInputStream):
+    return ACCEPT
+
+@pyfilter
+def packet_filter(packet: RawPacket):
+    packet.l4_data = packet.l4_data.replace(b"a", b"b")
+    return UNSTABLE_MANGLE
+"""
+    template = build_glob(code, ["stream_filter"])
+    assert need_raw_packet(template) is False
+    stream = new_stream_globals(template)
+    assert handle_packet_fast(stream, b"a", None, True, False, True, 1) == (0, None, None)
+
+    template = build_glob(code, ["stream_filter", "packet_filter"])
+    assert need_raw_packet(template) is True
+    stream = new_stream_globals(template)
+    assert handle_packet_fast(stream, b"a", b"\x00" * 40 + b"a", True, False, True, 1) == (3, "packet_filter", b"\x00" * 40 + b"b")
@@ -0,0 +1,74 @@
+from utils.pyfilter_helpers import build_glob, send
+
+
+FILTER_CODE = """
+from firegex.nfproxy import pyfilter, ACCEPT, DROP, FullStreamAction
+from firegex.nfproxy.models import TCPInputStream
+
+FGEX_STREAM_MAX_SIZE = 8
+FGEX_FULL_STREAM_ACTION = FullStreamAction.{action}
+
+streams = []
+
+@pyfilter
+def block_flag(stream: TCPInputStream):
+    streams.append((stream.data, stream.total_stream_size))
+    if b"flag" in stream.data:
+        return DROP
+    return ACCEPT
+"""
+
+
+def test_stream_accumulation():
+    glob = build_glob(FILTER_CODE.format(action="FLUSH").replace("FGEX_STREAM_MAX_SIZE = 8", ""), ["block_flag"])
+    for chunk in (b"abc", b"def", b"gh"):
+        assert send(glob, chunk) == (0, None, None)
+    send(glob, b"ignored", is_input=False)
+    assert glob["streams"] == [(b"abc", 3), (b"abcdef", 6), (b"abcdefgh", 8)]
+
+
+def test_stream_keep_last():
+    glob = build_glob(FILTER_CODE.format(action="KEEP_LAST"), ["block_flag"])
+    assert send(glob, b"abcdefg") == (0, None, None)
+    assert send(glob, b"hijkfl") == (0, None, None)
+    assert glob["streams"][-1] == (b"fghijkfl", 13)
+    # The pattern across the two packets is still found in the window
+    assert send(glob, b"ag") == (1, "block_flag", None)
+    assert glob["streams"][-1] == (b"hijkflag", 15)
+
+
+def test_stream_keep_last_first_packet():
+    glob = build_glob(FILTER_CODE.format(action="KEEP_LAST"), ["block_flag"])
+    assert send(glob, b"0123456789ab") == (0, None, None)
+    assert glob["streams"] == [(b"456789ab", 12)]
+
+
+VIEW_FILTER_CODE = """
+import re
+from firegex.nfproxy import pyfilter, ACCEPT, DROP, FullStreamAction
+from firegex.nfproxy.models import TCPInputStream
+
+FGEX_STREAM_MAX_SIZE = 8
+FGEX_FULL_STREAM_ACTION = FullStreamAction.KEEP_LAST
+
+views = []
+new_data = []
+
+@pyfilter
+def block_flag(stream: TCPInputStream):
+    views.append(stream.view)  # Kept after the call: the stream must still grow
+    new_data.append(stream.new_data)
+    if re.search(rb"fl.g", stream.view):
+        return DROP
+    return ACCEPT
+"""
+
+
+def test_stream_view():
+    glob = build_glob(VIEW_FILTER_CODE, ["block_flag"])
+    assert send(glob, b"abcdefg") == (0, None, None)
+    assert send(glob, b"hijkfl") == (0, None, None)
+    assert send(glob, b"ag") == (1, "block_flag", None)
+    assert [bytes(view) for view in glob["views"]] == [b"abcdefg", b"fghijkfl", b"hijkflag"]
+    assert glob["views"][-1].readonly
+    assert glob["new_data"] == [b"abcdefg", b"hijkfl", b"ag"]
@@ -0,0 +1,132 @@
+import struct
+import pytest
+from websockets.exceptions import ProtocolError
+from websockets.frames import Frame, Opcode
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from firegex.nfproxy.models.http import InternalHttpRequest, InternalWebSocketDecoder
+from utils.pyfilter_helpers import build_glob, send
+
+
+def client_frames(payloads: list[bytes], extensions=None) -> bytes:
+    return b"".join(
+        Frame(Opcode.TEXT, payload).serialize(mask=True, extensions=extensions)
+        for payload in payloads
+    )
+
+
+def test_frames_split_between_packets():
+    payloads = [b"a" * 10, b"b" * 300, b"c" * 70000]
+    data = client_frames(payloads)
+    decoder = InternalWebSocketDecoder(mask=True)
+    frames = []
+    for i in range(0, len(data), 1000):
+        decoder.feed(data[i:i + 1000], frames)
+    assert [frame.data for frame in frames] == payloads
+    assert decoder.pending == b""
+
+    # More frames in a single packet, the last one incomplete
+    frames = []
+    decoder.feed(data[:-5], frames)
+    assert [frame.data for frame in frames] == payloads[:2]
+    decoder.feed(data[-5:], frames)
+    assert [frame.data for frame in frames] == payloads
+
+
+def test_permessage_deflate_context_takeover():
+    encoder = PerMessageDeflate(False, False, 15, 15)
+    payloads = [b"hello websocket " * 20, b"hello websocket " * 20 + b"!"]
+    # The second frame refers to the data of the first one (context takeover)
+    data = client_frames(payloads, extensions=[encoder])
+    decoder = InternalWebSocketDecoder(mask=True)
+    frames = []
+    decoder.feed(data, frames, [PerMessageDeflate(False, False, 15, 15)])
+    assert [frame.data for frame in frames] == payloads
+
+
+def test_invalid_frame_passed_to_stream():
+    parser = InternalHttpRequest()
+    parser.parse_data(
+        b"GET /chat HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    )
+    assert parser.msg.upgrading_to_ws
+    unmasked = Frame(Opcode.TEXT, b"not masked").serialize(mask=False)
+    parser.parse_data(client_frames([b"first"]) + unmasked)
+    assert [frame.data for frame in parser.msg.ws_stream] == [b"first"]
+    assert parser.msg.stream == unmasked
+
+
+def test_request_filter_gets_the_extensions_of_the_response():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT
+from firegex.nfproxy.models import HttpRequest
+
+ws_streams = []
+
+@pyfilter
+def on_request(req: HttpRequest):
+    ws_streams.append([frame.data for frame in req.ws_stream])
+    return ACCEPT
+""", ["on_request"], proto="http")
+
+    send(glob, b"GET / HTTP/1.1\r\nHost: test\r\n\r\n", is_input=True)
+    # The server packets are parsed for the request filter until the upgrade
+    assert send(glob, b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok", is_input=False)[0] == 0
+    send(glob, (
+        b"GET /chat HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n"
+        b"Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n"
+    ), is_input=True)
+    # Once the extensions are known the server packets are no longer needed (ACCEPT_DIRECTION)
+    assert send(glob, (
+        b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\nSec-WebSocket-Extensions: permessage-deflate\r\n\r\n"
+    ), is_input=False)[0] == 5
+    send(glob, client_frames([b"hello hello hello"], extensions=[PerMessageDeflate(False, False, 15, 15)]), is_input=True)
+    assert glob["ws_streams"][-1] == [b"hello hello hello"]
+
+
+WS_UPGRADE_REQUEST = (
+    b"GET /chat HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+    b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n"
+)
+
+
+def test_incomplete_frame_counted_in_the_stream_size():
+    glob = build_glob("""
+from firegex.nfproxy import pyfilter, ACCEPT, FullStreamAction
+from firegex.nfproxy.models import HttpRequest
+
+FGEX_STREAM_MAX_SIZE = 100000
+FGEX_FULL_STREAM_ACTION = FullStreamAction.REJECT
+
+@pyfilter
+def on_request(req: HttpRequest):
+    return ACCEPT
+""", ["on_request"], proto="http")
+    send(glob, WS_UPGRADE_REQUEST, is_input=True)
+    assert send(glob, b"\x81\xff" + struct.pack("!Q", 2**40) + b"mask", is_input=True)[0] == 0
+    results = [send(glob, b"A" * 10000, is_input=True) for _ in range(300)]
+    assert (2, "@MAX_STREAM_SIZE_REACHED", None) in results
+
+
+def test_discarded_frame_skipped():
+    decoder = InternalWebSocketDecoder(mask=True)
+    frames = []
+    data = client_frames([b"a" * 1000])
+    decoder.feed(data[:500], frames)
+    assert decoder.pending_size == 500
+    decoder.discard()
+    assert decoder.pending_size == 0
+    # The rest of the dropped frame is skipped, the next frame is parsed
+    decoder.feed(data[500:] + client_frames([b"next"]), frames)
+    assert [frame.data for frame in frames] == [b"next"]
+
+
+def test_frame_size_cap():
+    decoder = InternalWebSocketDecoder(mask=True, max_frame_size=100)
+    frames = []
+    decoder.feed(client_frames([b"a" * 100]), frames)
+    with pytest.raises(ProtocolError):
+        decoder.feed(client_frames([b"a" * 101])[:10], frames)
+    assert len(frames) == 1
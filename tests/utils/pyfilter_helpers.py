@@ -0,0 +1,30 @@
+from firegex.nfproxy import clear_pyfilter_registry
+from firegex.nfproxy.internals import compile, handle_packet_fast
+
+
+def build_glob(code: str, filters: list[str], proto: str = "tcp") -> dict:
+    """Executes the filter code and compiles it as the C++ core does, with the given filters enabled"""
+    glob = {}
+    clear_pyfilter_registry()
+    glob["__firegex_pyfilter_enabled"] = filters
+    glob["__firegex_proto"] = proto
+    exec(code, glob, glob)
+    compile(glob)
+    return glob
+
+
+def send(glob: dict, payload: bytes, is_input: bool = True):
+    """Runs the filters on a packet with the given payload, as the C++ core does"""
+    return handle_packet_fast(glob, payload, b"\x00" * 40 + payload, is_input, False, True, len(payload))
+
+
+def create_packet_info(payload: bytes, is_input: bool) -> dict:
+    """The __firegex_packet_info of a packet with the given payload, for firegex.nfproxy.internals.handle_packet"""
+    return {
+        "data": payload,
+        "raw_packet": b"\x00" * 40 + payload,
+        "is_input": is_input,
+        "is_ipv6": False,
+        "is_tcp": True,
+        "l4_size": len(payload),
+    }
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Cost of the websocket frame parsing of nfproxy (firegex.nfproxy.models.http.InternalWebSocketDecoder),
+compared with parsing the frames with websockets.frames.Frame.parse and a read_exact generator (the way it was done before):
+a masked client stream is sent in packets of 1400 bytes, with small frames and with frames bigger than a packet.
+"""
+
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../fgex-lib")))
+
+from websockets.frames import Frame, Opcode
+from firegex.nfproxy.models.http import InternalWebSocketDecoder
+
+PACKET_SIZE = 1400
+
+def frame_parse_path(packets: list[bytes]) -> int:
+    n_frames = 0
+    stream = b""
+    for packet in packets:
+        stream += packet
+        while True:
+            read_buffering = bytearray()
+
+            def read_exact(n: int):
+                nonlocal read_buffering
+                buffer = bytearray(read_buffering)
+                while len(buffer) < n:
+                    data = yield
+                    buffer.extend(data)
+                new_data = bytes(buffer[:n])
+                read_buffering = buffer[n:]
+                return new_data
+
+            parsing = Frame.parse(read_exact, extensions=[], mask=True)
+            parsing.send(None)
+            try:
+                parsing.send(bytearray(stream))
+            except StopIteration:
+                n_frames += 1
+                stream = bytes(read_buffering)
+                continue
+            break  # Incomplete frame: parsed again from the start with the next packet
+    return n_frames
+
+def decoder_path(packets: list[bytes]) -> int:
+    decoder = InternalWebSocketDecoder(mask=True)
+    frames = []
+    for packet in packets:
+        decoder.feed(packet, frames)
+    return len(frames)
+
+def build_packets(frame_size: int, n_frames: int) -> list[bytes]:
+    data = b"".join(Frame(Opcode.BINARY, os.urandom(frame_size)).serialize(mask=True) for _ in range(n_frames))
+    return [data[i:i + PACKET_SIZE] for i in range(0, len(data), PACKET_SIZE)]
+
+def run_bench(func, packets: list[bytes], n_frames: int, n_runs: int) -> float:
+    best = None
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        assert func(packets) == n_frames
+        elapsed = (time.perf_counter() - start) / n_frames
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", "-n", type=int, required=False, help="Number of frames of the stream", default=2000)
+    parser.add_argument("--runs", "-r", type=int, required=False, help="Number of runs for each parser", default=5)
+    args = parser.parse_args()
+
+    print(f"{'frame size':>10} {'Frame.parse us/frame':>22} {'decoder us/frame':>18}")
+    for frame_size in (64, 1024, 16384):
+        packets = build_packets(frame_size, args.frames)
+        old = run_bench(frame_parse_path, packets, args.frames, args.runs)
+        new = run_bench(decoder_path, packets, args.frames, args.runs)
+        print(f"{frame_size:>10} {old*1e6:>22.2f} {new*1e6:>18.2f}")